@@ -0,0 +1,61 @@
+#!/usr/local/bin/python3
+
+import argparse
+import math
+import os
+import struct
+import timeit
+from btcp.btcp_segment import calculate_checksum
+from btcp.constants import *
+
+
+# The checksum function as it was before the one's complement engine, kept to compare against
+def legacy_checksum(data):
+    data_buffer = []
+    current_data = data
+    for x in range(math.ceil(PAYLOAD_SIZE/2)):
+        bit_buffer = current_data[:2]
+        current_data = current_data[2:]
+        if len(bit_buffer) > 0:
+            if len(bit_buffer) == 1:
+                (integer,) = struct.unpack('B', bit_buffer)
+            else:
+                (integer,) = struct.unpack('H', bit_buffer)
+            data_buffer.append(integer)
+        else:
+            break
+    wraparound = bin(sum(data_buffer))
+    new_sum = int(str(wraparound[10:]), 2)
+    carrys_to_add = wraparound[2:]
+    for x in range(len(carrys_to_add)):
+        if carrys_to_add[x] == 1:
+            new_sum += math.pow(2, 7-x)
+    checksum = 65535 - new_sum
+    return checksum
+
+
+def time_function(function, data, number):
+    return timeit.timeit(lambda: function(data), number=number) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", help="Number of runs per measurement", type=int, default=1000)
+    args = parser.parse_args()
+
+    print("{:>10} {:>14} {:>14} {:>10}".format("size", "legacy (us)", "engine (us)", "speedup"))
+    for size in [HEADER_SIZE, PAYLOAD_SIZE // 2, PAYLOAD_SIZE]:
+        data = os.urandom(size)
+        legacy = time_function(legacy_checksum, data, args.number)
+        engine = time_function(calculate_checksum, data, args.number)
+        print("{:>10} {:>14.2f} {:>14.2f} {:>9.1f}x".format(size, legacy, engine, legacy / engine))
+
+    # the legacy function only looks at the first PAYLOAD_SIZE bytes, so for whole files only the engine is timed
+    for size in [64 * 1024, 1024 * 1024]:
+        data = os.urandom(size)
+        engine = time_function(calculate_checksum, data, max(1, args.number // 100))
+        print("{:>10} {:>14} {:>14.2f}".format(size, "-", engine))
+
+
+if __name__ == "__main__":
+    main()
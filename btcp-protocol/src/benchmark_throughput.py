@@ -0,0 +1,280 @@
+#!/usr/local/bin/python3
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from btcp.client_socket import BTCPClientSocket
+from btcp.congestion_control import CONGESTION_CONTROLLERS
+from btcp.constants import *
+from btcp.network_emulator import EmulatedNetwork
+from btcp.server_socket import BTCPServerSocket
+from btcp.striping import StripedClient, StripedReceiver
+
+# The network profiles of the test framework, as netem arguments. The delay profile depends on the timeout (ms).
+PROFILES = {
+    'ideal': "",
+    'flip': "corrupt 1%",
+    'duplicate': "duplicate 10%",
+    'lossy': "loss 10% 25%",
+    'reorder': "delay 20ms reorder 25% 50%",
+    'delay': "delay {timeout}ms 20ms",
+    'all_bad': "corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%",
+    'bottleneck': "delay 20ms rate 20mbit limit 20",
+}
+
+# Return size bytes of CSV text: rows of a timestamp, a host name, a level and a measurement, as found in logs
+def csv_content(rng, size):
+    rows = []
+    length = 0
+    timestamp = 1600000000
+    while length < size:
+        timestamp += rng.randrange(1000)
+        row = "{},host{:02d},{},{:.3f}\n".format(timestamp, rng.randrange(16), rng.choice(("INFO", "WARN", "ERROR")),
+                                               rng.random() * 100)
+        rows.append(row)
+        length += len(row)
+    return "".join(rows).encode()[:size]
+
+
+# The contents the input files can have
+CONTENTS = {
+    'random': lambda rng, size: rng.randbytes(size),
+    'csv': csv_content,
+}
+
+# The parameters that identify a run, used to group its repetitions and to match results with the baseline
+KEY_FIELDS = ('size', 'window', 'timeout', 'profile', 'congestion', 'pacing', 'fec', 'compression', 'stripes',
+              'content')
+# The values of the fields that were added to the benchmark later, which a run of an older version used implicitly
+KEY_DEFAULTS = {'congestion': DEFAULT_CONGESTION_CONTROL, 'pacing': None, 'fec': None, 'compression': False,
+                'stripes': 1, 'content': 'random'}
+
+
+# Transfer the input file from a client to a server over an emulated network and put the measurements in the
+# queue. Every run has its own process, so the CPU time and the peak RSS belong to that run alone.
+def run_transfer(run, input_path, output_path, results):
+    # the sockets print their progress, which would get mixed up with the table
+    sys.stdout = open(os.devnull, 'w')
+    network = EmulatedNetwork(seed=run['seed'])
+    network.set_profile(PROFILES[run['profile']].format(timeout=run['timeout']))
+    options = {'pacing': run['pacing'], 'fec': run['fec'], 'compression': run['compression']}
+    if run['stripes'] > 1:
+        run_striped_transfer(run, network, options, input_path, output_path, results)
+        return
+    client = BTCPClientSocket(run['window'], run['timeout'], run['congestion'], network=network, **options)
+    server = BTCPServerSocket(run['window'], run['timeout'], network=network)
+    try:
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        server.accept()
+        start = time.monotonic()
+        client.connect()
+        client.send(input_path)
+        # send returns when every packet is acknowledged, so all data has reached the server by now
+        completion_time = time.monotonic() - start
+        server.recv(output_path)
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        client.disconnect()
+
+        sender = client.stats()['sender']
+        put_measurements(run, input_path, output_path, completion_time, sender['segments_sent'],
+                         sender['retransmissions'], start_usage, end_usage, results)
+    finally:
+        client.close()
+        server.close()
+        network.close()
+
+
+# Transfer the input file over run['stripes'] parallel connections (see StripedClient) and put the measurements in
+# the queue, together with the goodput of every stripe
+def run_striped_transfer(run, network, options, input_path, output_path, results):
+    client = StripedClient(run['window'], run['timeout'], run['stripes'], network=network,
+                           congestion_control=run['congestion'], **options)
+    server = BTCPServerSocket(run['window'], run['timeout'], network=network)
+    receiver = StripedReceiver(server)
+    try:
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        receiving = threading.Thread(target=receiver.recv, args=(output_path,))
+        receiving.start()
+        start = time.monotonic()
+        client.send(input_path)
+        receiving.join()
+        completion_time = time.monotonic() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        stripes = client.stats()['stripes']
+        put_measurements(run, input_path, output_path, completion_time,
+                         sum(stripe['segments_sent'] for stripe in stripes),
+                         sum(stripe['retransmissions'] for stripe in stripes), start_usage, end_usage, results,
+                         stripe_goodput_mbps=[stripe['goodput_mbps'] for stripe in stripes])
+    finally:
+        server.close()
+        network.close()
+
+
+# Compare the output file with the input file and put the measurements of a transfer in the queue
+def put_measurements(run, input_path, output_path, completion_time, segments_sent, retransmissions, start_usage,
+                     end_usage, results, **extra):
+    with open(input_path, 'rb') as f_in, open(output_path, 'rb') as f_out:
+        correct = f_in.read() == f_out.read()
+    packets = segments_sent - retransmissions
+    results.put(dict({
+        'completion_time': completion_time,
+        'goodput_mbps': run['size'] * 8 / completion_time / 1e6,
+        'retransmission_ratio': retransmissions / packets if packets else 0.0,
+        'cpu_time': (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': end_usage.ru_maxrss,
+        'correct': correct,
+    }, **extra))
+
+
+# Run one configuration in a child process, a run that does not finish within limit seconds is recorded as failed
+def measure(run, input_path, directory, limit):
+    results = multiprocessing.Queue()
+    output_path = os.path.join(directory, "output_{}.file".format(os.getpid()))
+    process = multiprocessing.Process(target=run_transfer, args=(run, input_path, output_path, results))
+    process.start()
+    process.join(limit)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return dict(run, correct=False, timed_out=True)
+    try:
+        return dict(run, timed_out=False, **results.get(timeout=1))
+    except queue.Empty:
+        return dict(run, correct=False, timed_out=False)
+
+
+# Combine the repetitions of every configuration: the median of the measurements and the largest peak RSS
+def summarize(results):
+    summary = []
+    for key, runs in itertools.groupby(sorted(results, key=result_key), key=result_key):
+        runs = list(runs)
+        finished = [run for run in runs if run['correct']]
+        entry = dict(zip(KEY_FIELDS, key), repetitions=len(runs), failures=len(runs) - len(finished))
+        if finished:
+            for field in ('completion_time', 'goodput_mbps', 'retransmission_ratio', 'cpu_time'):
+                entry[field] = statistics.median(run[field] for run in finished)
+            entry['peak_rss_kb'] = max(run['peak_rss_kb'] for run in finished)
+        summary.append(entry)
+    return summary
+
+
+# A field that a baseline of an older version of the benchmark does not have gets the value that version used, so
+# that baseline still matches the runs of the same configuration
+def result_key(result):
+    return tuple(result.get(field, KEY_DEFAULTS.get(field)) for field in KEY_FIELDS)
+
+
+# Print the change in goodput against the baseline and return the configurations that got slower by more than
+# tolerance (a fraction), or that failed while they passed in the baseline, and the configurations that are not in
+# the baseline at all
+def compare(summary, baseline, tolerance):
+    baseline = {result_key(entry): entry for entry in baseline['summary']}
+    regressions = []
+    unmatched = []
+    print()
+    print("{:>10} {:>6} {:>6} {:>10} {:>14} {:>14} {:>9}".format(
+        "size", "window", "timeout", "profile", "baseline Mb/s", "current Mb/s", "change"))
+    for entry in summary:
+        old = baseline.get(result_key(entry))
+        if old is None:
+            unmatched.append(entry)
+            print("{size:>10} {window:>6} {timeout:>6} {profile:>10}".format(**entry), "{:>40}".format("no baseline"))
+            continue
+        if 'goodput_mbps' not in entry or 'goodput_mbps' not in old:
+            change = "failed" if 'goodput_mbps' not in entry else "fixed"
+            if 'goodput_mbps' in old:
+                regressions.append(entry)
+            print("{size:>10} {window:>6} {timeout:>6} {profile:>10}".format(**entry), "{:>40}".format(change))
+            continue
+        change = entry['goodput_mbps'] / old['goodput_mbps'] - 1
+        if change < -tolerance:
+            regressions.append(entry)
+        print("{size:>10} {window:>6} {timeout:>6} {profile:>10}".format(**entry),
+              "{:>14.2f} {:>14.2f} {:>+8.1f}%".format(old['goodput_mbps'], entry['goodput_mbps'], change * 100))
+    return regressions, unmatched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", help="File sizes to send in bytes", type=int, nargs='+',
+                        default=[100 * 1000, 1000 * 1000])
+    parser.add_argument("-w", "--window", help="bTCP window sizes", type=int, nargs='+', default=[100])
+    parser.add_argument("-t", "--timeout", help="bTCP timeouts in milliseconds", type=int, nargs='+', default=[100])
+    parser.add_argument("-p", "--profiles", help="Network profiles", nargs='+', choices=list(PROFILES),
+                        default=list(PROFILES))
+    parser.add_argument("-c", "--congestion", help="Congestion controller to use",
+                        choices=sorted(CONGESTION_CONTROLLERS), default=DEFAULT_CONGESTION_CONTROL)
+    parser.add_argument("--pacing", help="Pace the segments: 'rtt' or a rate such as 10mbit")
+    parser.add_argument("--fec", help="Forward error correction: 'adaptive' or the number of segments per parity "
+                                      "segment")
+    parser.add_argument("--compression", help="Compress the payloads", action="store_true")
+    parser.add_argument("--stripes", help="Number of parallel connections the file is striped over", type=int,
+                        default=1)
+    parser.add_argument("--content", help="Content of the input files: random bytes or CSV text",
+                        choices=sorted(CONTENTS), default='random')
+    parser.add_argument("-r", "--repeat", help="Number of runs per configuration", type=int, default=1)
+    parser.add_argument("--seed", help="Seed of the input files and the emulated network", type=int, default=0)
+    parser.add_argument("--limit", help="Seconds after which a run is aborted", type=float, default=300)
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="Compare against the results in this JSON file")
+    parser.add_argument("--tolerance", help="Fraction of goodput that may be lost before a configuration counts "
+                                            "as a regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = []
+    print("{:>10} {:>6} {:>6} {:>10} {:>8} {:>10} {:>8} {:>8} {:>10} {:>7}".format(
+        "size", "window", "timeout", "profile", "time (s)", "Mb/s", "retrans", "cpu (s)", "rss (kB)", "correct"))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            input_path = os.path.join(directory, "input_{}.file".format(size))
+            with open(input_path, 'wb') as f:
+                f.write(CONTENTS[args.content](random.Random(args.seed), size))
+            for (window, timeout, profile, repetition) in itertools.product(args.window, args.timeout,
+                                                                            args.profiles, range(args.repeat)):
+                run = {'size': size, 'window': window, 'timeout': timeout, 'profile': profile,
+                       'congestion': args.congestion, 'pacing': args.pacing, 'fec': args.fec,
+                       'compression': args.compression, 'content': args.content, 'stripes': args.stripes,
+                       'seed': args.seed + repetition}
+                result = measure(run, input_path, directory, args.limit)
+                results.append(result)
+                if 'completion_time' in result:
+                    print("{size:>10} {window:>6} {timeout:>6} {profile:>10} {completion_time:>8.2f} "
+                          "{goodput_mbps:>10.2f} {retransmission_ratio:>8.3f} {cpu_time:>8.2f} {peak_rss_kb:>10} "
+                          "{correct!s:>7}".format(**result))
+                else:
+                    print("{size:>10} {window:>6} {timeout:>6} {profile:>10}".format(**result),
+                          "timed out" if result['timed_out'] else "failed")
+
+    summary = summarize(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results, 'summary': summary}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        (regressions, unmatched) = compare(summary, baseline, args.tolerance)
+        if unmatched:
+            # a configuration without a baseline is not compared, so it must not pass as free of regressions
+            print("{} configuration(s) have no match in the baseline".format(len(unmatched)))
+        if regressions:
+            print("{} configuration(s) regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+        if unmatched or regressions:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import asyncio
+import contextlib
+import socket
+from btcp.constants import *
+from btcp.lossy_layer import path_payload_size
+
+
+# asyncio version of the lossy layer. Instead of a thread that polls the socket, the event loop calls
+# datagram_received for every segment that arrives, which passes it to the lossy_layer_input method of the
+# associated socket. The UDP socket is bound when open is awaited.
+class AsyncLossyLayer(asyncio.DatagramProtocol):
+    def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        self._bTCP_sock = bTCP_sock
+        self._a_ip = a_ip
+        self._a_port = a_port
+        self._b_ip = b_ip
+        self._b_port = b_port
+        self._transport = None
+
+    # Bind the socket and register it with the running event loop, does nothing when it is already open
+    async def open(self):
+        if self._transport is not None:
+            return
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER_SIZE)
+        udp_sock.bind((self._a_ip, self._a_port))
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=udp_sock)
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, address):
+        self._bTCP_sock.lossy_layer_input((data, address))
+
+    # An ICMP error (e.g. port unreachable) for an earlier segment, bTCP treats it as a lost segment
+    def error_received(self, exc):
+        pass
+
+    # Close the socket
+    def destroy(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    # Return the largest payload of a segment that can be sent to address (b by default) without fragmentation
+    def path_payload_size(self, address=None):
+        return path_payload_size((self._b_ip, self._b_port) if address is None else address)
+
+    # The transport already queues the segments that are sent while the event loop is busy, so a batch needs no
+    # bookkeeping of its own
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    # Put the segment (bytes, bytearray or memoryview) into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address=None):
+        if self._transport is None:
+            return
+        if address is None:
+            address = (self._b_ip, self._b_port)
+        self._transport.sendto(segment, address)
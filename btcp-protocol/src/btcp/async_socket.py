@@ -0,0 +1,249 @@
+import asyncio
+import functools
+import logging
+from btcp.async_lossy_layer import AsyncLossyLayer
+from btcp.client_socket import BTCPClientSocket
+from btcp.framing import MessageParser, name_messages
+from btcp.server_connection import BTCPServerConnection
+from btcp.server_socket import BTCPServerSocket
+from btcp.btcp_segment import *
+
+logger = logging.getLogger(__name__)
+
+
+# Delayed ACK timer that runs on an asyncio event loop, with the same Start, Cancel and Stop methods as
+# DelayedAckTimer
+class AsyncDelayedAckTimer:
+    def __init__(self, loop, delay, callback):
+        self._loop = loop
+        self._delay = delay
+        self._callback = callback
+        self._handle = None
+        self._stopped = False
+
+    # Arm the timer if it is not armed yet
+    def Start(self):
+        if self._handle is None and not self._stopped:
+            self._handle = self._loop.call_later(self._delay, self.Fire)
+
+    # Disarm the timer
+    def Cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def Stop(self):
+        self.Cancel()
+        self._stopped = True
+
+    def Fire(self):
+        self._handle = None
+        self._callback()
+
+
+# bTCP client socket for asyncio. It uses the handshakes and the selective repeat sender of BTCPClientSocket, but
+# receives its segments from the event loop and drives the sender and all timeouts with the loop as well, so a
+# single thread can run many connections. connect, send and disconnect are coroutines.
+class AsyncBTCPClientSocket(BTCPClientSocket):
+    def __init__(self, window, timeout, congestion_control=DEFAULT_CONGESTION_CONTROL, port=CLIENT_PORT, pacing=None,
+                 fec=None, compression=False):
+        super().__init__(window, timeout, congestion_control, port, pacing=pacing, fec=fec, compression=compression)
+
+        # Event that is set whenever a segment arrived, to wake up the coroutine that waits for a handshake
+        self._input_event = asyncio.Event()
+
+    def create_lossy_layer(self, port):
+        return AsyncLossyLayer(self, CLIENT_IP, port, SERVER_IP, SERVER_PORT)
+
+    # Called by the event loop whenever a segment arrives
+    def lossy_layer_input(self, rec_data):
+        super().lossy_layer_input(rec_data)
+        self._input_event.set()
+
+    # Wait until _connected_to_server becomes connected. Returns False if that did not happen within timeout ms. The
+    # state is checked once more after the timeout: the segment that changed it may have arrived in the same loop
+    # iteration.
+    async def wait_for_connection_state(self, connected, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout / 1000
+        while self._connected_to_server != connected:
+            self._input_event.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._input_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self._connected_to_server == connected
+
+    # Perform a three-way handshake to establish a connection. A connected socket does not send a new SYN: the server
+    # would take it for a new connection and replace the one it accepted.
+    async def connect(self):
+        await self._lossy_layer.open()
+        if self._connected_to_server:
+            return
+        print("connecting...")
+        self._connecting = True
+        try:
+            for connect_attempts in range(1, MAX_NUMBER_OF_CONNECTION_TRIES + 1):
+                self.synchonize_server()
+                if await self.wait_for_connection_state(True, self._timeout):
+                    return
+                if connect_attempts < MAX_NUMBER_OF_CONNECTION_TRIES:
+                    print("Connection attempt failed: Connection timeout, retrying...")
+        finally:
+            self._connecting = False
+        print("Connection attempts failed: Max number of connection tries ({}) exceeded.".format(
+            MAX_NUMBER_OF_CONNECTION_TRIES))
+
+    # Send the file with path data (or length bytes of it from offset on, preceded by header) in a reliable way to
+    # the server. The sender is woken up by every ACK and by a loop timer at its next retransmission or pacing
+    # deadline.
+    async def send(self, data, offset=0, length=None, header=b''):
+        self._selective_repeater.OpenData(data, offset, length, header)
+        try:
+            await self.send_all()
+        finally:
+            self._selective_repeater.CloseData()
+
+    # Send files to the server as framed messages over the connection that stays open, see
+    # BTCPClientSocket.send_messages
+    async def send_messages(self, messages):
+        self._selective_repeater.AddMessages(name_messages(messages))
+        await self.send_all()
+
+    # Run the sender until all of its data was acknowledged
+    async def send_all(self):
+        loop = asyncio.get_running_loop()
+        sender = self._selective_repeater
+        wakeup = asyncio.Event()
+        sender.SetAckListener(wakeup.set)
+        try:
+            while not sender.Finished():
+                sender.SendStep()
+                if sender.Finished():
+                    break
+                wait_time = sender.WaitTime()
+                timer = None
+                if wait_time is not None:
+                    timer = loop.call_later(wait_time, wakeup.set)
+                await wakeup.wait()
+                wakeup.clear()
+                if timer is not None:
+                    timer.cancel()
+        finally:
+            sender.SetAckListener(None)
+
+    # Perform a handshake to terminate a connection
+    async def disconnect(self):
+        print("disconnecting...")
+        for terminate_attempts in range(1, MAX_NUMBER_OF_TERMINATION_TRIES + 1):
+            self.finish_server()
+            if await self.wait_for_connection_state(False, self._timeout):
+                return
+            if terminate_attempts < MAX_NUMBER_OF_TERMINATION_TRIES:
+                print("Termination attempt failed: Termination timeout, retrying...")
+        print("Termination attempts failed: Max number of termination tries ({}) exceeded.".format(
+            MAX_NUMBER_OF_TERMINATION_TRIES))
+        self._connected_to_server = False
+
+
+# Connection of an AsyncBTCPServerSocket with one client. Data is read with the read and recv coroutines.
+class AsyncBTCPServerConnection(BTCPServerConnection):
+    def __init__(self, lossy_layer, address, connection_id, window, timer_factory, buffer_size=RECEIVE_BUFFER_SIZE):
+        super().__init__(lossy_layer, address, connection_id, window, timer_factory, buffer_size)
+
+        # Event that is set whenever a segment of this connection arrived
+        self._input_event = asyncio.Event()
+
+    def notify_input(self):
+        self._input_event.set()
+
+    # Clean up any state and wake up the coroutine that waits in read
+    def close(self):
+        super().close()
+        self._input_event.set()
+
+    # Return the data that was received in order since the last call, wait for it if there is none. Returns empty
+    # bytes once the client terminated the connection and all data was read.
+    async def read(self):
+        while True:
+            data = self.DeliverData()
+            if data or self._finished:
+                return data
+            self._input_event.clear()
+            await self._input_event.wait()
+
+    # Asynchronous generator of the framed messages the client sends, see BTCPServerConnection.messages
+    async def messages(self):
+        parser = MessageParser()
+        data = await self.read()
+        while data:
+            for message in parser.feed(data):
+                yield message
+            data = await self.read()
+        if parser.incomplete():
+            logger.warning("connection with %s ended in the middle of a message", self._address)
+
+    # Write all data the client sends until it terminates the connection to the file with path output
+    async def recv(self, output):
+        f = open(output, 'wb')
+        try:
+            data = await self.read()
+            while data:
+                f.write(data)
+                data = await self.read()
+        finally:
+            f.close()
+        print("Data Received")
+
+
+# bTCP server socket for asyncio. Like BTCPServerSocket it serves many clients at once, but all segments are
+# received and all timers run on the event loop, so no thread is needed per socket or per connection.
+class AsyncBTCPServerSocket(BTCPServerSocket):
+    def __init__(self, window, timeout, buffer_size=RECEIVE_BUFFER_SIZE):
+        super().__init__(window, timeout, buffer_size=buffer_size)
+
+        # Established connections that were not accepted yet, moved here from the accept queue of the base class
+        self._async_accept_queue = asyncio.Queue()
+
+    def create_lossy_layer(self):
+        return AsyncLossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+
+    def create_connection(self, address, connection_id):
+        timer_factory = functools.partial(AsyncDelayedAckTimer, asyncio.get_running_loop())
+        return AsyncBTCPServerConnection(self._lossy_layer, address, connection_id, self._window, timer_factory,
+                                         self._buffer_size)
+
+    # Called by the event loop whenever a segment arrives
+    def lossy_layer_input(self, rec_data):
+        connection = self._connections.get(rec_data[1])
+        super().lossy_layer_input(rec_data)
+        if connection is not None:
+            connection.notify_input()
+        while not self._accept_queue.empty():
+            self._async_accept_queue.put_nowait(self._accept_queue.get_nowait())
+
+    # Start listening and return the next connection that completes the three-way handshake
+    async def accept(self):
+        await self._lossy_layer.open()
+        self._listening = True
+        return await self._async_accept_queue.get()
+
+    # Write all data of the next accepted connection to the file with path output
+    async def recv(self, output):
+        if self._connection is None:
+            self._connection = await self.accept()
+        await self._connection.recv(output)
+
+    # Asynchronous generator of the messages of the next accepted connection
+    async def messages(self):
+        if self._connection is None:
+            self._connection = await self.accept()
+        async for message in self._connection.messages():
+            yield message
+
+    def clean(self):
+        super().clean()
+        self._async_accept_queue = asyncio.Queue()
@@ -1,80 +1,161 @@
 import struct
-import math
 import sys
-import numpy as np
 from btcp.constants import *
 
+# NumPy is only used to checksum large buffers (whole files), never for a single segment. It is imported the first
+# time such a buffer is checksummed, so importing bTCP does not pay for it.
+np = None
+numpy_import_attempted = False
+
+
+# Return the NumPy module, or None if it is not available
+def load_numpy():
+    global np, numpy_import_attempted
+    if not numpy_import_attempted:
+        numpy_import_attempted = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+    return np
+
+
+# Flag values of the header: FLAGS_TO_BINARY[ACK][SYN][FIN] is the 8 bit integer of a combination of flags and
+# BINARY_TO_FLAGS[value] the (ACK, SYN, FIN) tuple of an 8 bit integer
+FLAGS_TO_BINARY = tuple(tuple(tuple(ack | syn << 1 | fin << 2 for fin in (0, 1)) for syn in (0, 1)) for ack in (0, 1))
+BINARY_TO_FLAGS = tuple((bool(value & 1), bool(value & 2), bool(value & 4)) for value in range(256))
+
+# Flag values of a parity segment of forward error correction and of a data segment with a compressed payload. They
+# are not part of the (ACK, SYN, FIN) tuple: these segments have none of those flags, so they reach the receiver the
+# way a data segment does and are told apart by the parity and compressed attributes of their SegmentView. The
+# compressed flag of a parity segment is the XOR of the compressed flags of its block.
+PARITY_FLAG = 8
+COMPRESSED_FLAG = 16
+
+# Flag of a data segment or ACK whose checksum covers its header, sent once both sides agreed to
+# FEATURE_HEADER_CHECKSUM
+HEADER_CHECKSUM_FLAG = 32
+
+# Flags of the optional features. The checksum of a segment of the first wire format covers only its payload, the
+# checksum of a segment with one of these flags also covers its header fields (see header_checksum): a flipped bit
+# must not turn a data segment into a parity segment, mark a payload as compressed that is not, change the block a
+# parity segment rebuilds, move a payload to another sequence number or acknowledge packets that did not arrive.
+EXTENSION_FLAGS = PARITY_FLAG | COMPRESSED_FLAG | HEADER_CHECKSUM_FLAG
+
 
 # Method that translates a 3-tuple to a 8 bit integer that can be used in a segment header
 def flags_to_binary(ACK, SYN, FIN):
-    total = 0
-    if ACK:
-        total += math.pow(2, 0)
-    if SYN:
-        total += math.pow(2, 1)
-    if FIN:
-        total += math.pow(2, 2)
-    return np.uint8(total)
+    return FLAGS_TO_BINARY[bool(ACK)][bool(SYN)][bool(FIN)]
 
 
 # Method that translates the 8 bit integer that was received from a packet to a 3-tuple with the elements ACK,
 # SYN and FIN.
 def binary_to_flags(flags_value):
-    current = flags_value
-    ACK = False
-    SYN = False
-    FIN = False
-    if current >= 4:
-        current -= 4
-        FIN = True
-    if current >= 2:
-        current -= 2
-        SYN = True
-    if current >= 1:
-        ACK = True
-    return ACK, SYN, FIN
-
-
-# Method that calculates the checksum of data
-def calculate_checksum(data):
-    data_buffer = []
-    current_data = data
-
-    # divide 1008 bytes into packets of 2 bytes (16 bit) and put them into the data_buffer
-    for x in range(math.ceil(PAYLOAD_SIZE/2)):
-        bit_buffer = current_data[:2]
-        current_data = current_data[2:]
-        if len(bit_buffer) > 0:
-            if len(bit_buffer) == 1:
-                (integer,) = struct.unpack('B', bit_buffer)
-            else:
-                (integer,) = struct.unpack('H', bit_buffer)
-            data_buffer.append(integer)
-        else:
-            break
-
-    # sum all integers in data_buffer
-    wraparound = bin(sum(data_buffer))
-
-    # take the last 16 bits and turn in into an integer
-    new_sum = int(str(wraparound[10:]), 2)
-
-    # add the carrys to the 16 bit integer
-    carrys_to_add = wraparound[2:]
-    for x in range(len(carrys_to_add)):
-        if carrys_to_add[x] == 1:
-            new_sum += math.pow(2, 7-x)
-
-    # get checksum
-    checksum = 65535 - new_sum
-    return checksum
+    return BINARY_TO_FLAGS[flags_value]
+
+
+# Buffers of at least this many bytes are summed with NumPy (when it is available), smaller buffers are summed
+# with Python's big integers because the NumPy call overhead dominates for them.
+NUMPY_CHECKSUM_THRESHOLD = 4096
+
+
+# Method that adds the 16 bit words of data to partial using one's complement arithmetic (RFC 1071).
+# The words are read in network byte order and an odd trailing byte is padded with a zero byte.
+# The result can be passed as partial again to checksum several buffers (e.g. header and payload) incrementally,
+# as long as every buffer except the last one has an even length.
+def checksum_add(partial, data):
+    if data is None:
+        return partial
+    if len(data) % 2 == 1:
+        data = bytes(data) + b'\x00'
+
+    if len(data) >= NUMPY_CHECKSUM_THRESHOLD and load_numpy() is not None:
+        # sum all words at once, a 64 bit accumulator can not overflow for any realistic buffer
+        total = partial + int(np.frombuffer(data, dtype='>u2').sum(dtype=np.uint64))
+    else:
+        # 2^16 = 1 (mod 2^16 - 1), so the buffer read as one big integer has the same one's complement sum as
+        # its 16 bit words
+        total = partial + int.from_bytes(data, 'big')
+
+    # fold the carrys back into the lower 16 bits, a non-zero sum never folds to zero
+    folded = total % MAX_VALUE_16_BIT_INTEGER
+    if folded == 0 and total != 0:
+        folded = MAX_VALUE_16_BIT_INTEGER
+    return folded
+
+
+# Method that calculates the checksum of data, optionally continuing from a partial sum made with checksum_add
+def calculate_checksum(data, partial=0):
+    return ~checksum_add(partial, data) & MAX_VALUE_16_BIT_INTEGER
+
+
+# Return the partial sum of the header fields that the checksum of a segment with these fields covers, to be passed
+# to calculate_checksum with its payload: none for a segment of the first wire format, all fields before the
+# checksum for a segment with one of the EXTENSION_FLAGS
+def header_checksum(seq_number, ack_number, flags, window, data_length):
+    if not flags & EXTENSION_FLAGS:
+        return 0
+    return checksum_add(0, HEADER_FIELDS_STRUCT.pack(seq_number, ack_number, flags, window, data_length))
+
+
+# Precompiled header format, used to pack headers directly into segment buffers
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
+
+# Precompiled format of the header fields before the checksum
+HEADER_FIELDS_STRUCT = struct.Struct(HEADER_FORMAT[:-1])
+
+# Precompiled format of a selective acknowledgement block in the payload of an ACK
+SACK_BLOCK_STRUCT = struct.Struct(SACK_BLOCK_FORMAT)
+
+# Precompiled format of the maximum segment size option in the payload of a SYN and a SYN-ACK
+MSS_OPTION_STRUCT = struct.Struct(MSS_OPTION_FORMAT)
+
+
+# Read-only view of a received segment. The header is decoded once with the precompiled struct and the flags are
+# looked up in a table. The data is a memoryview into the segment, so nothing is copied: a view of a segment in a
+# reused receive buffer is only valid as long as that buffer is.
+class SegmentView:
+    __slots__ = ('seq_number', 'ack_number', 'flags', 'parity', 'compressed', 'extended', 'window', 'data_length',
+                 'checksum', '_segment')
+
+    def __init__(self, segment):
+        (self.seq_number, self.ack_number, bin_flags, self.window, self.data_length,
+         self.checksum) = HEADER_STRUCT.unpack_from(segment)
+        self.flags = BINARY_TO_FLAGS[bin_flags]
+        self.parity = bin_flags & PARITY_FLAG != 0
+        self.compressed = bin_flags & COMPRESSED_FLAG != 0
+        self.extended = bin_flags & EXTENSION_FLAGS != 0
+        self._segment = segment
+
+    # Everything after the header. Segments are sized to their data, but a peer of the first wire format pads every
+    # segment to SEGMENT_SIZE, so the data may still be followed by zeros.
+    @property
+    def data(self):
+        return memoryview(self._segment)[HEADER_SIZE:]
+
+    # Partial sum of the header fields that the checksum covers, see header_checksum
+    @property
+    def header_checksum(self):
+        if not self.extended:
+            return 0
+        return checksum_add(0, memoryview(self._segment)[:HEADER_FIELDS_STRUCT.size])
+
+    @property
+    def ack(self):
+        return self.flags[0]
+
+    @property
+    def syn(self):
+        return self.flags[1]
+
+    @property
+    def fin(self):
+        return self.flags[2]
 
 
 def unpack_segment(segment):
-    header_segment = segment[:HEADER_SIZE]
-    data_segment = segment[HEADER_SIZE:]
-    (seq_number, ack_number, bin_flags, window, data_length, checksum) = struct.unpack(HEADER_FORMAT, header_segment)
-    return seq_number, ack_number, binary_to_flags(bin_flags), window, data_length, checksum, data_segment
+    return SegmentView(segment)
 
 
 class Segment:
@@ -88,14 +169,82 @@ class Segment:
         self._data = data
 
     def create_segment(self):
-        header_segment = struct.pack(HEADER_FORMAT, self._seq_number, self._ack_number, self._flags, self._window,
-                                     self._data_length,
-                                     self._checksum)
-        segment = header_segment
-        if self._data_length > 0:
-            data_padding = bytes(PAYLOAD_SIZE - self._data_length)
-            segment += self._data
-        else:
-            data_padding = bytes(PAYLOAD_SIZE)
-        segment += data_padding
+        segment = bytearray(HEADER_SIZE + self._data_length)
+        self.create_segment_into(segment)
         return segment
+
+    # Method that packs the segment into buffer (a bytearray or writable memoryview of at least HEADER_SIZE plus
+    # the data length bytes) without allocating. Returns a memoryview of just the encoded bytes: control segments
+    # are only a header and data segments are not padded.
+    def create_segment_into(self, buffer):
+        HEADER_STRUCT.pack_into(buffer, 0, self._seq_number, self._ack_number, self._flags, self._window,
+                                self._data_length, self._checksum)
+        view = memoryview(buffer)
+        data_end = HEADER_SIZE + self._data_length
+        if self._data_length > 0:
+            view[HEADER_SIZE:data_end] = self._data
+        return view[:data_end]
+
+
+# Return the payload of a SYN or SYN-ACK that announces the largest payload size the sender of it can handle. When
+# features is not zero, it follows as a byte: the bitmask of the optional features (FEATURE_*) that the client asks
+# for, or that the server agrees to.
+def pack_mss_option(payload_size, features=0):
+    option = MSS_OPTION_STRUCT.pack(payload_size)
+    if features:
+        option += bytes((features,))
+    return option
+
+
+# Return the payload size that the SYN or SYN-ACK segment announces. A peer of the first wire format sends no option
+# and always uses PAYLOAD_SIZE, which is also assumed when the option (or the header, when the checksum covers it) is
+# damaged. A damaged data length may claim more data than the segment has.
+def unpack_mss_option(segment):
+    data = segment.data
+    if min(segment.data_length, len(data)) < MSS_OPTION_SIZE or \
+            segment.checksum != calculate_checksum(data, segment.header_checksum):
+        return PAYLOAD_SIZE
+    (payload_size,) = MSS_OPTION_STRUCT.unpack_from(data)
+    return max(1, min(payload_size, MAX_PAYLOAD_SIZE))
+
+
+# Return the bitmask of optional features that the SYN or SYN-ACK segment announces. A peer that announces none,
+# like every peer of an older wire format, gets none of them, and so does a damaged option.
+def unpack_features(segment):
+    data = segment.data
+    if min(segment.data_length, len(data)) < MSS_OPTION_SIZE + FEATURES_SIZE or \
+            segment.checksum != calculate_checksum(data, segment.header_checksum):
+        return 0
+    return data[MSS_OPTION_SIZE]
+
+
+# Pool of reusable segment buffers for the packets in a send window. The segment with sequence number x is stored
+# in slot x % slots, so the pool never holds more than one window of segments, and a segment that still occupies
+# its slot can be retransmitted without encoding it again. Buffers of buffer_size bytes are allocated the first time a
+# slot is used.
+class SegmentBufferPool:
+    def __init__(self, slots, buffer_size=SEGMENT_SIZE):
+        self._slots = max(1, slots)
+        self._buffer_size = buffer_size
+        self._views = [None] * self._slots
+
+        # encoded bytes of the segment that is currently stored in each slot and its sequence number
+        self._segments = [None] * self._slots
+        self._owners = [None] * self._slots
+
+    # Return the encoded segment with sequence number seq_number, or None if its slot was reused
+    def get(self, seq_number):
+        slot = seq_number % self._slots
+        if self._owners[slot] == seq_number:
+            return self._segments[slot]
+        return None
+
+    # Encode segment into the slot of seq_number and return a memoryview of the encoded bytes
+    def encode(self, seq_number, segment):
+        slot = seq_number % self._slots
+        if self._views[slot] is None:
+            self._views[slot] = memoryview(bytearray(self._buffer_size))
+        view = segment.create_segment_into(self._views[slot])
+        self._segments[slot] = view
+        self._owners[slot] = seq_number
+        return view
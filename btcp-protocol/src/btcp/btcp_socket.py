@@ -1,3 +1,6 @@
+from btcp.btcp_segment import calculate_checksum
+
+
 class BTCPSocket:
     def __init__(self, window, timeout):
         self._window = window
@@ -6,4 +9,4 @@ class BTCPSocket:
     # Return the Internet checksum of data
     @staticmethod
     def in_cksum(data):
-        pass
+        return calculate_checksum(data)
@@ -0,0 +1,61 @@
+import collections
+import threading
+
+
+# Thread-safe queue of bytes between the protocol and the application. The protocol puts chunks of in-order data in
+# it, the application takes out everything that is available at once. Closing the queue wakes up readers, which
+# then get the remaining data and after that empty bytes.
+class ByteQueue:
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    # Number of bytes in the queue
+    def __len__(self):
+        return self._size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    # Append data to the queue, the queue takes over the buffer so the caller must not change it afterwards
+    def put(self, data):
+        if not data:
+            return
+        with self._condition:
+            self._chunks.append(data)
+            self._size += len(data)
+            self._condition.notify_all()
+
+    # Block until there is data or the queue is closed. Returns False if neither happened within timeout seconds.
+    def wait(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._size > 0 or self._closed, timeout)
+
+    # Remove and return all data in the queue, waiting for some first. Returns empty bytes if the queue was closed
+    # and is empty, or if no data arrived within timeout seconds.
+    def get(self, timeout=None):
+        with self._condition:
+            self._condition.wait_for(lambda: self._size > 0 or self._closed, timeout)
+            return self.take_all()
+
+    # Remove and return all data in the queue without waiting
+    def get_nowait(self):
+        with self._condition:
+            return self.take_all()
+
+    def take_all(self):
+        if not self._chunks:
+            return bytes()
+        data = self._chunks[0] if len(self._chunks) == 1 else b''.join(self._chunks)
+        self._chunks.clear()
+        self._size = 0
+        return bytes(data)
+
+    # Close the queue, readers no longer wait for data
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -1,21 +1,41 @@
+import logging
 import random
-import time
+import threading
 import sys
 from btcp.btcp_socket import BTCPSocket
 from btcp.lossy_layer import LossyLayer
 from btcp.btcp_segment import *
+from btcp.framing import name_messages
 from btcp.selective_repeat import *
 
+logger = logging.getLogger(__name__)
+
 
 # bTCP client socket
 # A client application makes use of the services provided by bTCP by calling connect, send, disconnect, and close
 class BTCPClientSocket(BTCPSocket):
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout, congestion_control=DEFAULT_CONGESTION_CONTROL, port=CLIENT_PORT, network=None,
+                 pacing=None, fec=None, compression=False):
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        self._congestion_control = congestion_control
+        # pacing of the sender: None, "rtt" or a rate (see CreatePacer)
+        self._pacing = pacing
+        # forward error correction the client asks the server for: None, FEC_ADAPTIVE or the number of packets per
+        # parity packet
+        self._fec = fec
+        # whether the client asks the server to accept compressed payloads
+        self._compression = compression
+        # an EmulatedNetwork to send the segments through instead of a UDP socket
+        self._network = network
+        # every client of a server needs its own port, the server tells its connections apart by client address
+        self._lossy_layer = self.create_lossy_layer(port)
 
         # Boolean variable that determines whether the server has a connection to the cient
         self._connected_to_server = False
+        # Boolean variable that is true while connect waits for the SYN-ACK, a SYN-ACK at any other time is ignored
+        self._connecting = False
+        # condition that is notified when _connected_to_server changes, connect and disconnect wait on it
+        self._state_condition = threading.Condition()
 
         # Global variables that keep track of the sequence and the acknowledgement number that are send during
         # the three-way handshake
@@ -25,90 +45,192 @@ class BTCPClientSocket(BTCPSocket):
         # Variable that keeps track of the window size on the server side
         self._window_size_server = 0
 
+        # largest payload of a segment: this side's limit is announced in the SYN, the server answers with its own
+        # and the smallest of the two is used
+        self._max_segment_size = PAYLOAD_SIZE
+
+        # optional features (FEATURE_*) the client asks for in the SYN and the ones the server agreed to. The header
+        # checksum is always asked for, a server of the first wire format ignores it.
+        self._requested_features = FEATURE_HEADER_CHECKSUM
+        if fec is not None:
+            self._requested_features |= FEATURE_FEC
+        if compression:
+            self._requested_features |= FEATURE_COMPRESSION
+        self._features = 0
+
+        # number of segments and bytes that arrived from the network, and of the segments that were dropped because
+        # their checksum did not match or their header did not fit the state of the connection, read with stats
+        self._segments_received = 0
+        self._bytes_received = 0
+        self._checksum_failures = 0
+        self._unexpected_segments = 0
+
         # Selective repeater
-        self._selective_repeater = SelectiveRepeaterSender(self._lossy_layer, self._window, self._timeout)
+        self._selective_repeater = SelectiveRepeaterSender(self._lossy_layer, self._window, self._timeout,
+                                                            self._congestion_control, self._pacing, self._fec,
+                                                            self._compression)
+
+    # Create the lossy layer the socket sends and receives segments with
+    def create_lossy_layer(self, port):
+        if self._network is not None:
+            return self._network.create_lossy_layer(self, CLIENT_IP, port, SERVER_IP, SERVER_PORT)
+        return LossyLayer(self, CLIENT_IP, port, SERVER_IP, SERVER_PORT)
 
     # Called by the lossy layer from another thread whenever a segment arrives. 
     def lossy_layer_input(self, rec_data):
         (header, packet) = rec_data
-        seg_info = unpack_segment(header)
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
+        self._segments_received += 1
+        self._bytes_received += len(header)
+        segment = unpack_segment(header)
+        # the flags are only read once the segment is known to be undamaged. After the server agreed to the header
+        # checksum every segment it sends covers its header, so a segment that does not, or whose checksum does not
+        # match, is dropped: its flags may have been damaged as well.
+        if segment.extended or self._features & FEATURE_HEADER_CHECKSUM:
+            if not segment.extended or segment.checksum != calculate_checksum(segment.data, segment.header_checksum):
+                self._checksum_failures += 1
+                return
+        (ack, syn, fin) = segment.flags
         if not syn and ack and not fin:
             if self._selective_repeater is not None:
-                self._selective_repeater.ReceiveAckPacket(seg_info)
+                self._selective_repeater.ReceiveAckPacket(segment)
             else:
-                print("Selective repeat protocol not initiated, but still receiving ACK")
+                logger.warning("Selective repeat protocol not initiated, but still receiving ACK")
         if syn and ack and not fin:
-            self.acknowledge_server(seg_info)
+            # without the header checksum the checksum does not cover the flags: a SYN-ACK is only taken while
+            # connecting and its options must be intact (a server of the first wire format sends none)
+            if not self._connecting or segment.data_length and \
+                    segment.checksum != calculate_checksum(segment.data, segment.header_checksum):
+                self._unexpected_segments += 1
+            else:
+                self.acknowledge_server(segment)
         if not syn and ack and fin:
-            # Terminate connection between client and server
-            self._connected_to_server = False
-            print("disconnected to server")
+            # a FIN-ACK carries no data and acknowledges the FIN, a server of the first wire format acknowledges
+            # it with 0
+            if segment.data_length == 0 and (segment.ack_number == (self._x_value + 1) % SEQUENCE_NUMBER_SPACE or
+                                             segment.ack_number == 0 and not self._features):
+                # Terminate connection between client and server
+                self.set_connected(False)
+                print("disconnected to server")
+            else:
+                self._unexpected_segments += 1
+
+    # Change _connected_to_server and wake up the thread that waits for it in connect or disconnect
+    def set_connected(self, connected):
+        with self._state_condition:
+            self._connected_to_server = connected
+            self._state_condition.notify_all()
+
+    # Block until _connected_to_server equals connected. Returns False if that did not happen within timeout ms.
+    def wait_for_state(self, connected, timeout):
+        with self._state_condition:
+            return self._state_condition.wait_for(lambda: self._connected_to_server == connected, timeout / 1000)
 
     # Perform a three-way handshake to establish a connection
     def connect(self):
-        # Variable that keeps track of the moment when the first step of the three-way handshake was initiated.
-        # Used to determine whether a connection timeout has occurred.
-        connect_start = time.time()
-
         # Variable that keeps track of the number of attempts to connect to the server.
         # Used to determine whether the max number of connection attempts was exceeded.
         connect_attempts = 1
 
+        self._connecting = True
         self.synchonize_server()
         print("connecting...")
 
-        while not self._connected_to_server:
-            if ((time.time() - connect_start) * 1000) >= self._timeout:
-                # Connection Timeout
-                if connect_attempts >= MAX_NUMBER_OF_CONNECTION_TRIES:
-                    # Max number of connection tries was exceeded
-                    print("Connection attempts failed: Max number of connection tries ({}) exceeded.".format(MAX_NUMBER_OF_CONNECTION_TRIES))
-                    break
-                else:
-                    #Try to connect again
-                    print("Connection attempt failed: Connection timeout, retrying...")
-                    connect_attempts += 1
-                    connect_start = time.time()
-                    self.synchonize_server()
+        # every attempt waits for the SYN-ACK until the timeout has passed
+        while not self.wait_for_state(True, self._timeout):
+            # Connection Timeout
+            if connect_attempts >= MAX_NUMBER_OF_CONNECTION_TRIES:
+                # Max number of connection tries was exceeded
+                print("Connection attempts failed: Max number of connection tries ({}) exceeded.".format(MAX_NUMBER_OF_CONNECTION_TRIES))
+                break
+            else:
+                #Try to connect again
+                print("Connection attempt failed: Connection timeout, retrying...")
+                connect_attempts += 1
+                self.synchonize_server()
+        self._connecting = False
 
 
-    # Step 3 of the three-way handshake to establish connection
+    # Step 1 of the three-way handshake to establish connection, the SYN carries the largest payload size the path
+    # to the server allows and the optional features the client asks for
     def synchonize_server(self):
         # Step 1 of three way handshake
-        self._x_value = random.randint(0, MAX_VALUE_16_BIT_INTEGER + 1)
+        self._x_value = random.randrange(SEQUENCE_NUMBER_SPACE)
         ack_syn_fin = flags_to_binary(False, True, False)
-        segment = Segment(self._x_value, 0, ack_syn_fin, 0, 0, 0, None)
+        option = pack_mss_option(self._lossy_layer.path_payload_size(), self._requested_features)
+        segment = Segment(self._x_value, 0, ack_syn_fin, 0, len(option), calculate_checksum(option), option)
         data = segment.create_segment()
         self._lossy_layer.send_segment(data)
 
     # Step 3 of the three-way handshake to establish connection
-    def acknowledge_server(self, seg_info):
+    def acknowledge_server(self, syn_ack):
         # Step 3 of three way handshake
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
-        if ack_number != self._x_value+1:
-            print("acknowledgement number incorrect:", ack_number, self._x_value+1)
+        seq_number = syn_ack.seq_number
+        ack_number = syn_ack.ack_number
+        window = syn_ack.window
+        if ack_number != (self._x_value + 1) % SEQUENCE_NUMBER_SPACE:
+            logger.warning("acknowledgement number incorrect: %d, expected %d", ack_number,
+                           (self._x_value + 1) % SEQUENCE_NUMBER_SPACE)
         else:
             self._y_value = seq_number
             self._window_size_server = window
+            self._selective_repeater.SetPeerWindow(window)
+            self._max_segment_size = min(self._lossy_layer.path_payload_size(), unpack_mss_option(syn_ack))
+            self._selective_repeater.SetMaximumSegmentSize(self._max_segment_size)
+            self._features = self._requested_features & unpack_features(syn_ack)
+            if self._features & FEATURE_FEC:
+                self._selective_repeater.EnableForwardErrorCorrection()
+            if self._features & FEATURE_COMPRESSION:
+                self._selective_repeater.EnableCompression()
+            if self._features & FEATURE_HEADER_CHECKSUM:
+                self._selective_repeater.EnableHeaderChecksum()
             ack_syn_fin = flags_to_binary(True, False, False)
-            segment = Segment(self._x_value+1, self._y_value+1, ack_syn_fin, 0, 0, 0, None)
+            segment = Segment((self._x_value + 1) % SEQUENCE_NUMBER_SPACE, (self._y_value + 1) % SEQUENCE_NUMBER_SPACE,
+                              ack_syn_fin, 0, 0, 0, None)
             data = segment.create_segment()
             self._lossy_layer.send_segment(data)
             print("connected to server.")
-            self._connected_to_server = True
+            self._connecting = False
+            self.set_connected(True)
+
+
+    # Send data originating from the application in a reliable way to the server: the file with path data, or
+    # length bytes of it from offset on, preceded by header
+    def send(self, data, offset=0, length=None, header=b''):
+        self._selective_repeater.StartSending(data, offset, length, header)
 
+    # Send files to the server as framed messages: messages is an iterable of paths, each of them named after its
+    # file name, or of (name, path) pairs. The server reads them with messages(). The connection stays open, so later
+    # calls send more messages without a new handshake and without starting the congestion window over, and within
+    # a call the next file is sent while the earlier ones are still being acknowledged. A connection carries either
+    # messages or one file sent with send.
+    def send_messages(self, messages):
+        self._selective_repeater.SendMessages(name_messages(messages))
 
-    # Send data originating from the application in a reliable way to the server
-    def send(self, data):
-        self._selective_repeater.StartSending(data)
+    # Return the congestion window, slow start threshold and loss events of the congestion controller
+    def congestion_stats(self):
+        return self._selective_repeater.GetCongestionStats()
+
+    # Return the statistics counters of the socket, its sender and its congestion controller
+    def stats(self):
+        stats = {
+            'connected': self._connected_to_server,
+            'max_segment_size': self._max_segment_size,
+            'fec': bool(self._features & FEATURE_FEC),
+            'compression': bool(self._features & FEATURE_COMPRESSION),
+            'header_checksum': bool(self._features & FEATURE_HEADER_CHECKSUM),
+            'segments_received': self._segments_received,
+            'bytes_received': self._bytes_received,
+            'checksum_failures': self._checksum_failures,
+            'unexpected_segments': self._unexpected_segments,
+            'sender': self._selective_repeater.Stats(),
+            'congestion': self._selective_repeater.GetCongestionStats(),
+        }
+        if hasattr(self._lossy_layer, 'batch_stats'):
+            stats['lossy_layer'] = self._lossy_layer.batch_stats()
+        return stats
 
     # Perform a handshake to terminate a connection
     def disconnect(self):
-        # Variable that keeps track of the moment when the first step of the termination handshake was initiated.
-        # Used to determine whether a termination timeout has occurred.
-        terminate_start = time.time()
-
         # Variable that keeps track of the number of attempts to terminate the connection to the server.
         # Used to determine whether the max number of termination attempts was exceeded.
         terminate_attempts = 1
@@ -116,26 +238,30 @@ class BTCPClientSocket(BTCPSocket):
         self.finish_server()
         print("disconnecting...")
 
-        while self._connected_to_server:
-            if ((time.time() - terminate_start) * 1000) >= self._timeout:
-                # Connection Timeout
-                if terminate_attempts >= MAX_NUMBER_OF_TERMINATION_TRIES:
-                    # Max number of connection tries was exceeded
-                    print("Termination attempts failed: Max number of termination tries ({}) exceeded.".format(
-                        MAX_NUMBER_OF_TERMINATION_TRIES))
-                    self._connected_to_server = False
-                    break
-                else:
-                    # Try to connect again
-                    print("Termination attempt failed: Termination timeout, retrying...")
-                    terminate_attempts += 1
-                    terminate_start = time.time()
-                    self.finish_server()
-
-    # First step of termination handshake
+        # every attempt waits for the FIN-ACK until the timeout has passed
+        while not self.wait_for_state(False, self._timeout):
+            # Connection Timeout
+            if terminate_attempts >= MAX_NUMBER_OF_TERMINATION_TRIES:
+                # Max number of connection tries was exceeded
+                print("Termination attempts failed: Max number of termination tries ({}) exceeded.".format(
+                    MAX_NUMBER_OF_TERMINATION_TRIES))
+                self.set_connected(False)
+                break
+            else:
+                # Try to connect again
+                print("Termination attempt failed: Termination timeout, retrying...")
+                terminate_attempts += 1
+                self.finish_server()
+
+    # First step of termination handshake. The FIN carries the sequence number of the SYN of the connection, so that
+    # a late FIN of an earlier connection does not end the next one, and covers its header once the server agreed to
+    # the header checksum, so that the FIN-ACK does as well.
     def finish_server(self):
         ack_syn_fin = flags_to_binary(False, False, True)
-        segment = Segment(0, 0, ack_syn_fin, 0, 0, 0, None)
+        if self._features & FEATURE_HEADER_CHECKSUM:
+            ack_syn_fin |= HEADER_CHECKSUM_FLAG
+        segment = Segment(self._x_value, 0, ack_syn_fin, 0, 0,
+                          calculate_checksum(b'', header_checksum(self._x_value, 0, ack_syn_fin, 0, 0)), None)
         data = segment.create_segment()
         self._lossy_layer.send_segment(data)
 
@@ -144,7 +270,11 @@ class BTCPClientSocket(BTCPSocket):
         self._x_value = 0
         self._y_value = 0
         self._window_size_server = 0
-        self._selective_repeater = SelectiveRepeaterSender(self._lossy_layer, self._window, self._timeout)
+        self._max_segment_size = PAYLOAD_SIZE
+        self._features = 0
+        self._selective_repeater = SelectiveRepeaterSender(self._lossy_layer, self._window, self._timeout,
+                                                            self._congestion_control, self._pacing, self._fec,
+                                                            self._compression)
 
     # Clean up any state
     def close(self):
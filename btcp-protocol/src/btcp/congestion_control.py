@@ -0,0 +1,191 @@
+import math
+import time
+from btcp.constants import *
+
+
+# Base class of the congestion controllers of the bTCP sender. A controller keeps a congestion window (cwnd) in
+# packets; the sender never has more than min(cwnd, peer window) packets in flight. The sender calls OnAck for every
+# ACK that acknowledges new packets, OnLoss when the ACKs show a loss (UndoLoss when that loss turns out to be
+# spurious) and OnTimeout when the oldest outstanding packet times out.
+class CongestionController:
+    name = "base"
+
+    # attributes that make up the window, they are restored when a loss is undone
+    window_state = ("cwnd", "ssthresh")
+
+    def __init__(self, initial_window=INITIAL_CONGESTION_WINDOW):
+        self.cwnd = float(initial_window)
+        self.ssthresh = math.inf
+        self.loss_events = 0
+        self.timeouts = 0
+        self.undone_losses = 0
+
+        # window before the last loss that was detected from the ACKs, None when it can not be undone
+        self._undo_state = None
+
+    # Return the congestion window as a whole number of packets
+    def GetWindow(self):
+        return max(1, int(self.cwnd))
+
+    def InSlowStart(self):
+        return self.cwnd < self.ssthresh
+
+    # Method that is called when acked_packets new packets were acknowledged
+    def OnAck(self, acked_packets):
+        pass
+
+    # Method that is called when a packet loss was detected without a timeout (e.g. from the ACKs)
+    def OnLoss(self):
+        self.loss_events += 1
+        self._undo_state = {name: getattr(self, name) for name in self.window_state}
+
+    # Method that is called when all packets that were retransmitted for the last loss turned out to have arrived,
+    # so there was no loss: the window before it is restored
+    def UndoLoss(self):
+        if self._undo_state is None:
+            return
+        for (name, value) in self._undo_state.items():
+            setattr(self, name, value)
+        self._undo_state = None
+        self.undone_losses += 1
+
+    # Method that is called when the oldest outstanding packet timed out
+    def OnTimeout(self):
+        self.loss_events += 1
+        self.timeouts += 1
+        self._undo_state = None
+
+    # Return the state of the controller, for tuning
+    def Stats(self):
+        return {
+            "controller": self.name,
+            "cwnd": self.cwnd,
+            "ssthresh": self.ssthresh,
+            "loss_events": self.loss_events,
+            "timeouts": self.timeouts,
+            "undone_losses": self.undone_losses,
+        }
+
+
+# Controller that does not limit the sender, only the window size is used (the behaviour without congestion control)
+class FixedWindowController(CongestionController):
+    name = "fixed"
+
+    def __init__(self, initial_window=INITIAL_CONGESTION_WINDOW):
+        super().__init__(initial_window)
+        self.cwnd = math.inf
+
+    def GetWindow(self):
+        return math.inf
+
+
+# Slow start and additive increase, multiplicative decrease (TCP Reno, RFC 5681)
+class RenoController(CongestionController):
+    name = "reno"
+
+    def OnAck(self, acked_packets):
+        if self.InSlowStart():
+            # grow by one packet per acknowledged packet, but not past ssthresh in one step
+            growth = min(acked_packets, max(0.0, self.ssthresh - self.cwnd))
+            self.cwnd += growth
+            acked_packets -= growth
+        if acked_packets > 0:
+            # congestion avoidance: grow by one packet per window
+            self.cwnd += acked_packets / self.cwnd
+
+    def OnLoss(self):
+        super().OnLoss()
+        self.ssthresh = max(self.cwnd / 2, MIN_SLOW_START_THRESHOLD)
+        self.cwnd = self.ssthresh
+
+    def OnTimeout(self):
+        super().OnTimeout()
+        self.ssthresh = max(self.cwnd / 2, MIN_SLOW_START_THRESHOLD)
+        self.cwnd = 1.0
+
+
+# CUBIC (RFC 8312): after a loss the window grows along a cubic function of the time since the loss, that is flat
+# around the window where the loss happened. In the region where Reno would be faster, the Reno window is used.
+class CubicController(CongestionController):
+    name = "cubic"
+    window_state = CongestionController.window_state + ("w_max", "_epoch_start", "_k", "_w_reno")
+
+    def __init__(self, initial_window=INITIAL_CONGESTION_WINDOW):
+        super().__init__(initial_window)
+        # window at the last loss event, the start of the current epoch and the time the curve takes to reach
+        # w_max again
+        self.w_max = 0.0
+        self._epoch_start = None
+        self._k = 0.0
+        # estimate of the window Reno would have in the same epoch
+        self._w_reno = 0.0
+
+    def OnAck(self, acked_packets):
+        if self.InSlowStart():
+            growth = min(acked_packets, max(0.0, self.ssthresh - self.cwnd))
+            self.cwnd += growth
+            acked_packets -= growth
+            if acked_packets <= 0:
+                return
+
+        now = time.monotonic()
+        if self._epoch_start is None:
+            # first ACK of the epoch (after slow start or after a loss)
+            self._epoch_start = now
+            if self.cwnd < self.w_max:
+                self._k = ((self.w_max - self.cwnd) / CUBIC_C) ** (1 / 3)
+            else:
+                self._k = 0.0
+                self.w_max = self.cwnd
+            self._w_reno = self.cwnd
+
+        t = now - self._epoch_start
+        target = CUBIC_C * (t - self._k) ** 3 + self.w_max
+        self._w_reno += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked_packets / self.cwnd
+
+        if self._w_reno > target:
+            target = self._w_reno
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked_packets
+        else:
+            self.cwnd += 0.01 * acked_packets / self.cwnd
+
+    def StartEpoch(self):
+        # fast convergence: release bandwidth when the window stopped growing since the last loss
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self._epoch_start = None
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, MIN_SLOW_START_THRESHOLD)
+
+    def OnLoss(self):
+        super().OnLoss()
+        self.StartEpoch()
+        self.cwnd = self.ssthresh
+
+    def OnTimeout(self):
+        super().OnTimeout()
+        self.StartEpoch()
+        self.cwnd = 1.0
+
+    def Stats(self):
+        stats = super().Stats()
+        stats["w_max"] = self.w_max
+        return stats
+
+
+# The congestion controllers that can be selected by name
+CONGESTION_CONTROLLERS = {
+    FixedWindowController.name: FixedWindowController,
+    RenoController.name: RenoController,
+    CubicController.name: CubicController,
+}
+
+
+# Method that creates the congestion controller with the given name
+def CreateCongestionController(name):
+    if name not in CONGESTION_CONTROLLERS:
+        raise ValueError("Unknown congestion controller '{}', choose from: {}".format(
+            name, ", ".join(CONGESTION_CONTROLLERS)))
+    return CONGESTION_CONTROLLERS[name]()
@@ -5,8 +5,66 @@ SERVER_PORT = 30000
 HEADER_SIZE = 10
 PAYLOAD_SIZE = 1008
 SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+MAX_VALUE_8_BIT_INTEGER = 255
 MAX_VALUE_16_BIT_INTEGER = 65535
+SEQUENCE_NUMBER_SPACE = MAX_VALUE_16_BIT_INTEGER + 1
 HEADER_FORMAT = '!HHBBHH'
 MAX_NUMBER_OF_CONNECTION_TRIES = 3
 MAX_NUMBER_OF_TERMINATION_TRIES = 3
-MAX_PACKET_SIZE = 2000
\ No newline at end of file
+MAX_SACK_BLOCKS = 32
+SACK_BLOCK_FORMAT = '!HH'
+SACK_BLOCK_SIZE = 4
+DELAYED_ACK_SEGMENTS = 2
+DELAYED_ACK_TIMEOUT = 10
+MIN_RETRANSMISSION_TIMEOUT = 20
+MAX_RETRANSMISSION_TIMEOUT = 60000
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4
+RTT_CLOCK_GRANULARITY = 1
+INITIAL_CONGESTION_WINDOW = 10
+MIN_SLOW_START_THRESHOLD = 2
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+DEFAULT_CONGESTION_CONTROL = 'reno'
+RECEIVE_BUFFER_SIZE = 64 * 1024 * 1024
+MAX_SERVER_CONNECTIONS = 1024
+MAX_DATAGRAM_BATCH = 64
+UDP_SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+RECEIVE_QUEUE_SIZE = 256
+UDP_IP_HEADER_SIZE = 28
+MAX_PAYLOAD_SIZE = MAX_VALUE_16_BIT_INTEGER - UDP_IP_HEADER_SIZE - HEADER_SIZE
+MAX_SEGMENT_SIZE = HEADER_SIZE + MAX_PAYLOAD_SIZE
+DEFAULT_PATH_MTU = 1500
+MSS_OPTION_FORMAT = '!H'
+MSS_OPTION_SIZE = 2
+REORDER_WINDOW_DIVISOR = 4
+MAX_REORDER_WINDOW_MULTIPLIER = 1024
+PACING_BURST_TIME = 1
+PACING_MIN_BURST_SEGMENTS = 2
+PACING_SLOW_START_GAIN = 2.0
+PACING_CONGESTION_AVOIDANCE_GAIN = 1.2
+FEATURES_SIZE = 1
+FEATURE_FEC = 1
+FEATURE_COMPRESSION = 2
+FEATURE_HEADER_CHECKSUM = 4
+SUPPORTED_FEATURES = FEATURE_FEC | FEATURE_COMPRESSION | FEATURE_HEADER_CHECKSUM
+FEC_ADAPTIVE = 'adaptive'
+FEC_MIN_BLOCK_SIZE = 2
+FEC_MAX_BLOCK_SIZE = 32
+FEC_LOSSES_PER_BLOCK = 0.5
+LOSS_RATE_ALPHA = 0.01
+COMPRESSION_LEVEL = 1
+COMPRESSION_FILL = 0.9
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSION_MAX_INPUT_SEGMENTS = 64
+COMPRESSION_MAX_BACKOFF = 64
+STRIPE_HEADER_FORMAT = '!QQH'
+STRIPE_HEADER_SIZE = 18
+DEFAULT_STRIPES = 4
+STRIPE_RANGES_PER_STRIPE = 4
+STRIPE_MIN_RANGE_SIZE = 256 * 1024
+STRIPE_ACCEPT_INTERVAL = 10
+MESSAGE_HEADER_FORMAT = '!HQ'
+MESSAGE_HEADER_SIZE = 10
+MAX_MESSAGE_NAME_SIZE = 255
@@ -0,0 +1,64 @@
+import collections
+import os
+import struct
+from btcp.constants import *
+
+# Precompiled format of the frame header of a message: the length of its name and the size of its data. The header is
+# followed by the name (UTF-8) and the data.
+MESSAGE_HEADER_STRUCT = struct.Struct(MESSAGE_HEADER_FORMAT)
+
+# A message that was received completely: its name and its data
+Message = collections.namedtuple('Message', ['name', 'data'])
+
+
+# Return the frame header of a message with the given name and data size, including the name
+def pack_message_header(name, size):
+    encoded_name = name.encode('utf-8')
+    if len(encoded_name) > MAX_MESSAGE_NAME_SIZE:
+        raise ValueError("Message name is longer than {} bytes: {}".format(MAX_MESSAGE_NAME_SIZE, name))
+    return MESSAGE_HEADER_STRUCT.pack(len(encoded_name), size) + encoded_name
+
+
+# Return the (name, path) pairs of messages, an iterable of paths, each of them named after its file name, or of
+# (name, path) pairs
+def name_messages(messages):
+    for message in messages:
+        if isinstance(message, (str, os.PathLike)):
+            yield (os.path.basename(message), message)
+        else:
+            yield message
+
+
+# Parser of a stream of framed messages. The data of the stream is fed in pieces as it is delivered, in any sizes,
+# and every message is returned as soon as all of its data arrived.
+class MessageParser:
+    def __init__(self):
+        self._buffer = bytearray()
+        # (name, size) of the message whose data is in the buffer, None while its header is not complete
+        self._header = None
+
+    # Add data of the stream and return the messages that are complete now
+    def feed(self, data):
+        self._buffer += data
+        messages = []
+        while True:
+            if self._header is None:
+                if len(self._buffer) < MESSAGE_HEADER_SIZE:
+                    break
+                (name_length, size) = MESSAGE_HEADER_STRUCT.unpack_from(self._buffer)
+                if len(self._buffer) < MESSAGE_HEADER_SIZE + name_length:
+                    break
+                name = bytes(self._buffer[MESSAGE_HEADER_SIZE:MESSAGE_HEADER_SIZE + name_length]).decode('utf-8')
+                del self._buffer[:MESSAGE_HEADER_SIZE + name_length]
+                self._header = (name, size)
+            (name, size) = self._header
+            if len(self._buffer) < size:
+                break
+            messages.append(Message(name, bytes(self._buffer[:size])))
+            del self._buffer[:size]
+            self._header = None
+        return messages
+
+    # Return whether a message was started but did not arrive completely
+    def incomplete(self):
+        return self._header is not None or len(self._buffer) > 0
@@ -1,23 +1,69 @@
+import collections
+import contextlib
+import queue
 import socket
 import select
+import sys
 import threading
 from btcp.constants import *
 
-# Continuously read from the socket and whenever a segment arrives, 
-# call the lossy_layer_input method of the associated socket. 
-# When flagged, return from the function.
-def handle_incoming_segments(bTCP_sock, event, udp_sock):
+# Socket option that reads the MTU of the route of a connected socket, only Linux has it
+IP_MTU = getattr(socket, 'IP_MTU', 14) if sys.platform.startswith('linux') else None
+
+
+# Return the MTU of the route to address as the kernel knows it, or DEFAULT_PATH_MTU when it can not be asked
+def path_mtu(address):
+    if IP_MTU is None:
+        return DEFAULT_PATH_MTU
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            # connecting a UDP socket sends nothing, it only looks up the route
+            probe.connect(address)
+            return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_PATH_MTU
+
+
+# Return the largest payload of a segment that fits in a single IP packet on the route to address
+def path_payload_size(address):
+    return max(1, min(MAX_PAYLOAD_SIZE, path_mtu(address) - UDP_IP_HEADER_SIZE - HEADER_SIZE))
+
+
+# Continuously wait for the socket to become readable and whenever it does, let the lossy layer read all segments
+# that have arrived. When flagged, return from the function.
+def handle_incoming_segments(lossy_layer, event, udp_sock):
     while not event.is_set():
         # We do not block here, because we might never check the loop condition in that case
         rlist, wlist, elist = select.select([udp_sock], [], [], 1)
         if rlist:
-            segment = udp_sock.recvfrom(SEGMENT_SIZE)
-            bTCP_sock.lossy_layer_input(segment)
+            lossy_layer.receive_batch()
+
+
+# Run by the protocol worker: wait for the segments that the I/O thread queued and let the lossy layer handle them,
+# up to MAX_DATAGRAM_BATCH at a time. Returns when the lossy layer is destroyed.
+def process_incoming_segments(lossy_layer, receive_queue):
+    while True:
+        items = [receive_queue.get()]
+        while len(items) < MAX_DATAGRAM_BATCH:
+            try:
+                items.append(receive_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not lossy_layer.process_batch(items):
+            return
 
 
 # The lossy layer emulates the network layer in that it provides bTCP with 
 # an unreliable segment delivery service between a and b. When the lossy layer is created, 
 # a thread is started that calls handle_incoming_segments. 
+# Python has no sendmmsg/recvmmsg, so batching is done with one non-blocking call per datagram: every wakeup drains
+# all datagrams that are ready into preallocated buffers before they are handled, and segments sent inside a batch
+# are queued and flushed together when the batch ends.
+# Two threads receive segments. The I/O thread only moves datagrams from the socket into a queue, the protocol
+# worker takes them out and runs the protocol (lossy_layer_input of the socket) for them, so a slow segment never
+# keeps the socket from being read. The queue is bounded by the number of receive buffers, a datagram that arrives
+# while all buffers are in use is dropped like a segment that is lost in the network. Segments are as large as the
+# payload size that was negotiated in the handshake, so every receive buffer can hold the largest possible datagram.
 class LossyLayer:
     def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
         self._bTCP_sock = bTCP_sock
@@ -25,17 +71,160 @@ class LossyLayer:
         self._b_port = b_port
         self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # a larger kernel buffer absorbs a full window of segments while the thread is busy handling the previous ones
+        self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER_SIZE)
+        self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SOCKET_BUFFER_SIZE)
         self._udp_sock.bind((a_ip, a_port))
+        self._udp_sock.setblocking(False)
+        # receive buffers that are not in the queue, they are allocated on demand up to RECEIVE_QUEUE_SIZE
+        self._free_buffers = collections.deque()
+        self._allocated_buffers = 0
+        self._discard_buffer = bytearray(MAX_SEGMENT_SIZE)
+        self._receive_queue = queue.SimpleQueue()
+        # every thread has its own queue of outbound segments, so one thread's batch never delays another's segments
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._receive_batches = 0
+        self._received_segments = 0
+        self._send_batches = 0
+        self._sent_segments = 0
+        self._dropped_segments = 0
         self._event = threading.Event()
-        self._thread = threading.Thread(target=handle_incoming_segments, args=(self._bTCP_sock, self._event, self._udp_sock))
+        self._thread = threading.Thread(target=handle_incoming_segments, args=(self, self._event, self._udp_sock))
+        self._worker = threading.Thread(target=process_incoming_segments, args=(self, self._receive_queue))
+        self._worker.start()
         self._thread.start()
 
-    # Flag the thread that it can stop and close the socket.
+    # Flag the threads that they can stop and close the socket.
     def destroy(self):
         self._event.set()
         self._thread.join()
+        self._receive_queue.put(None)
+        if threading.current_thread() is not self._worker:
+            self._worker.join()
         self._udp_sock.close()
 
-    # Put the segment into the network
-    def send_segment(self, segment):
-        self._udp_sock.sendto(segment, (self._b_ip, self._b_port))
+    # Return the largest payload of a segment that can be sent to address (b by default) without fragmentation
+    def path_payload_size(self, address=None):
+        return path_payload_size((self._b_ip, self._b_port) if address is None else address)
+
+    # Return a free receive buffer, or None if all RECEIVE_QUEUE_SIZE buffers are in use
+    def take_receive_buffer(self):
+        try:
+            return self._free_buffers.pop()
+        except IndexError:
+            if self._allocated_buffers >= RECEIVE_QUEUE_SIZE:
+                return None
+            self._allocated_buffers += 1
+            return memoryview(bytearray(MAX_SEGMENT_SIZE))
+
+    # Run by the I/O thread: read every datagram that is ready (up to MAX_DATAGRAM_BATCH) into a receive buffer and
+    # put it in the queue of the protocol worker
+    def receive_batch(self):
+        received = 0
+        dropped = 0
+        while received < MAX_DATAGRAM_BATCH:
+            buffer = self.take_receive_buffer()
+            try:
+                (nbytes, address) = self._udp_sock.recvfrom_into(self._discard_buffer if buffer is None else buffer)
+            except (BlockingIOError, InterruptedError):
+                if buffer is not None:
+                    self._free_buffers.append(buffer)
+                break
+            received += 1
+            if buffer is None:
+                dropped += 1
+            else:
+                self._receive_queue.put((buffer, nbytes, address))
+        if received:
+            with self._stats_lock:
+                self._receive_batches += 1
+                self._received_segments += received
+                self._dropped_segments += dropped
+
+    # Run by the protocol worker: pass the queued segments one by one to the lossy_layer_input method of the
+    # associated socket. A segment is a memoryview into a receive buffer that is reused afterwards, so it is only
+    # valid during the call. Segments sent while the batch is handled are flushed together afterwards. Returns False
+    # when the lossy layer is destroyed.
+    def process_batch(self, items):
+        with self.batch():
+            for item in items:
+                if item is None:
+                    return False
+                (buffer, nbytes, address) = item
+                try:
+                    self._bTCP_sock.lossy_layer_input((buffer[:nbytes], address))
+                finally:
+                    self._free_buffers.append(buffer)
+        return True
+
+    # Context manager during which the segments sent by the calling thread are queued and sent in one burst at the
+    # end (or whenever the queue is full). Nested batches are flushed by the outermost one.
+    @contextlib.contextmanager
+    def batch(self):
+        local = self._local
+        if getattr(local, 'queue', None) is not None:
+            yield
+            return
+        if not hasattr(local, 'buffers'):
+            local.buffers = [bytearray(SEGMENT_SIZE) for _ in range(MAX_DATAGRAM_BATCH)]
+            local.views = [memoryview(buffer) for buffer in local.buffers]
+        local.queue = []
+        try:
+            yield
+        finally:
+            self.flush(local)
+            local.queue = None
+
+    # Send all segments that are queued in the batch of this thread
+    def flush(self, local):
+        if local.queue:
+            self.sendto(local.queue)
+            local.queue.clear()
+
+    # Put the segment (bytes, bytearray or memoryview) into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address=None):
+        if address is None:
+            address = (self._b_ip, self._b_port)
+        pending = getattr(self._local, 'queue', None)
+        if pending is None:
+            self.sendto([(segment, address)])
+            return
+        # the caller may reuse its buffer right away, so the segment is copied into a buffer of the batch, which
+        # grows when the segment does not fit
+        local = self._local
+        index = len(pending)
+        size = len(segment)
+        if len(local.buffers[index]) < size:
+            local.buffers[index] = bytearray(size)
+            local.views[index] = memoryview(local.buffers[index])
+        local.buffers[index][:size] = segment
+        pending.append((local.views[index][:size], address))
+        if len(pending) == MAX_DATAGRAM_BATCH:
+            self.flush(local)
+
+    # Send a burst of (segment, address) pairs. A datagram the kernel has no room for is dropped, just like one
+    # that is lost in the network.
+    def sendto(self, segments):
+        for (segment, address) in segments:
+            try:
+                self._udp_sock.sendto(segment, address)
+            except (BlockingIOError, InterruptedError):
+                pass
+        with self._stats_lock:
+            self._send_batches += 1
+            self._sent_segments += len(segments)
+
+    # Return the number of batches and segments that were received and sent, and the average size of a batch
+    def batch_stats(self):
+        with self._stats_lock:
+            return {
+                'receive_batches': self._receive_batches,
+                'received_segments': self._received_segments,
+                'average_receive_batch': self._received_segments / self._receive_batches if self._receive_batches else 0.0,
+                'dropped_segments': self._dropped_segments,
+                'queued_segments': self._receive_queue.qsize(),
+                'send_batches': self._send_batches,
+                'sent_segments': self._sent_segments,
+                'average_send_batch': self._sent_segments / self._send_batches if self._send_batches else 0.0,
+            }
@@ -0,0 +1,136 @@
+import bisect
+import http.server
+import math
+import threading
+
+# Upper bounds (ms) of the buckets of round trip time histograms
+RTT_HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+# Histogram with fixed buckets. Observing a value is a binary search and an increment, so it can be done for every
+# sample. The caller protects it with its own lock.
+class Histogram:
+    def __init__(self, bounds=RTT_HISTOGRAM_BOUNDS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def Observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    # Return the cumulative count of every bucket by upper bound, with the sum and the number of the values
+    def Snapshot(self):
+        buckets = {}
+        total = 0
+        for (bound, count) in zip(self._bounds + ('+Inf',), self._counts):
+            total += count
+            buckets[bound] = total
+        return {'buckets': buckets, 'sum': self._sum, 'count': self._count}
+
+
+# Flatten a stats dictionary into (metric, type, name, labels, value) samples. Numbers are samples, nested
+# dictionaries extend the name, strings are labels of the samples at their level and lists hold dictionaries that
+# share names but differ in labels (e.g. the connections of a server). Histogram snapshots become the _bucket, _sum and
+# _count samples of a histogram metric. The stats mix counters and gauges without saying which, so other numbers are
+# untyped.
+def flatten_stats(name, stats, labels=()):
+    labels = labels + tuple((key, value) for (key, value) in stats.items() if isinstance(value, str))
+    if 'buckets' in stats:
+        for (bound, count) in stats['buckets'].items():
+            yield name, 'histogram', name + '_bucket', labels + (('le', str(bound)),), count
+        yield name, 'histogram', name + '_sum', labels, stats['sum']
+        yield name, 'histogram', name + '_count', labels, stats['count']
+        return
+    for (key, value) in stats.items():
+        if isinstance(value, dict):
+            yield from flatten_stats(name + '_' + key, value, labels)
+        elif isinstance(value, list):
+            for element in value:
+                yield from flatten_stats(name + '_' + key, element, labels)
+        elif isinstance(value, (bool, int, float)):
+            yield name + '_' + key, 'untyped', name + '_' + key, labels, float(value)
+
+
+# Format a sample value the way Prometheus expects it, the slow start threshold for example may be infinite
+def format_sample_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+# Format the value of a label, with the backslashes, quotes and newlines escaped
+def format_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Render the stats of the registered sources in the Prometheus text format. The samples of a metric are grouped after
+# its TYPE line, and those of a histogram by sample name, as the format requires.
+def render_prometheus(sources):
+    metrics = {}
+    for (name, stats_function) in sources:
+        for (metric, metric_type, sample_name, labels, value) in flatten_stats(name, stats_function()):
+            (_, samples) = metrics.setdefault(metric, (metric_type, {}))
+            samples.setdefault(sample_name, []).append((labels, value))
+    lines = []
+    for (metric, (metric_type, samples)) in metrics.items():
+        lines.append('# TYPE {} {}'.format(metric, metric_type))
+        for (sample_name, values) in samples.items():
+            for (labels, value) in values:
+                label_text = ','.join('{}="{}"'.format(key, format_label_value(label)) for (key, label) in labels)
+                lines.append('{}{} {}'.format(sample_name, '{' + label_text + '}' if label_text else '',
+                                              format_sample_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# Local HTTP endpoint that serves the stats of bTCP sockets in the Prometheus text format on /metrics. Sockets are
+# registered with a name, their stats() are read on every scrape.
+class MetricsExporter:
+    def __init__(self, port=0, host='127.0.0.1'):
+        self._sources = []
+        self._lock = threading.Lock()
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # scrapes are not logged to stderr
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    # Port the endpoint listens on, useful when it was created with port 0
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    # Serve the stats of source (anything with a stats method) under btcp_<name>_...
+    def register(self, name, source):
+        with self._lock:
+            self._sources.append(('btcp_' + name, source.stats))
+
+    def render(self):
+        with self._lock:
+            sources = list(self._sources)
+        return render_prometheus(sources)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,328 @@
+import contextlib
+import functools
+import heapq
+import random
+import socket
+import threading
+import time
+from btcp.constants import *
+from btcp.units import parse_rate
+
+
+# Resolve the host of an address once, so that 'localhost' and '127.0.0.1' name the same endpoint, just like they
+# do for a real UDP socket
+@functools.lru_cache(maxsize=None)
+def normalize_address(address):
+    (host, port) = address
+    return socket.gethostbyname(host), port
+
+
+# Parse a netem percentage ("10%") into a probability
+def parse_percentage(value):
+    return float(value.rstrip('%')) / 100
+
+
+# Parse a netem time ("20ms", "1s", "500us") into seconds
+def parse_time(value):
+    for (unit, factor) in (('us', 1e-6), ('ms', 1e-3), ('s', 1.0)):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * factor
+    return float(value) * 1e-6
+
+
+# The impairments of an emulated link. The parameters follow tc netem: every probability may have a correlation with
+# the previous decision, reordered packets skip the delay, and the rate and limit model a bottleneck queue.
+class NetworkProfile:
+    def __init__(self, loss=0.0, loss_correlation=0.0, gilbert_elliott=None, corrupt=0.0, corrupt_correlation=0.0,
+                 duplicate=0.0, duplicate_correlation=0.0, reorder=0.0, reorder_correlation=0.0, delay=0.0,
+                 jitter=0.0, rate=None, limit=1000):
+        self.loss = loss
+        self.loss_correlation = loss_correlation
+        # (p, r, bad_loss, good_loss): the chance to move from the good to the bad state, the chance to move back
+        # and the loss probability in each state
+        self.gilbert_elliott = gilbert_elliott
+        self.corrupt = corrupt
+        self.corrupt_correlation = corrupt_correlation
+        self.duplicate = duplicate
+        self.duplicate_correlation = duplicate_correlation
+        self.reorder = reorder
+        self.reorder_correlation = reorder_correlation
+        # delay and jitter in seconds, rate in bytes per second (None is unlimited), limit in packets
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.limit = limit
+
+    # Create a profile from netem arguments, e.g. "corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%"
+    # or "loss gemodel 1% 10% 70% 0.1% rate 10mbit"
+    @classmethod
+    def parse(cls, rule):
+        profile = cls()
+        words = rule.split()
+        position = 0
+
+        # Return the next word if it is a value rather than a keyword
+        def optional(parser, default):
+            nonlocal position
+            if position < len(words) and words[position][0].isdigit():
+                position += 1
+                return parser(words[position - 1])
+            return default
+
+        while position < len(words):
+            keyword = words[position]
+            position += 1
+            if keyword == 'loss' and position < len(words) and words[position] == 'gemodel':
+                position += 1
+                p = optional(parse_percentage, 0.0)
+                r = optional(parse_percentage, 1 - p)
+                bad_loss = optional(parse_percentage, 1.0)
+                good_loss = optional(parse_percentage, 0.0)
+                profile.gilbert_elliott = (p, r, bad_loss, good_loss)
+            elif keyword == 'loss':
+                if position < len(words) and words[position] == 'random':
+                    position += 1
+                profile.loss = optional(parse_percentage, 0.0)
+                profile.loss_correlation = optional(parse_percentage, 0.0)
+            elif keyword in ('corrupt', 'duplicate', 'reorder'):
+                setattr(profile, keyword, optional(parse_percentage, 0.0))
+                setattr(profile, keyword + '_correlation', optional(parse_percentage, 0.0))
+            elif keyword == 'delay':
+                profile.delay = optional(parse_time, 0.0)
+                profile.jitter = optional(parse_time, 0.0)
+                # the correlation of the jitter is not emulated
+                optional(parse_percentage, 0.0)
+            elif keyword == 'rate':
+                profile.rate = optional(parse_rate, None)
+            elif keyword == 'limit':
+                profile.limit = optional(int, profile.limit)
+            else:
+                raise ValueError("unsupported netem option: {}".format(keyword))
+        return profile
+
+
+# Random decisions that are correlated with the previous one, the way netem makes them: every new random value is
+# mixed with the last one
+class CorrelatedRandom:
+    def __init__(self, rng, correlation):
+        self._rng = rng
+        self._correlation = correlation
+        self._last = rng.random()
+
+    def chance(self, probability):
+        if probability <= 0:
+            return False
+        value = self._rng.random()
+        if self._correlation:
+            value = value * (1 - self._correlation) + self._last * self._correlation
+        self._last = value
+        return value < probability
+
+
+# The state of one direction between two endpoints. Every link has its own random generator, seeded from the seed of
+# the network and the two addresses, so the fate of the n-th segment on a link does not depend on how the threads
+# of the two directions interleave.
+class EmulatedLink:
+    def __init__(self, seed, source, destination, profile):
+        self.rng = random.Random("{}:{}:{}".format(seed, source, destination))
+        self.profile = profile
+        self.loss = CorrelatedRandom(self.rng, profile.loss_correlation)
+        self.corrupt = CorrelatedRandom(self.rng, profile.corrupt_correlation)
+        self.duplicate = CorrelatedRandom(self.rng, profile.duplicate_correlation)
+        self.reorder = CorrelatedRandom(self.rng, profile.reorder_correlation)
+        self.bad_state = False
+        # moment the bottleneck is done transmitting the segments queued before, and the number of queued segments
+        self.free_at = 0.0
+        self.backlog = 0
+
+    # Decide whether the next segment is lost
+    def lose(self):
+        profile = self.profile
+        if profile.gilbert_elliott is not None:
+            (p, r, bad_loss, good_loss) = profile.gilbert_elliott
+            if self.bad_state:
+                self.bad_state = self.rng.random() >= r
+            else:
+                self.bad_state = self.rng.random() < p
+            if self.rng.random() < (bad_loss if self.bad_state else good_loss):
+                return True
+        return self.loss.chance(profile.loss)
+
+    # Return a copy of the segment with one random bit flipped
+    def flip_bit(self, segment):
+        flipped = bytearray(segment)
+        if flipped:
+            flipped[self.rng.randrange(len(flipped))] ^= 1 << self.rng.randrange(8)
+        return bytes(flipped)
+
+    # Return the number of seconds the segment spends in the network. A reordered segment skips the delay, so it
+    # overtakes the segments that were sent before it.
+    def latency(self):
+        profile = self.profile
+        if profile.reorder and self.reorder.chance(profile.reorder):
+            return 0.0
+        if profile.jitter:
+            return max(0.0, profile.delay + self.rng.uniform(-profile.jitter, profile.jitter))
+        return profile.delay
+
+
+# An in-process network between lossy layers. Instead of configuring tc netem on the loopback interface (which needs
+# root and random decisions that differ on every run), segments are impaired by seeded random generators and handed
+# to the socket at the other end by a delivery thread once their delay has passed. Segments for an address that no
+# lossy layer is bound to are dropped, and so are segments that do not fit in one packet of the given MTU.
+# Only the random decisions are reproducible: the n-th segment on a link is always lost, corrupted, duplicated,
+# reordered or delayed the same way. Delivery runs on wall-clock timers and the sockets retransmit on them as well,
+# so which segment is the n-th one, the bottleneck queue and the order of delivery can still differ between runs.
+class EmulatedNetwork:
+    def __init__(self, profile=None, seed=0, mtu=DEFAULT_PATH_MTU):
+        self._profile = profile if profile is not None else NetworkProfile()
+        self._seed = seed
+        self._mtu = mtu
+        self._endpoints = {}
+        self._links = {}
+        self._queue = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._stats = dict.fromkeys(('sent', 'delivered', 'lost', 'corrupted', 'duplicated', 'reordered',
+                                     'overflowed', 'unreachable', 'oversized'), 0)
+
+    # Use another profile for all segments sent from now on. The links start over from the seed, so a scenario that
+    # sets a profile behaves the same every time it is run.
+    def set_profile(self, profile):
+        if isinstance(profile, str):
+            profile = NetworkProfile.parse(profile)
+        with self._condition:
+            self._profile = profile
+            self._links = {}
+
+    # Return the largest payload of a segment that fits in one packet of the MTU of the network
+    def path_payload_size(self):
+        return max(1, min(MAX_PAYLOAD_SIZE, self._mtu - UDP_IP_HEADER_SIZE - HEADER_SIZE))
+
+    # Create a lossy layer for bTCP_sock that is bound to (a_ip, a_port) and sends to (b_ip, b_port) by default
+    def create_lossy_layer(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        return EmulatedLossyLayer(self, bTCP_sock, a_ip, a_port, b_ip, b_port)
+
+    def bind(self, address, lossy_layer):
+        with self._condition:
+            if address in self._endpoints:
+                raise OSError("address already in use: {}".format(address))
+            self._endpoints[address] = lossy_layer
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.deliver_segments, daemon=True)
+                self._thread.start()
+
+    def unbind(self, address):
+        with self._condition:
+            self._endpoints.pop(address, None)
+
+    # Stop the delivery thread, segments that are still in the network are dropped
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    # Return the number of segments that were sent, delivered and impaired in each way
+    def stats(self):
+        with self._condition:
+            return dict(self._stats)
+
+    # Put a segment from source into the network, addressed to destination
+    def transmit(self, segment, source, destination):
+        segment = bytes(segment)
+        now = time.monotonic()
+        with self._condition:
+            self._stats['sent'] += 1
+            if len(segment) + UDP_IP_HEADER_SIZE > self._mtu:
+                self._stats['oversized'] += 1
+                return
+            link = self._links.get((source, destination))
+            if link is None:
+                link = self._links[(source, destination)] = EmulatedLink(self._seed, source, destination,
+                                                                          self._profile)
+            profile = link.profile
+            if link.lose():
+                self._stats['lost'] += 1
+                return
+            copies = 2 if profile.duplicate and link.duplicate.chance(profile.duplicate) else 1
+            self._stats['duplicated'] += copies - 1
+            for _ in range(copies):
+                if link.backlog >= profile.limit:
+                    self._stats['overflowed'] += 1
+                    continue
+                data = segment
+                if profile.corrupt and link.corrupt.chance(profile.corrupt):
+                    data = link.flip_bit(segment)
+                    self._stats['corrupted'] += 1
+                # the bottleneck sends one segment at a time at the given rate
+                departure = now
+                if profile.rate:
+                    departure = max(now, link.free_at) + len(data) / profile.rate
+                    link.free_at = departure
+                latency = link.latency()
+                if latency == 0.0 and profile.delay:
+                    self._stats['reordered'] += 1
+                link.backlog += 1
+                self._counter += 1
+                heapq.heappush(self._queue, (departure + latency, self._counter, link, data, source, destination))
+            self._condition.notify()
+
+    # Run by the delivery thread: hand every segment to the lossy layer it is addressed to once its time has come
+    def deliver_segments(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                due = []
+                now = time.monotonic()
+                while self._queue and self._queue[0][0] <= now:
+                    (deliver_at, counter, link, data, source, destination) = heapq.heappop(self._queue)
+                    link.backlog -= 1
+                    endpoint = self._endpoints.get(destination)
+                    if endpoint is None:
+                        self._stats['unreachable'] += 1
+                    else:
+                        self._stats['delivered'] += 1
+                        due.append((endpoint, data, source))
+            # the sockets are called without holding the lock, because they send segments in response
+            for (endpoint, data, source) in due:
+                endpoint.receive_segment(data, source)
+
+
+# Drop-in replacement of the LossyLayer that sends its segments through an EmulatedNetwork instead of a UDP socket
+class EmulatedLossyLayer:
+    def __init__(self, network, bTCP_sock, a_ip, a_port, b_ip, b_port):
+        self._network = network
+        self._bTCP_sock = bTCP_sock
+        self._address = normalize_address((a_ip, a_port))
+        self._b_address = normalize_address((b_ip, b_port))
+        self._network.bind(self._address, self)
+
+    # Stop receiving segments
+    def destroy(self):
+        self._network.unbind(self._address)
+
+    # Called by the network when a segment for this lossy layer arrives
+    def receive_segment(self, segment, source):
+        self._bTCP_sock.lossy_layer_input((segment, source))
+
+    # Return the largest payload of a segment that fits in one packet of the network, the same for every address
+    def path_payload_size(self, address=None):
+        return self._network.path_payload_size()
+
+    # The network queues every segment anyway, so a batch needs no bookkeeping of its own
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    # Put the segment (bytes, bytearray or memoryview) into the network, addressed to b unless another address is given
+    def send_segment(self, segment, address=None):
+        address = self._b_address if address is None else normalize_address(address)
+        self._network.transmit(segment, self._address, address)
@@ -0,0 +1,100 @@
+import math
+from btcp.constants import *
+from btcp.units import parse_rate
+
+# pacing mode that derives the rate from the congestion window and the smoothed round trip time
+PACING_RTT = "rtt"
+
+
+# Token bucket that paces the segments of the sender. Tokens are bytes: they flow in at the pacing rate and every
+# segment that is sent takes its size out of the bucket. A segment may be sent as long as the bucket is not empty,
+# so the bucket can go into debt by one segment and the rate holds on average. The bucket holds at most a burst of
+# PACING_BURST_TIME ms worth of tokens (but at least PACING_MIN_BURST_SEGMENTS segments), which absorbs a sender
+# loop that wakes up late without letting a whole window leave back to back.
+# The rate is either configured (bytes per second) or follows the window: the effective window is spread over the
+# smoothed round trip time, with a gain that leaves room for the window to grow. Until the first round trip time
+# sample the sender is not paced.
+class TokenBucketPacer:
+    def __init__(self, rate=None, segment_size=SEGMENT_SIZE):
+        self.mode = "fixed" if rate is not None else PACING_RTT
+        self._segment_size = segment_size
+
+        # current rate in bytes per second, None while the sender is not paced
+        self.rate = rate
+        self._tokens = 0.0
+        self._last_refill = None
+
+        # number of times the sender had to wait for tokens and the number of segments that were paced
+        self.waits = 0
+        self.paced_segments = 0
+
+    # Method that sets the size of the largest segment, e.g. from the three-way handshake
+    def SetSegmentSize(self, segment_size):
+        self._segment_size = segment_size
+
+    # Return the largest number of tokens the bucket can hold at the current rate
+    def Burst(self):
+        return max(PACING_MIN_BURST_SEGMENTS * self._segment_size, self.rate * PACING_BURST_TIME / 1000)
+
+    # Method that is called with the effective window (packets), the smoothed round trip time (ms) and whether the
+    # congestion controller is in slow start, after every ACK. A configured rate does not change.
+    def OnWindowUpdate(self, window, srtt, slow_start):
+        if self.mode != PACING_RTT or srtt is None or srtt <= 0 or math.isinf(window):
+            return
+        gain = PACING_SLOW_START_GAIN if slow_start else PACING_CONGESTION_AVOIDANCE_GAIN
+        self.rate = gain * window * self._segment_size / (srtt / 1000)
+
+    # Method that adds the tokens that flowed in since the last refill
+    def Refill(self, now):
+        if self._last_refill is None:
+            # the first segments may leave in one burst
+            self._tokens = self.Burst()
+        else:
+            self._tokens = min(self.Burst(), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    # Return whether a segment may be sent at now
+    def CanSend(self, now):
+        if self.rate is None:
+            return True
+        self.Refill(now)
+        if self._tokens >= 0:
+            return True
+        self.waits += 1
+        return False
+
+    # Method that takes the tokens of a segment of size bytes that was sent
+    def Consume(self, size):
+        if self.rate is None:
+            return
+        self._tokens -= size
+        self.paced_segments += 1
+
+    # Return the moment at which the bucket is no longer empty, or None if a segment may be sent right away
+    def NextSendTime(self):
+        if self.rate is None or self._last_refill is None or self._tokens >= 0:
+            return None
+        return self._last_refill - self._tokens / self.rate
+
+    # Return the state of the pacer, for tuning
+    def Stats(self):
+        return {
+            "mode": self.mode,
+            "rate": self.rate if self.rate is not None else math.inf,
+            "waits": self.waits,
+            "paced_segments": self.paced_segments,
+        }
+
+
+# Method that creates the pacer for a pacing option: None (no pacing), PACING_RTT or a rate in bytes per second,
+# which may also be given as a netem rate such as "10mbit"
+def CreatePacer(pacing):
+    if pacing is None:
+        return None
+    if pacing == PACING_RTT:
+        return TokenBucketPacer()
+    if isinstance(pacing, str):
+        pacing = parse_rate(pacing)
+    if pacing <= 0:
+        raise ValueError("Pacing rate must be positive: {}".format(pacing))
+    return TokenBucketPacer(pacing)
@@ -0,0 +1,43 @@
+from btcp.constants import *
+
+
+# Estimator of the retransmission timeout from measured round trip times, following RFC 6298. All times are in
+# milliseconds. Until the first sample arrives the configured timeout is used.
+class RTTEstimator:
+    def __init__(self, initial_timeout, min_timeout=MIN_RETRANSMISSION_TIMEOUT,
+                 max_timeout=MAX_RETRANSMISSION_TIMEOUT):
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+
+        # smoothed round trip time and round trip time variance, None until the first sample
+        self.srtt = None
+        self.rttvar = None
+
+        # timeout without backoff and the factor it is currently multiplied with after timeouts
+        self._timeout = self.Clamp(initial_timeout)
+        self._backoff = 1
+
+    def Clamp(self, timeout):
+        return min(self._max_timeout, max(self._min_timeout, timeout))
+
+    # Method that adds a round trip time sample. Samples of retransmitted packets must not be added, because it is
+    # not known which transmission was acknowledged (Karn's rule).
+    def AddSample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self._timeout = self.Clamp(self.srtt + max(RTT_CLOCK_GRANULARITY, RTT_K * self.rttvar))
+        # a new sample means packets get through again, so the backoff is reset
+        self._backoff = 1
+
+    # Method that doubles the timeout after a retransmission timeout
+    def Backoff(self):
+        if self._timeout * self._backoff < self._max_timeout:
+            self._backoff *= 2
+
+    # Return the current retransmission timeout
+    def GetTimeout(self):
+        return min(self._max_timeout, self._timeout * self._backoff)
@@ -1,40 +1,341 @@
+import collections
+import functools
+import heapq
+import logging
+import mmap
+import os
 import sys
+import threading
 import time
+import zlib
 from btcp.btcp_segment import *
+from btcp.byte_queue import ByteQueue
+from btcp.congestion_control import CreateCongestionController
+from btcp.framing import pack_message_header
+from btcp.metrics import Histogram
+from btcp.pacing import CreatePacer
+from btcp.rtt_estimator import RTTEstimator
 
+logger = logging.getLogger(__name__)
 
-# Method that converts data to an array with parts of the data
-def DivideDataInArray(data):
-    # array that packets will be put into
-    data_array = []
-    # data that still has to be put in the array
-    file = open(data, 'rb')
-    current_data = file.read()
-    file.close()
+# loss detection states of a packet in the send window
+PACKET_LOST = 1
+PACKET_FAST_RETRANSMITTED = 2
 
-    while len(current_data) > 0:
-        # take first PAYLOAD_SIZE of bytes and put in in the array
-        packet = current_data[:PAYLOAD_SIZE]
-        data_array.append(packet)
 
-        current_data = current_data[PAYLOAD_SIZE:]
+# Read-only source of the payloads of a file, which is divided in chunks of chunk_size bytes. The file is
+# memory-mapped and the payload of a sequence number is served as a memoryview into the mapping, so only the pages of
+# the packets that are in flight have to be resident and no copy of the file is made.
+# Only the length bytes from offset on are sent when they are given (the rest of the file by default), and a header
+# is sent in packets of its own before them when it is given, divided in chunks like the file when it is longer than
+# chunk_size. The header can also be a function that returns it from the number of bytes that are sent, as they are
+# known once the file is opened.
+class FileChunkSource:
+    def __init__(self, path, chunk_size=PAYLOAD_SIZE, offset=0, length=None, header=b''):
+        self._chunk_size = chunk_size
+        self._file = open(path, 'rb')
+        file_size = os.fstat(self._file.fileno()).st_size
+        self._size = max(0, file_size - offset) if length is None else min(length, max(0, file_size - offset))
+        self._header = header(self._size) if callable(header) else header
+        self._header_packets = (len(self._header) + chunk_size - 1) // chunk_size
+        self._mmap = None
+        if self._size > 0:
+            # an empty file can not be mapped
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                # the file is read front to back, so let the kernel read ahead
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._mmap)[offset:offset + self._size]
+        else:
+            self._view = memoryview(bytes())
+
+    # number of packets the file is divided in, including those of the header
+    def __len__(self):
+        return self._header_packets + (self._size + self._chunk_size - 1) // self._chunk_size
+
+    # Return the payload of the packet with sequence number seq_number
+    def __getitem__(self, seq_number):
+        if seq_number < self._header_packets:
+            start = seq_number * self._chunk_size
+            return self._header[start:start + self._chunk_size]
+        seq_number -= self._header_packets
+        start = seq_number * self._chunk_size
+        return self._view[start:start + self._chunk_size]
+
+    # Return the flags the packet with sequence number seq_number is sent with
+    def flags(self, seq_number):
+        return 0
+
+    # Method that is called when the packets before seq_number are no longer needed. A mapped file reads them again
+    # when they are needed.
+    def release(self, seq_number):
+        pass
+
+    # Return whether the number of packets is final: a source that produces its packets while they are sent counts
+    # one packet more until it produced the last one
+    def complete(self):
+        return True
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a payload view is still referenced somewhere, the mapping is freed when it is garbage collected
+                pass
+        self._file.close()
+
+
+# Source of the payloads of a file that compresses it with one zlib stream (raw deflate). Packets are produced in
+# order when they are first asked for, so the number of packets is only known once the whole file was compressed:
+# until then the source counts one packet more than it produced. The stream is flushed (Z_SYNC_FLUSH) at the end of
+# every packet, so the receiver can decompress all data of a packet as soon as it has the packets before it, and a
+# retransmitted packet is the same as the one that was lost. The input for a packet is sized from the compression
+# ratio so far to fill about one packet; output that does not fit spills over into the next packet.
+# When a packet does not compress below COMPRESSION_MAX_RATIO the data is sent uncompressed (without the
+# COMPRESSED_FLAG) for a number of packets that doubles every time compression is tried again in vain.
+# Files that are sent one after the other on a connection may share the compressor, their packets then form one
+# zlib stream.
+class CompressedChunkSource(FileChunkSource):
+    def __init__(self, path, chunk_size=PAYLOAD_SIZE, offset=0, length=None, header=b'', compressor=None):
+        super().__init__(path, chunk_size, offset, length, header)
+        if compressor is None:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._compressor = compressor
+
+        # position in the file of the input that was not compressed or sent yet, and the number of input bytes for
+        # the next compressed packet
+        self._position = 0
+        self._input_size = int(chunk_size * COMPRESSION_FILL)
+
+        # compressed output that did not fit in the last packet
+        self._pending = b''
+
+        # number of packets that are still sent uncompressed and the number of packets the next back off lasts
+        self._uncompressed_packets = 0
+        self._backoff = 1
+
+        # (payload, flags) of the packets from sequence number _first on that were produced and not released
+        self._packets = collections.deque()
+        self._first = 0
+        # the header is not compressed
+        for start in range(0, len(self._header), chunk_size):
+            self._packets.append((self._header[start:start + chunk_size], 0))
+
+        # statistics counters, read with stats
+        self.input_bytes = 0
+        self.compressed_bytes = 0
+        self.uncompressed_packets = 0
+
+    # number of packets produced so far, plus one while there is data left
+    def __len__(self):
+        return self._first + len(self._packets) + (not self.complete())
+
+    def complete(self):
+        return self._position >= self._size and len(self._pending) == 0
+
+    def __getitem__(self, seq_number):
+        return self.packet(seq_number)[0]
+
+    def flags(self, seq_number):
+        return self.packet(seq_number)[1]
+
+    # Return the (payload, flags) of the packet with sequence number seq_number, producing the packets up to it
+    def packet(self, seq_number):
+        while seq_number >= self._first + len(self._packets):
+            self._packets.append(self.produce())
+        return self._packets[seq_number - self._first]
+
+    def release(self, seq_number):
+        while self._first < seq_number and self._packets:
+            self._packets.popleft()
+            self._first += 1
+
+    # Return the (payload, flags) of the next packet
+    def produce(self):
+        if self._pending:
+            payload = self._pending[:self._chunk_size]
+            self._pending = self._pending[self._chunk_size:]
+            return payload, COMPRESSED_FLAG
+        if self._uncompressed_packets > 0:
+            self._uncompressed_packets -= 1
+            self.uncompressed_packets += 1
+            payload = self._view[self._position:self._position + self._chunk_size]
+            self._position += len(payload)
+            return payload, 0
+
+        data = self._view[self._position:self._position + self._input_size]
+        self._position += len(data)
+        output = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.input_bytes += len(data)
+        self.compressed_bytes += len(output)
+
+        ratio = len(output) / len(data)
+        fill = self._chunk_size * COMPRESSION_FILL
+        if ratio > COMPRESSION_MAX_RATIO:
+            # incompressible data: do not spend the time to compress the next packets
+            self._uncompressed_packets = self._backoff
+            self._backoff = min(self._backoff * 2, COMPRESSION_MAX_BACKOFF)
+            self._input_size = int(fill)
+        else:
+            self._backoff = 1
+            self._input_size = int(min(self._chunk_size * COMPRESSION_MAX_INPUT_SEGMENTS, fill / ratio))
+        self._pending = output[self._chunk_size:]
+        return output[:self._chunk_size], COMPRESSED_FLAG
+
+    # Return the number of bytes that were compressed, the size they were compressed to and the number of packets
+    # that were sent uncompressed
+    def stats(self):
+        return {
+            'input_bytes': self.input_bytes,
+            'compressed_bytes': self.compressed_bytes,
+            'uncompressed_packets': self.uncompressed_packets,
+        }
+
+
+# Source of the payloads of a stream of messages on one connection. Every message is a file that is sent after its
+# frame header (see btcp.framing), as a chunk source of its own whose packets follow those of the message before it.
+# Messages can be added while earlier ones are still being sent or acknowledged, a file is only opened when its
+# first packet is needed and it is closed once all its packets are released. With compression all messages share
+# one compressor, so that a small file can refer to the ones before it.
+class MessageSource:
+    def __init__(self, chunk_size=PAYLOAD_SIZE, compression=False):
+        self._chunk_size = chunk_size
+        self._compressor = None
+        if compression:
+            self._compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        # (first sequence number, chunk source) of the messages that were opened and not released yet, and the
+        # first sequence number of the next message once they are all released
+        self._sources = collections.deque()
+        self._end = 0
+
+        # (name, path) of the messages that were added and not opened yet
+        self._messages = collections.deque()
+
+        # statistics counters, read with stats
+        self.messages_opened = 0
+        self.messages_closed = 0
+
+    # Method that adds the file with path to the stream as a message with the given name. The name is checked right
+    # away, the size of the file is taken from the file once it is opened.
+    def add(self, name, path):
+        pack_message_header(name, 0)
+        self._messages.append((name, path))
+
+    # number of packets of the messages that were opened, plus one while there are messages left
+    def __len__(self):
+        if not self._sources:
+            return self._end + bool(self._messages)
+        (first, source) = self._sources[-1]
+        if not source.complete():
+            return first + len(source)
+        return first + len(source) + bool(self._messages)
+
+    def __getitem__(self, seq_number):
+        (first, source) = self.find(seq_number)
+        return source[seq_number - first]
+
+    def flags(self, seq_number):
+        (first, source) = self.find(seq_number)
+        return source.flags(seq_number - first)
+
+    # Return the (first sequence number, chunk source) of the message that seq_number belongs to, opening the next
+    # message when seq_number is beyond the packets of the opened ones
+    def find(self, seq_number):
+        if seq_number < (self._sources[0][0] if self._sources else self._end):
+            raise IndexError("packet {} was released".format(seq_number))
+        for (first, source) in reversed(self._sources):
+            if seq_number >= first:
+                if seq_number < first + len(source):
+                    return (first, source)
+                break
+        while True:
+            (first, source) = self.open()
+            if seq_number < first + len(source):
+                return (first, source)
+
+    # Open the next message and return its (first sequence number, chunk source)
+    def open(self):
+        if self._sources:
+            (first, source) = self._sources[-1]
+            first += len(source)
+        else:
+            first = self._end
+        (name, path) = self._messages.popleft()
+        # the size in the header is taken from the opened file, so it matches the data that is sent even when the
+        # file is replaced meanwhile
+        header = functools.partial(pack_message_header, name)
+        if self._compressor is not None:
+            source = CompressedChunkSource(path, self._chunk_size, header=header, compressor=self._compressor)
+        else:
+            source = FileChunkSource(path, self._chunk_size, header=header)
+        self._sources.append((first, source))
+        self.messages_opened += 1
+        return (first, source)
+
+    # Method that closes the messages all of whose packets are before seq_number
+    def release(self, seq_number):
+        while self._sources:
+            (first, source) = self._sources[0]
+            if not source.complete() or first + len(source) > seq_number:
+                source.release(seq_number - first)
+                break
+            self._sources.popleft()
+            self._end = first + len(source)
+            source.close()
+            self.messages_closed += 1
 
-    return data_array
+    def complete(self):
+        return not self._messages and all(source.complete() for (_, source) in self._sources)
+
+    def close(self):
+        while self._sources:
+            (first, source) = self._sources.popleft()
+            self._end = first + len(source)
+            source.close()
+
+    # Return the number of messages that were opened and closed
+    def stats(self):
+        return {
+            'messages_opened': self.messages_opened,
+            'messages_closed': self.messages_closed,
+        }
 
 
 class SelectiveRepeaterSender:
-    def __init__(self, lossy_layer, window_size, packet_timeout):
+    def __init__(self, lossy_layer, window_size, packet_timeout, congestion_control=DEFAULT_CONGESTION_CONTROL,
+                 pacing=None, fec=None, compression=False):
         self._lossy_layer = lossy_layer
         self._data_array = []
+        self._number_of_packets = 0
+
+        # function that is called after every ACK, see SetAckListener
+        self._ack_listener = None
+
+        # The arrays below only cover the send window: the packet with sequence number x uses slot x % window_size.
 
         # array that keeps track of the times when a packet was sent
-        self._timeout_array = []
+        self._timeout_array = [0.0] * window_size
 
-        # boolean array that determines for each packet whether it was sent
-        self._sent_array = []
+        # array that counts how many times each packet in the window was sent
+        self._transmissions = [0] * window_size
 
         # boolean array that determines for each packet whether an ack was received for it
-        self._ack_array = []
+        self._ack_array = bytearray(window_size)
+
+        # loss detection state of each packet in the window: PACKET_LOST when the ACKs showed that it was lost and
+        # it waits for its fast retransmit, PACKET_FAST_RETRANSMITTED after that
+        self._loss_state = bytearray(window_size)
+
+        # min-heap of (deadline, sequence number, transmission) entries of the outstanding packets. Entries of packets
+        # that were acknowledged or sent again in the meantime are stale and skipped when they reach the top.
+        self._timer_heap = []
+
+        # condition that protects the sender state, it is notified by ReceiveAckPacket so that the sender loop only
+        # wakes up for an ACK or for the next retransmission deadline
+        self._condition = threading.Condition()
 
         # lower bound of window
         self._send_base = 0
@@ -45,156 +346,1074 @@ class SelectiveRepeaterSender:
         self._window_size = window_size
 
         # when the sender doesn't receive an ACK from the receiver side within this packet_timeout a new
-        # packet is sent.
+        # packet is sent. The configured value is only the starting point, the timeout adapts to the measured
+        # round trip times.
         self._packet_timeout = packet_timeout
+        self._rtt_estimator = RTTEstimator(packet_timeout)
+
+        # send time of the packet that the next round trip time sample is taken from
+        self._rtt_sample_time = None
+
+        # RACK-style loss detection (RFC 8985): the latest send time of a packet that was acknowledged after a single
+        # transmission and its round trip time (s), the factor the reordering window is widened with after spurious
+        # retransmits and the moment at which packets that are still within the reordering window count as lost
+        self._rack_send_time = None
+        self._rack_rtt = 0.0
+        self._reorder_window_multiplier = 1
+        self._reorder_deadline = None
+
+        # the packets in flight that were not acknowledged yet, in the order of their last transmission, with the
+        # moment it was sent. Loss detection walks it from the packet that was sent first and stops at the first one
+        # that was sent after the RACK send time, so it does not scan the whole window on every ACK.
+        self._send_order = collections.OrderedDict()
+
+        # marks the (wrapped) sequence numbers of the packets that were fast retransmitted with the loss event they
+        # belong to, so that a report of a duplicate can be attributed to a fast retransmit rather than to a timeout
+        # or to the network. When all fast retransmits of the current loss event turn out to be spurious, the
+        # window reduction of the congestion controller is undone.
+        self._fast_retransmitted = bytearray(SEQUENCE_NUMBER_SPACE)
+        self._loss_event = 1
+        self._loss_event_retransmissions = 0
+
+        # packets that were detected as lost and are retransmitted by the next SendStep, and the first packet that
+        # was sent after the last loss event: losses before it belong to the same event and do not shrink the
+        # congestion window again
+        self._lost_packets = collections.deque()
+        self._recovery_point = 0
+
+        # largest payload of a segment, negotiated in the three-way handshake
+        self._max_segment_size = PAYLOAD_SIZE
+
+        # reusable buffers that hold the encoded segments of the current window
+        self._segment_pool = SegmentBufferPool(window_size)
+
+        # congestion controller that limits the number of packets in flight below the window size
+        self._congestion_controller = CreateCongestionController(congestion_control)
+
+        # token bucket that spreads the packets over time (None sends them back to back), see CreatePacer, and the
+        # moment at which the pacer lets the next packet go when it held packets back
+        self._pacer = CreatePacer(pacing)
+        self._pacing_deadline = None
+
+        # Forward error correction: the configured mode (None, the number of packets that share a parity packet or
+        # FEC_ADAPTIVE), the mode that is in use once the receiver agreed to it, the first packet of the block the
+        # next parity packet covers and the number of packets in that block. In the adaptive mode the block size
+        # follows the loss rate: a moving average of the fraction of the packets that were lost.
+        self._fec_mode = ValidateForwardErrorCorrection(fec, window_size)
+        self._fec = None
+        self._fec_block_start = 0
+        self._fec_block_size = 0
+        self._loss_rate = 0.0
+
+        # whether the file is compressed: the configured setting and whether the receiver agreed to it
+        self._compression_mode = compression
+        self._compression = False
+
+        # flags every data segment is sent with besides those of its payload: HEADER_CHECKSUM_FLAG once the receiver
+        # agreed to check the headers of data segments
+        self._segment_flags = 0
+
+        # number of packets that were newly acknowledged by the ACK that is being processed
+        self._newly_acked = 0
+
+        # receive window the receiver advertised in its last ACK, in packets
+        self._peer_window = window_size
+
+        # Zero window probing: moment at which a probe is sent when the receiver advertised a zero window and no
+        # packets are in flight, and the factor the probe interval is multiplied with after unanswered probes
+        self._probe_deadline = None
+        self._probe_backoff = 1
+        self._zero_window_probes = 0
+
+        # statistics counters, read with Stats
+        self._segments_sent = 0
+        self._bytes_sent = 0
+        self._retransmissions = 0
+        self._fast_retransmissions = 0
+        self._spurious_retransmissions = 0
+        self._timeouts = 0
+        self._parity_segments = 0
+        self._acks_received = 0
+        self._duplicate_acks = 0
+        self._stale_acks = 0
+        self._checksum_failures = 0
+        self._rtt_histogram = Histogram()
+
+    # Return the number of packets that may be in flight: the minimum of the congestion window, the window size and
+    # the window advertised by the receiver
+    def EffectiveWindow(self):
+        return min(self._congestion_controller.GetWindow(), self._window_size, self._peer_window)
+
+    # Method that sets the receive window of the receiver, e.g. from the three-way handshake
+    def SetPeerWindow(self, window):
+        with self._condition:
+            self._peer_window = window
+            self._condition.notify()
+
+    # Method that sets the largest payload of a segment, e.g. from the three-way handshake. The file is divided in
+    # packets of this size when it is opened, so a later change (a retransmitted SYN-ACK) is ignored.
+    def SetMaximumSegmentSize(self, payload_size):
+        with self._condition:
+            if self._number_of_packets > 0 or payload_size == self._max_segment_size:
+                return
+            self._max_segment_size = payload_size
+            self._segment_pool = SegmentBufferPool(self._window_size, HEADER_SIZE + payload_size)
+            if self._pacer is not None:
+                self._pacer.SetSegmentSize(HEADER_SIZE + payload_size)
+
+    # Method that turns on the forward error correction mode the sender was created with, once the receiver agreed
+    # to it in the three-way handshake. Like the segment size it can not change once the file is opened.
+    def EnableForwardErrorCorrection(self):
+        with self._condition:
+            if self._number_of_packets > 0 or self._fec_mode is None:
+                return
+            self._fec = self._fec_mode
+            self._fec_block_start = self._send_next
+            self._fec_block_size = self.FecBlockSize()
+
+    # Method that turns on compression when the sender was created with it, once the receiver agreed to it in the
+    # three-way handshake. It can not change once the file is opened.
+    def EnableCompression(self):
+        with self._condition:
+            if self._number_of_packets == 0:
+                self._compression = self._compression_mode
+
+    # Method that makes the checksum of every data segment cover its header as well, once the receiver agreed to it in
+    # the three-way handshake. Unlike compression it may change at any time: the receiver checks every segment the
+    # way its flags say.
+    def EnableHeaderChecksum(self):
+        with self._condition:
+            self._segment_flags = HEADER_CHECKSUM_FLAG
+
+    # Return the number of packets the next parity packet covers
+    def FecBlockSize(self):
+        if self._fec != FEC_ADAPTIVE:
+            return self._fec
+        if self._loss_rate <= 0:
+            return FEC_MAX_BLOCK_SIZE
+        return int(max(FEC_MIN_BLOCK_SIZE, min(FEC_MAX_BLOCK_SIZE, FEC_LOSSES_PER_BLOCK / self._loss_rate)))
+
+    # Method that adds a lost packet to the moving average of the loss rate
+    def CountLoss(self):
+        self._loss_rate += LOSS_RATE_ALPHA * (1 - self._loss_rate)
+
+    # Return the state of the congestion controller (cwnd, ssthresh, loss events, ...)
+    def GetCongestionStats(self):
+        with self._condition:
+            return self._congestion_controller.Stats()
+
+    # Return the statistics counters of the sender, the window occupancy, the round trip time histogram (ms) and the
+    # state of the pacer
+    def Stats(self):
+        with self._condition:
+            stats = {
+                'segments_sent': self._segments_sent,
+                'bytes_sent': self._bytes_sent,
+                'retransmissions': self._retransmissions,
+                'fast_retransmissions': self._fast_retransmissions,
+                'spurious_retransmissions': self._spurious_retransmissions,
+                'timeouts': self._timeouts,
+                'parity_segments': self._parity_segments,
+                'fec_block_size': self._fec_block_size if self._fec is not None else 0,
+                'loss_rate': self._loss_rate,
+                'acks_received': self._acks_received,
+                'duplicate_acks': self._duplicate_acks,
+                'stale_acks': self._stale_acks,
+                'checksum_failures': self._checksum_failures,
+                'zero_window_probes': self._zero_window_probes,
+                'packets_in_flight': self._send_next - self._send_base,
+                'effective_window': min(self.EffectiveWindow(), self._window_size),
+                'peer_window': self._peer_window,
+                'max_segment_size': self._max_segment_size,
+                'retransmission_timeout_ms': self._rtt_estimator.GetTimeout(),
+                'reorder_window_ms': self.ReorderWindow() * 1000,
+                'rtt_ms': self._rtt_histogram.Snapshot(),
+            }
+            if self._pacer is not None:
+                stats['pacing'] = self._pacer.Stats()
+            if isinstance(self._data_array, CompressedChunkSource):
+                stats['compression'] = self._data_array.stats()
+            elif isinstance(self._data_array, MessageSource):
+                stats['messages'] = self._data_array.stats()
+            return stats
+
+    # Sender side of selective repeat protocol. The data is the path of a file, of which only length bytes from offset
+    # on are sent when they are given, after the header when it is given (see FileChunkSource).
+    def StartSending(self, data, offset=0, length=None, header=b''):
+        self.OpenData(data, offset, length, header)
+        try:
+            self.SendAll()
+        finally:
+            self.CloseData()
+
+    # Sender side for a stream of messages: the messages, an iterable of (name, path), are sent after the messages of
+    # earlier calls, with the same sequence numbers, window and congestion state. The packets of a message follow
+    # those of the message before it without waiting for their ACKs. Returns when all messages were acknowledged.
+    def SendMessages(self, messages):
+        self.AddMessages(messages)
+        self.SendAll()
+
+    # Method that adds messages, an iterable of (name, path), to the message stream of the sender. A sender either
+    # sends one file or a stream of messages.
+    def AddMessages(self, messages):
+        with self._condition:
+            if not isinstance(self._data_array, MessageSource):
+                self._data_array = MessageSource(self._max_segment_size, self._compression)
+            for (name, path) in messages:
+                self._data_array.add(name, path)
+            self._number_of_packets = len(self._data_array)
+
+    # Sender loop: send the data until all of it was acknowledged
+    def SendAll(self):
+        with self._condition:
+            while not self.Finished():
+                self.SendStep()
+                # sleep until the next deadline or until an ACK arrives
+                if not self.Finished():
+                    self._condition.wait(self.WaitTime())
+
+    # Method that maps the file with path data, payloads are read (and compressed) from it on demand
+    def OpenData(self, data, offset=0, length=None, header=b''):
+        source = CompressedChunkSource if self._compression else FileChunkSource
+        self._data_array = source(data, self._max_segment_size, offset, length, header)
+        self._number_of_packets = len(self._data_array)
+
+    def CloseData(self):
+        self._data_array.close()
+
+    # Return whether all packets of the data have been acknowledged
+    def Finished(self):
+        return self._send_base >= self._number_of_packets
+
+    # Method that does one round of the sender loop without blocking: it retransmits the packets that the ACKs
+    # showed to be lost, sends the new packets that fit in the window, retransmits the packets whose timer has
+    # expired and probes a zero window. Lost and new packets only leave as fast as the pacer allows. It must be
+    # called with the condition held (or from the only thread that uses the sender).
+    def SendStep(self):
+        # all packets of one step leave the lossy layer in a single burst
+        with self._lossy_layer.batch():
+            # fast retransmit the lost packets without waiting for their timer
+            now = time.monotonic()
+            self._pacing_deadline = None
+            if self._reorder_deadline is not None and now >= self._reorder_deadline:
+                self.DetectLosses(now)
+            while self._lost_packets:
+                seq_number = self._lost_packets[0]
+                slot = seq_number % self._window_size
+                if seq_number < self._send_base or self._loss_state[slot] != PACKET_LOST:
+                    # acknowledged or retransmitted after a timeout in the meantime
+                    self._lost_packets.popleft()
+                    continue
+                if not self.PacingAllows(now):
+                    break
+                self._lost_packets.popleft()
+                self._loss_state[slot] = PACKET_FAST_RETRANSMITTED
+                self._fast_retransmitted[seq_number % SEQUENCE_NUMBER_SPACE] = self._loss_event
+                self._loss_event_retransmissions += 1
+                self._fast_retransmissions += 1
+                logger.debug("packet %d lost, fast retransmit", seq_number)
+                self.SendSenderPacket(seq_number)
 
-    # Sender side of selective repeat protocol
-    def StartSending(self, data):
-        # Create data array
-        self._data_array = DivideDataInArray(data)
+            # send packages to receiver as long as they are within the window
+            while (self._send_next - self._send_base) < self.EffectiveWindow() and \
+                    self._send_next < self._number_of_packets and self.PacingAllows(now):
+                self.SendNewPacket()
 
-        for x in range(len(self._data_array)):
-            self._timeout_array.append(0)
+            # retransmit the packets whose timer has expired
+            now = time.monotonic()
+            self.DiscardStaleTimers()
+            while self._timer_heap and self._timer_heap[0][0] <= now:
+                (deadline, seq_number, transmission) = heapq.heappop(self._timer_heap)
+                # every packet has its own timer, the timeout is only backed off when the oldest
+                # outstanding packet times out so that a burst of expiring timers counts as one timeout
+                if seq_number == self._send_base:
+                    self._rtt_estimator.Backoff()
+                    self._congestion_controller.OnTimeout()
+                    self._recovery_point = self._send_next
+                # a timeout has occurred and the packet is send again
+                self._loss_state[seq_number % self._window_size] = 0
+                self._timeouts += 1
+                self.CountLoss()
+                logger.debug("packet %d timed out", seq_number)
+                self.SendSenderPacket(seq_number)
+                self.DiscardStaleTimers()
 
-        for x in range(len(self._data_array)):
-            self._sent_array.append(False)
+            self.ProbeZeroWindow(now, self._number_of_packets)
 
-        for x in range(len(self._data_array)):
-            self._ack_array.append(False)
+    # Return whether the pacer lets a packet go at now. If not, the pacing deadline is set to the moment it will.
+    # The packets that are retransmitted after a timeout or sent as a probe are not held back, but they do take
+    # their tokens.
+    def PacingAllows(self, now):
+        if self._pacer is None or self._pacer.CanSend(now):
+            return True
+        self._pacing_deadline = self._pacer.NextSendTime()
+        return False
 
-        # Start sender loop
-        while self._send_base < len(self._data_array):
-            # send package to receiver only if it is within the window
-            if (self._send_next - self._send_base) < self._window_size:
-                if self._send_next < len(self._data_array):
-                    self.SendSenderPacket(self._send_next)
-                    self._send_next += 1
-            # check if timeout on one of the packets that has NOT received an ACK yet has occurred
-            for x in range(len(self._sent_array)):
-                if self._sent_array[x] and not self._ack_array[x]:
-                    if ((time.time() - self._timeout_array[x]) * 1000) > self._packet_timeout:
-                        # a timeout has occurred and the packet is send again
-                        print("packet timeout occurred")
-                        self.SendSenderPacket(x)
+    # Method that passes the effective window and the smoothed round trip time to the pacer, after every ACK
+    def UpdatePacingRate(self):
+        if self._pacer is not None:
+            self._pacer.OnWindowUpdate(self.EffectiveWindow(), self._rtt_estimator.srtt,
+                                       self._congestion_controller.InSlowStart())
 
+    # Return the number of seconds until the next retransmission, probe, reorder or pacing deadline, or None if there
+    # is none
+    def WaitTime(self):
+        deadlines = [self._timer_heap[0][0]] if self._timer_heap else []
+        if self._probe_deadline is not None:
+            deadlines.append(self._probe_deadline)
+        if self._reorder_deadline is not None:
+            deadlines.append(self._reorder_deadline)
+        if self._pacing_deadline is not None:
+            deadlines.append(self._pacing_deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    # Method that sets a function that is called after every ACK, for drivers of the sender that do not wait on the
+    # condition (e.g. an asyncio event loop)
+    def SetAckListener(self, listener):
+        self._ack_listener = listener
+
+    # Method that sends a probe when the receiver advertised a zero window and no packets are in flight. In that case
+    # no ACK would ever arrive to open the window again, so when the persist timer expires the next packet is sent
+    # anyway. The receiver buffers it if it can and answers with its current window.
+    def ProbeZeroWindow(self, now, number_of_packets):
+        if self._peer_window > 0 or self._send_next != self._send_base or self._send_next >= number_of_packets:
+            self._probe_deadline = None
+        elif self._probe_deadline is None:
+            probe_interval = min(MAX_RETRANSMISSION_TIMEOUT, self._rtt_estimator.GetTimeout() * self._probe_backoff)
+            self._probe_deadline = now + probe_interval / 1000
+        elif now >= self._probe_deadline:
+            self._zero_window_probes += 1
+            self._probe_deadline = None
+            self._probe_backoff *= 2
+            self.SendNewPacket()
+
+    # Method that removes the timers of packets that were acknowledged or sent again from the top of the heap
+    def DiscardStaleTimers(self):
+        while self._timer_heap:
+            (deadline, seq_number, transmission) = self._timer_heap[0]
+            slot = seq_number % self._window_size
+            if seq_number >= self._send_base and not self._ack_array[slot] and \
+                    transmission == self._transmissions[slot]:
+                break
+            heapq.heappop(self._timer_heap)
 
     # Method that is called when a package with the ack flag (and only the ack flag) is received
-    def ReceiveAckPacket(self, seg_info):
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
-        # Now that the ack has been received we set the boolean that keeps track whether an ack is being sent to false
-        self._ack_array[ack_number] = True
-
-        # Now we update the _send_base variable because a new ack was received
-        index = 0
-        for x in self._ack_array:
-            if not x:
+    def ReceiveAckPacket(self, segment):
+        ack_number = segment.ack_number
+        window = segment.window
+        data = segment.data
+        # the payload of an ACK holds its selective acknowledgement blocks, a corrupted ACK is ignored
+        if segment.checksum != calculate_checksum(data, segment.header_checksum):
+            with self._condition:
+                self._checksum_failures += 1
+            return
+        with self._condition:
+            self._acks_received += 1
+            # A first selective acknowledgement block that reports a duplicate is read even from an old ACK
+            sack_blocks = UnpackSackBlocks(data[:segment.data_length])
+            if IsDuplicateReport(sack_blocks, ack_number):
+                self.ReceiveDuplicateReport(sack_blocks[0][0])
+                sack_blocks = sack_blocks[1:]
+
+            # The ACK is cumulative: all packets before ack_number have been received
+            cumulative = self.UnwrapSequenceNumber(ack_number, self._send_next + 1)
+            if cumulative is None:
+                # old ACK that arrived out of order
+                self._stale_acks += 1
+                return
+            self.MarkAcknowledged(self._send_base, cumulative)
+
+            # Every ACK advertises how many packets the receiver can still buffer
+            self._peer_window = window
+            if window > 0:
+                self._probe_backoff = 1
+
+            # The packets in the selective acknowledgement blocks have been received as well
+            for (block_start, block_end) in sack_blocks:
+                block_start = self.UnwrapSequenceNumber(block_start, self._send_next)
+                block_end = self.UnwrapSequenceNumber(block_end, self._send_next + 1)
+                if block_start is not None and block_end is not None:
+                    self.MarkAcknowledged(block_start, block_end)
+
+            # Let the congestion window grow for the newly acknowledged packets
+            if self._newly_acked > 0:
+                self._congestion_controller.OnAck(self._newly_acked)
+                self._loss_rate *= (1 - LOSS_RATE_ALPHA) ** self._newly_acked
+                self._newly_acked = 0
+            else:
+                self._duplicate_acks += 1
+
+            # Take a round trip time sample from the packet that was sent last among the ones this ACK acknowledges,
+            # packets that were sent before it and are still missing may be lost
+            if self._rtt_sample_time is not None:
+                now = time.monotonic()
+                rtt = (now - self._rtt_sample_time) * 1000
+                self._rtt_estimator.AddSample(rtt)
+                self._rtt_histogram.Observe(rtt)
+                if self._rack_send_time is None or self._rtt_sample_time > self._rack_send_time:
+                    self._rack_send_time = self._rtt_sample_time
+                    self._rack_rtt = rtt / 1000
+                    self.DetectLosses(now)
+                self._rtt_sample_time = None
+
+            # Now we update the _send_base variable past all packets that have been acknowledged and free their slots
+            slot = self._send_base % self._window_size
+            while self._send_base < self._send_next and self._ack_array[slot]:
+                self._send_order.pop(self._send_base, None)
+                self._ack_array[slot] = 0
+                self._transmissions[slot] = 0
+                self._loss_state[slot] = 0
+                self._send_base += 1
+                slot = self._send_base % self._window_size
+
+            # the payloads before the send base are not needed anymore, unless the next parity packet covers them
+            if self._send_base > 0:
+                self._data_array.release(min(self._send_base, self._fec_block_start) if self._fec is not None
+                                         else self._send_base)
+
+            self.UpdatePacingRate()
+            self._condition.notify()
+        if self._ack_listener is not None:
+            self._ack_listener()
+
+    # Method that is called when the receiver reports that the packet with (wrapped) sequence number duplicate
+    # arrived twice. If it was fast retransmitted, it was reordered instead of lost: the reordering window is widened
+    # and when all fast retransmits of the current loss event were spurious, the window reduction is undone.
+    def ReceiveDuplicateReport(self, duplicate):
+        loss_event = self._fast_retransmitted[duplicate]
+        if not loss_event:
+            return
+        self._fast_retransmitted[duplicate] = 0
+        self._spurious_retransmissions += 1
+        self._reorder_window_multiplier = min(self._reorder_window_multiplier * 2, MAX_REORDER_WINDOW_MULTIPLIER)
+        if loss_event == self._loss_event:
+            self._loss_event_retransmissions -= 1
+            if self._loss_event_retransmissions == 0:
+                self._congestion_controller.UndoLoss()
+
+    # Return the reordering window in seconds: a quarter of the smoothed round trip time, widened after spurious
+    # retransmits but never beyond the smoothed round trip time. RFC 8985 starts from the smallest round trip time
+    # instead, but packets that overtake the others pull that down to almost nothing on a reordering path.
+    def ReorderWindow(self):
+        if self._rtt_estimator.srtt is None:
+            return 0.0
+        srtt = self._rtt_estimator.srtt
+        return min(srtt / REORDER_WINDOW_DIVISOR * self._reorder_window_multiplier, srtt) / 1000
+
+    # Return the time (s) that has to pass since a packet was sent before it can count as lost, given that a packet
+    # sent after it was acknowledged: the round trip time of that packet, but at least the smoothed one because a
+    # packet that overtook the others may have had a much shorter trip, plus the reordering window
+    def LossDelay(self):
+        return max(self._rack_rtt, self._rtt_estimator.srtt / 1000) + self.ReorderWindow()
+
+    # Method that marks the packets as lost that are not acknowledged although a packet that was sent after them
+    # was, once the loss delay has passed since they were sent. They are queued for a fast retransmit and the first
+    # loss after the recovery point is reported to the congestion controller. For the packets that may still be
+    # reordered, the reorder deadline is set to the moment the first of them counts as lost. The packets are visited
+    # in the order they were sent, so the walk ends at the first packet that was sent after the RACK send time or
+    # that may still be reordered: the packets after it were sent later still. Only packets that are lost and wait
+    # for their fast retransmit, or that were acknowledged while they did, are passed over.
+    def DetectLosses(self, now):
+        wait = self.LossDelay()
+        self._reorder_deadline = None
+        for (seq_number, send_time) in self._send_order.items():
+            if send_time >= self._rack_send_time:
+                break
+            slot = seq_number % self._window_size
+            if self._ack_array[slot] or self._loss_state[slot] == PACKET_LOST:
+                continue
+            deadline = send_time + wait
+            if deadline > now:
+                self._reorder_deadline = deadline
                 break
-            index += 1
-        self._send_base = index
-        #print(self._send_base, ack_number)
+            self._loss_state[slot] = PACKET_LOST
+            self._lost_packets.append(seq_number)
+            self.CountLoss()
+            if seq_number >= self._recovery_point:
+                self._recovery_point = self._send_next
+                self._loss_event = self._loss_event % MAX_VALUE_8_BIT_INTEGER + 1
+                self._loss_event_retransmissions = 0
+                self._congestion_controller.OnLoss()
+
+    # Method that maps a wrapped sequence number from the 16 bit header field to the first packet at or after the
+    # send base with this sequence number. Returns None if that packet lies at or after limit.
+    def UnwrapSequenceNumber(self, seq_number, limit):
+        seq_number = self._send_base + (seq_number - self._send_base) % SEQUENCE_NUMBER_SPACE
+        if seq_number >= limit:
+            return None
+        return seq_number
+
+    # Method that marks the packets in the range [start, end) as acknowledged and remembers the latest send time of
+    # the newly acknowledged packets that were only sent once, to sample the round trip time
+    def MarkAcknowledged(self, start, end):
+        for seq_number in range(start, end):
+            slot = seq_number % self._window_size
+            if not self._ack_array[slot]:
+                self._ack_array[slot] = 1
+                self._newly_acked += 1
+                self._send_order.pop(seq_number, None)
+                if self._transmissions[slot] == 1 and \
+                        (self._rtt_sample_time is None or self._timeout_array[slot] > self._rtt_sample_time):
+                    self._rtt_sample_time = self._timeout_array[slot]
+
+    # Method that sends the next packet for the first time. With forward error correction, the parity packet of the
+    # block follows the last packet of a block. A compressed file only knows how many packets it has once all of it
+    # was compressed, so the number is read again.
+    def SendNewPacket(self):
+        self.SendSenderPacket(self._send_next)
+        self._send_next += 1
+        self._number_of_packets = len(self._data_array)
+        if self._fec is not None and (self._send_next - self._fec_block_start >= self._fec_block_size or
+                                      self._send_next == self._number_of_packets):
+            self.SendParityPacket(self._fec_block_start, self._send_next)
+            self._fec_block_start = self._send_next
+            self._fec_block_size = self.FecBlockSize()
+
+    # Method that sends the parity packet of the packets in [start, end): the XOR of their payloads. The header holds
+    # the sequence number of the first packet, the number of packets in the window field and the XOR of their
+    # payload lengths in the acknowledgement number field, its compressed flag is the XOR of theirs. A parity packet
+    # is sent once, it is neither acknowledged nor retransmitted.
+    def SendParityPacket(self, start, end):
+        payloads = [self._data_array[seq_number] for seq_number in range(start, end)]
+        size = max(len(payload) for payload in payloads)
+        lengths = 0
+        flags = PARITY_FLAG
+        for seq_number in range(start, end):
+            lengths ^= len(payloads[seq_number - start])
+            flags ^= self._data_array.flags(seq_number)
+        parity = XorPayloads(payloads, size).to_bytes(size, 'big')
+        partial = header_checksum(start % SEQUENCE_NUMBER_SPACE, lengths, flags, end - start, size)
+        segment = Segment(start % SEQUENCE_NUMBER_SPACE, lengths, flags, end - start, size,
+                          calculate_checksum(parity, partial), parity)
+        data = segment.create_segment()
+        self._lossy_layer.send_segment(data)
+        if self._pacer is not None:
+            self._pacer.Consume(len(data))
+        self._parity_segments += 1
 
     # Method that sends a packet from the sender to receiver
     def SendSenderPacket(self, seq_number):
         #print("sending", seq_number)
-        data_to_send = self._data_array[seq_number]
-        segment = Segment(seq_number, 0, 0, 0, len(data_to_send), calculate_checksum(data_to_send), data_to_send)
-        data = segment.create_segment()
+        # a retransmitted segment is still in its slot of the pool, so it only has to be encoded the first time
+        data = self._segment_pool.get(seq_number)
+        if data is None:
+            data_to_send = self._data_array[seq_number]
+            flags = self._data_array.flags(seq_number) | self._segment_flags
+            partial = header_checksum(seq_number % SEQUENCE_NUMBER_SPACE, 0, flags, 0, len(data_to_send))
+            segment = Segment(seq_number % SEQUENCE_NUMBER_SPACE, 0, flags, 0, len(data_to_send),
+                              calculate_checksum(data_to_send, partial), data_to_send)
+            data = self._segment_pool.encode(seq_number, segment)
         self._lossy_layer.send_segment(data)
+        if self._pacer is not None:
+            self._pacer.Consume(len(data))
+
+        # keep track of time that packet was send and schedule its retransmission timer
+        slot = seq_number % self._window_size
+        send_time = time.monotonic()
+        self._timeout_array[slot] = send_time
+        self._send_order[seq_number] = send_time
+        self._send_order.move_to_end(seq_number)
+        self._transmissions[slot] += 1
+        if self._transmissions[slot] == 1:
+            self._fast_retransmitted[seq_number % SEQUENCE_NUMBER_SPACE] = 0
+        self._segments_sent += 1
+        self._bytes_sent += len(self._data_array[seq_number])
+        if self._transmissions[slot] > 1:
+            self._retransmissions += 1
+        heapq.heappush(self._timer_heap,
+                       (send_time + self.RetransmissionTimeout(), seq_number, self._transmissions[slot]))
+
+    # Return the time (s) after which a packet that was sent now is retransmitted if it was not acknowledged. When
+    # the round trip time is stable the timeout is hardly longer than the smoothed round trip time, so it is
+    # extended to beyond the loss delay: a packet that the ACKs of later packets show to be lost is fast
+    # retransmitted instead of waiting for a timeout that collapses the congestion window.
+    def RetransmissionTimeout(self):
+        timeout = self._rtt_estimator.GetTimeout() / 1000
+        if self._rtt_estimator.srtt is None:
+            return timeout
+        return max(timeout, self.LossDelay() + DELAYED_ACK_TIMEOUT / 1000)
+
+
+# Timer that calls callback from its own thread once delay seconds have passed after it was started. Starting an
+# armed timer does not move its deadline. A single thread is reused for all rounds, it is created on first use.
+class DelayedAckTimer:
+    def __init__(self, delay, callback):
+        self._delay = delay
+        self._callback = callback
+        self._condition = threading.Condition()
+        self._deadline = None
+        self._stopped = False
+        self._thread = None
+
+    # Arm the timer if it is not armed yet
+    def Start(self):
+        with self._condition:
+            if self._deadline is None and not self._stopped:
+                self._deadline = time.monotonic() + self._delay
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.Run, daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+
+    # Disarm the timer
+    def Cancel(self):
+        with self._condition:
+            self._deadline = None
+
+    # Disarm the timer and let its thread finish
+    def Stop(self):
+        with self._condition:
+            self._deadline = None
+            self._stopped = True
+            self._condition.notify()
+
+    def Run(self):
+        with self._condition:
+            while not self._stopped:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self._deadline = None
+                # the callback is called without holding the timer lock, it may start or cancel the timer again
+                self._condition.release()
+                try:
+                    self._callback()
+                finally:
+                    self._condition.acquire()
+
+
+# Return the XOR of the payloads as an integer, every payload padded at its end with zeros to size bytes
+def XorPayloads(payloads, size):
+    result = 0
+    for payload in payloads:
+        result ^= int.from_bytes(payload, 'big') << (8 * (size - len(payload)))
+    return result
+
+
+# Return the forward error correction mode fec (None, FEC_ADAPTIVE or a number of packets per parity packet, which
+# may be given as a string), or raise a ValueError when it is not valid for a window of window_size packets
+def ValidateForwardErrorCorrection(fec, window_size):
+    if fec is None or fec == FEC_ADAPTIVE:
+        return fec
+    try:
+        block_size = int(fec)
+    except ValueError:
+        raise ValueError("Forward error correction must be '{}' or a number of packets, not '{}'".format(
+            FEC_ADAPTIVE, fec))
+    if not 1 <= block_size <= min(window_size, MAX_VALUE_8_BIT_INTEGER):
+        raise ValueError("Forward error correction block size must be between 1 and {}: {}".format(
+            min(window_size, MAX_VALUE_8_BIT_INTEGER), block_size))
+    return block_size
+
+
+# Method that packs the (start, end) sequence number pairs of selective acknowledgement blocks into ACK payload bytes
+def PackSackBlocks(blocks):
+    sack_data = bytearray(len(blocks) * SACK_BLOCK_SIZE)
+    for x in range(len(blocks)):
+        SACK_BLOCK_STRUCT.pack_into(sack_data, x * SACK_BLOCK_SIZE, blocks[x][0], blocks[x][1])
+    return sack_data
+
+
+# Method that unpacks the selective acknowledgement blocks from the payload of an ACK
+def UnpackSackBlocks(sack_data):
+    return list(SACK_BLOCK_STRUCT.iter_unpack(sack_data[:len(sack_data) - len(sack_data) % SACK_BLOCK_SIZE]))
 
-        # keep track of time that packet was send to determine when a timeout occurs
-        self._timeout_array[seq_number] = time.time()
 
-        # state that packet was sent
-        self._sent_array[seq_number] = True
+# Method that returns whether the first of the selective acknowledgement blocks of an ACK reports a duplicate packet
+# (D-SACK, RFC 2883): it lies before the cumulative ack number, or inside one of the other blocks
+def IsDuplicateReport(blocks, ack_number):
+    if not blocks:
+        return False
+    (start, end) = blocks[0]
+    if (ack_number - end) % SEQUENCE_NUMBER_SPACE < SEQUENCE_NUMBER_SPACE // 2:
+        return True
+    for (block_start, block_end) in blocks[1:]:
+        if (start - block_start) % SEQUENCE_NUMBER_SPACE < (block_end - block_start) % SEQUENCE_NUMBER_SPACE:
+            return True
+    return False
 
 
 class SelectiveRepeaterReceiver:
-    def __init__(self, lossy_layer, window_size):
+    def __init__(self, lossy_layer, window_size, ack_every=DELAYED_ACK_SEGMENTS, ack_delay=DELAYED_ACK_TIMEOUT,
+                 buffer_size=RECEIVE_BUFFER_SIZE, timer_factory=DelayedAckTimer):
         self._window_size = window_size
         self._lossy_layer = lossy_layer
 
-        self._delivering = False
+        # number of bytes of in-order data that may wait for the application before the advertised window shrinks
+        self._buffer_size = buffer_size
 
-        # lower bound of window
+        # lower bound of window, i.e. the number of packets that were delivered in order. It only moves forward.
         self._rec_base = 0
 
-        # array that keeps track of the packets that were received
-        self._rec_array = []
-        for x in range(MAX_PACKET_SIZE):
-            self._rec_array.append(False)
-
-        # data that should be delivered to application layer
-        self._data_to_deliver = bytes()
-
-        # data buffer that keeps a hold of unordered segments
-        self._buffer = []
-        for x in range(MAX_PACKET_SIZE):
-            self._buffer.append(bytes())
-
-    # Deliver data to application layer
-    def DeliverData(self):
-        # don't do anything if data is currently being delivered (to _data_to_deliver) (mutual exclusion)
-        if not self._delivering:
-            # empty the data_to_deliver bytes and return the data
-            data = self._data_to_deliver
-            self._data_to_deliver = bytes()
-            return data
-        else:
-            return bytes()
+        # bitmap over the receive window that keeps track of the packets that were received. The packet with
+        # (unwrapped) sequence number x is kept in slot x % window_size.
+        self._rec_array = bytearray(window_size)
+
+        # data that should be delivered to application layer. The protocol thread puts data in, the application
+        # thread takes it out.
+        self._data_to_deliver = ByteQueue()
+
+        # ring of payload slots that keeps a hold of unordered segments
+        self._buffer = [None] * window_size
+
+        # Forward error correction: whether the sender adds parity packets, the (unwrapped) sequence number of the
+        # payload in every slot of the ring, and the parity packets of the blocks that still miss packets, by the
+        # first packet of the block: (end of the block, XOR of the payload lengths, XOR of the compressed flags,
+        # parity). With forward error correction a payload stays in the ring after it was delivered, so that a
+        # missing packet of its block can still be rebuilt. Packets that were rebuilt are marked by their (wrapped)
+        # sequence number, so that a retransmission of them is not reported as a duplicate: it was lost after all.
+        self._fec = False
+        self._buffer_owners = [None] * window_size
+        self._parity_blocks = {}
+        self._recovered = bytearray(SEQUENCE_NUMBER_SPACE)
+
+        # whether the payload in every slot of the ring is compressed, and the decompressor of the zlib stream of the
+        # sender when the sender compresses. Payloads are decompressed in order, when they are delivered.
+        self._compressed = bytearray(window_size)
+        self._decompressor = None
+
+        # largest payload of a segment, negotiated in the three-way handshake
+        self._max_segment_size = PAYLOAD_SIZE
+
+        # window that was advertised in the last ACK
+        self._advertised_window = self.AdvertisedWindow()
+
+        # buffer that every ACK is encoded into, it fits the header and the largest number of SACK blocks, and the
+        # flags every ACK is sent with besides ACK: HEADER_CHECKSUM_FLAG once the sender agreed to it
+        self._ack_buffer = bytearray(HEADER_SIZE + MAX_SACK_BLOCKS * SACK_BLOCK_SIZE)
+        self._ack_flags = 0
+
+        # Delayed ACKs: in-order packets are acknowledged every ack_every packets, or when ack_delay milliseconds
+        # have passed since the first packet that was not acknowledged yet. timer_factory(delay, callback) creates
+        # the timer, it must have the Start, Cancel and Stop methods of DelayedAckTimer.
+        self._ack_every = ack_every
+        self._pending_acks = 0
+        self._ack_timer = timer_factory(ack_delay / 1000, self.SendDelayedACK)
+
+        # lock that protects the receiver state against the delayed ACK timer
+        self._lock = threading.Lock()
+
+        # statistics counters, read with Stats
+        self._segments_received = 0
+        self._bytes_received = 0
+        self._bytes_delivered = 0
+        self._duplicates = 0
+        self._checksum_failures = 0
+        self._out_of_window = 0
+        self._acks_sent = 0
+        self._window_updates = 0
+        self._parity_segments_received = 0
+        self._recovered_packets = 0
+        self._compressed_segments = 0
+        # number of packets that arrived after a gap and wait in the ring for the gap to be filled
+        self._buffered_packets = 0
+
+    # Deliver data to application layer: all data that was received in order and not read yet. When there is none,
+    # wait up to timeout seconds for it (None waits until data arrives or the receiver is stopped).
+    def DeliverData(self, timeout=0):
+        data = self._data_to_deliver.get(timeout)
+        if data:
+            with self._lock:
+                self._bytes_delivered += len(data)
+            self.SendWindowUpdate()
+        return data
 
     def PutInDataToDeliver(self, data):
-        self._delivering = True
-        self._data_to_deliver += data
-        self._delivering = False
+        self._data_to_deliver.put(data)
+
+    # Block until there is data to deliver or the receiver is stopped. Returns False if neither happened within
+    # timeout seconds.
+    def WaitForData(self, timeout=None):
+        return self._data_to_deliver.wait(timeout)
+
+    # Method that sets the largest payload of a segment, e.g. from the three-way handshake
+    def SetMaximumSegmentSize(self, payload_size):
+        with self._lock:
+            self._max_segment_size = payload_size
+
+    # Method that tells the receiver whether the sender adds parity packets, e.g. from the three-way handshake
+    def SetForwardErrorCorrection(self, enabled):
+        with self._lock:
+            self._fec = enabled
+
+    # Method that tells the receiver whether the sender compresses its payloads, e.g. from the three-way handshake
+    def SetCompression(self, enabled):
+        with self._lock:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if enabled else None
+
+    # Method that tells the receiver whether the checksum of its ACKs covers their header, e.g. from the three-way
+    # handshake. Data segments are checked the way their flags say either way.
+    def SetHeaderChecksum(self, enabled):
+        with self._lock:
+            self._ack_flags = HEADER_CHECKSUM_FLAG if enabled else 0
+
+    # Return the number of packets the receiver can accept after the receive base: the window size, limited by the
+    # space that is left in the buffer of data that the application has not read yet
+    def AdvertisedWindow(self):
+        free_packets = max(0, self._buffer_size - len(self._data_to_deliver)) // self._max_segment_size
+        return min(free_packets, self._window_size, MAX_VALUE_8_BIT_INTEGER)
+
+    # Method that is called after the application read data. When the window that was advertised last was small,
+    # the sender is told right away that it may send again.
+    def SendWindowUpdate(self):
+        with self._lock:
+            full_window = min(self._window_size, MAX_VALUE_8_BIT_INTEGER)
+            if self._advertised_window < full_window // 2 and self.AdvertisedWindow() > self._advertised_window:
+                self._window_updates += 1
+                self.SendACK()
+
+    # Method that returns the distance of a (wrapped) sequence number from the receive base
+    def WindowOffset(self, seq_number):
+        return (seq_number - self._rec_base) % SEQUENCE_NUMBER_SPACE
 
     # method that tests whether a package has not been received yet. i.e. handling duplicate packats
-    def NotYetReceived(self, index):
-        return self._rec_array[index] == False
+    def NotYetReceived(self, offset):
+        return offset < self._window_size and not self._rec_array[(self._rec_base + offset) % self._window_size]
+
+    # Return the statistics counters of the receiver and the occupancy of its window and buffer
+    def Stats(self):
+        with self._lock:
+            return {
+                'segments_received': self._segments_received,
+                'bytes_received': self._bytes_received,
+                'bytes_delivered': self._bytes_delivered,
+                'duplicates': self._duplicates,
+                'checksum_failures': self._checksum_failures,
+                'out_of_window': self._out_of_window,
+                'acks_sent': self._acks_sent,
+                'window_updates': self._window_updates,
+                'parity_segments_received': self._parity_segments_received,
+                'recovered_packets': self._recovered_packets,
+                'compressed_segments': self._compressed_segments,
+                'buffered_packets': self._buffered_packets,
+                'undelivered_bytes': len(self._data_to_deliver),
+                'advertised_window': self._advertised_window,
+                'max_segment_size': self._max_segment_size,
+            }
+
+    # Method that is called when a packet (without any flag, or a parity packet) is received
+    def ReceivePacket(self, segment):
+        if segment.parity:
+            self.ReceiveParityPacket(segment)
+            return
+        seq_number = segment.seq_number
+        data_length = segment.data_length
+        data = segment.data
 
-    # Method that is called when a packet (without any flag) is received
-    def ReceivePacket(self, seg_info):
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
+        offset = self.WindowOffset(seq_number)
+        # packets that were already delivered lie just before the window, their ACK was lost so it is sent again
+        already_delivered = offset >= SEQUENCE_NUMBER_SPACE - self._window_size
 
         # now we verify the checksum and check whether the packet can be received
-        if checksum == calculate_checksum(data) and (seq_number - self._rec_base) < self._window_size:
-            # We ONLY do something with the data if we haven't yet received the packet.
-            # i.e. when we receive the packet for the first time
-            if self.NotYetReceived(seq_number):
-                # Mark that the packet with sequence number has been received
-                self._rec_array[seq_number] = True
-
-                # Send ACK back to the sender
-                self.SendACK(seq_number)
-
-                # Now we update the _rec_base variable because a new packet was received
-                index = 0
-                for x in self._rec_array:
-                    if not x:
-                        break
-                    index += 1
-                self._rec_base = index
-
-                # temporarily store data in buffer
-                unpadded_data = data[:data_length]
-                self._buffer[seq_number] = unpadded_data
-
-                # Collect all the data that is ordered so that it can be delivered to the application layer
-                # Note that when data is not ordered it remains in the buffer
-                data = bytes()
-                for x in range(index):
-                    data += self._buffer[x]
-                    self._buffer[x] = bytes()
-
-                self.PutInDataToDeliver(data)
+        valid = segment.checksum == calculate_checksum(data, segment.header_checksum)
+        if valid and (offset < self._window_size or already_delivered):
+            with self._lock:
+                self._segments_received += 1
+                self._bytes_received += data_length
+                # We ONLY do something with the data if we haven't yet received the packet.
+                # i.e. when we receive the packet for the first time
+                if self.NotYetReceived(offset):
+                    # the segment may be a view into a buffer of the lossy layer that is reused, so the data is copied
+                    self._recovered[seq_number] = 0
+                    self.StorePacket(offset, bytes(data[:data_length]), segment.compressed)
+                    if self._parity_blocks:
+                        self.RecoverPackets()
+                else:
+                    # otherwise we only resent the ACK, which reports the duplicate, unless the packet was rebuilt
+                    # from a parity packet and this is its retransmission
+                    self._duplicates += 1
+                    self.SendACK(None if self._recovered[seq_number] else seq_number)
+        else:
+            with self._lock:
+                if not valid:
+                    self._checksum_failures += 1
+                else:
+                    self._out_of_window += 1
+            logger.debug("error detected: ignoring packet %d", seq_number)
+
+    # Method that stores the payload of the packet at offset from the receive base, delivers the data that is in
+    # order now and acknowledges the packet. It must be called with the lock held.
+    def StorePacket(self, offset, payload, compressed):
+        # temporarily store data in the slot of the packet and mark that it has been received
+        slot = (self._rec_base + offset) % self._window_size
+        self._buffer[slot] = payload
+        self._buffer_owners[slot] = self._rec_base + offset
+        self._compressed[slot] = compressed
+        self._rec_array[slot] = 1
+        self._buffered_packets += 1
+
+        # Collect all the data that is ordered so that it can be delivered to the application layer and
+        # move the _rec_base forward past it. Note that when data is not ordered it remains in the buffer
+        data = bytearray()
+        delivered = 0
+        slot = self._rec_base % self._window_size
+        while self._rec_array[slot]:
+            if self._compressed[slot]:
+                self._compressed_segments += 1
+                data += self._decompressor.decompress(self._buffer[slot])
             else:
-                # otherwise we only resent the ACK
-                self.SendACK(seq_number)
+                data += self._buffer[slot]
+            delivered += 1
+            if not self._fec:
+                self._buffer[slot] = None
+            self._rec_array[slot] = 0
+            self._buffered_packets -= 1
+            self._rec_base += 1
+            slot = self._rec_base % self._window_size
+
+        if data:
+            self.PutInDataToDeliver(data)
+
+        # Send ACK back to the sender, only after the data has been handed over so that an acknowledged
+        # packet is always available to the application. A packet that arrived in order while no other
+        # packets are buffered may be acknowledged later together with the next ones, any other packet
+        # (a gap, or one that fills a gap) is acknowledged right away.
+        self._pending_acks += 1
+        in_order = offset == 0 and delivered == 1 and self._rec_array.find(1) < 0
+        if not in_order or self._pending_acks >= self._ack_every:
+            self.SendACK()
         else:
-            print("error detected: ignoring packet", self.NotYetReceived(seq_number), (seq_number - self._rec_base) < self._window_size)
+            self._ack_timer.Start()
 
-    # Method that sends a ACK to the sender
-    def SendACK(self, seq_number):
-        ack_syn_fin = flags_to_binary(True, False, False)
-        segment = Segment(0, seq_number, ack_syn_fin, 0, 0, 0, None)
-        data = segment.create_segment()
+    # Method that is called when a parity packet is received. Its block is kept until it misses no packets anymore,
+    # a single missing packet is rebuilt right away.
+    def ReceiveParityPacket(self, segment):
+        data = segment.data
+        if segment.checksum != calculate_checksum(data, segment.header_checksum):
+            with self._lock:
+                self._checksum_failures += 1
+            return
+        with self._lock:
+            self._parity_segments_received += 1
+            offset = self.WindowOffset(segment.seq_number)
+            if offset < self._window_size:
+                start = self._rec_base + offset
+            elif offset >= SEQUENCE_NUMBER_SPACE - self._window_size:
+                start = self._rec_base + offset - SEQUENCE_NUMBER_SPACE
+            else:
+                self._out_of_window += 1
+                return
+            end = start + segment.window
+            if end - self._rec_base > self._window_size:
+                # the sender never has packets beyond the window in flight
+                self._out_of_window += 1
+            elif end > self._rec_base:
+                self._parity_blocks[start] = (end, segment.ack_number, segment.compressed,
+                                              bytes(data[:segment.data_length]))
+                self.RecoverPackets()
+
+    # Method that rebuilds the packet that a block misses when it misses only one. Blocks that miss no packets
+    # anymore are dropped. It must be called with the lock held.
+    def RecoverPackets(self):
+        for (start, (end, lengths, compressed, parity)) in list(self._parity_blocks.items()):
+            missing = self.MissingPackets(start, end)
+            if len(missing) > 1:
+                continue
+            del self._parity_blocks[start]
+            if missing:
+                self.RecoverPacket(start, end, lengths, compressed, parity, missing[0])
+
+    # Return the (unwrapped) sequence numbers of the packets in [start, end) that were not received, but no more
+    # than two of them
+    def MissingPackets(self, start, end):
+        missing = []
+        for seq_number in range(max(start, self._rec_base), end):
+            if not self._rec_array[seq_number % self._window_size]:
+                missing.append(seq_number)
+                if len(missing) > 1:
+                    break
+        return missing
+
+    # Method that rebuilds the packet missing of the block [start, end): the XOR of the parity and the payloads of
+    # the other packets of the block. A payload of the block that was delivered and then overwritten by a later
+    # packet in its slot makes that impossible, the packet is then left to be retransmitted.
+    def RecoverPacket(self, start, end, lengths, compressed, parity, missing):
+        payloads = []
+        for seq_number in range(start, end):
+            if seq_number == missing:
+                continue
+            slot = seq_number % self._window_size
+            if self._buffer_owners[slot] != seq_number or self._buffer[slot] is None:
+                return
+            payloads.append(self._buffer[slot])
+            lengths ^= len(self._buffer[slot])
+            compressed ^= self._compressed[slot]
+        if lengths > len(parity):
+            return
+        payload = XorPayloads(payloads, len(parity)) ^ int.from_bytes(parity, 'big')
+        self._recovered_packets += 1
+        self._recovered[missing % SEQUENCE_NUMBER_SPACE] = 1
+        self.StorePacket(missing - self._rec_base, payload.to_bytes(len(parity), 'big')[:lengths], compressed)
+
+    # Method that is called by the delayed ACK timer
+    def SendDelayedACK(self):
+        with self._lock:
+            if self._pending_acks > 0:
+                self.SendACK()
+
+    # Method that returns the offset from the receive base of the first slot at or after offset whose bitmap value
+    # is value, or None if there is none in the window
+    def FindInWindow(self, value, offset):
+        base_slot = self._rec_base % self._window_size
+        start_slot = (base_slot + offset) % self._window_size
+        if start_slot >= base_slot:
+            index = self._rec_array.find(value, start_slot, self._window_size)
+            if index >= 0:
+                return offset + index - start_slot
+            index = self._rec_array.find(value, 0, base_slot)
+            if index >= 0:
+                return offset + self._window_size - start_slot + index
+        else:
+            index = self._rec_array.find(value, start_slot, base_slot)
+            if index >= 0:
+                return offset + index - start_slot
+        return None
+
+    # Method that returns the (start, end) sequence numbers of the blocks of packets that were received after a gap,
+    # end is the first sequence number after the block
+    def SackBlocks(self):
+        blocks = []
+        # the slot at the receive base is always empty, otherwise the base would have moved forward
+        offset = 1
+        while offset < self._window_size and len(blocks) < MAX_SACK_BLOCKS:
+            start = self.FindInWindow(1, offset)
+            if start is None:
+                break
+            end = self.FindInWindow(0, start)
+            if end is None:
+                end = self._window_size
+            blocks.append(((self._rec_base + start) % SEQUENCE_NUMBER_SPACE,
+                           (self._rec_base + end) % SEQUENCE_NUMBER_SPACE))
+            offset = end
+        return blocks
+
+    # Method that sends a cumulative ACK to the sender: the ack number is the sequence number of the next packet
+    # that is expected, the payload holds the selective acknowledgement blocks of the packets after a gap. When the
+    # ACK answers a duplicate packet, the first block reports its sequence number (D-SACK, RFC 2883).
+    def SendACK(self, duplicate=None):
+        self._pending_acks = 0
+        self._ack_timer.Cancel()
+        blocks = self.SackBlocks()
+        if duplicate is not None:
+            blocks = [(duplicate, (duplicate + 1) % SEQUENCE_NUMBER_SPACE)] + blocks[:MAX_SACK_BLOCKS - 1]
+        sack_data = PackSackBlocks(blocks)
+        self._advertised_window = self.AdvertisedWindow()
+        ack_syn_fin = flags_to_binary(True, False, False) | self._ack_flags
+        partial = header_checksum(0, self._rec_base % SEQUENCE_NUMBER_SPACE, ack_syn_fin, self._advertised_window,
+                                  len(sack_data))
+        segment = Segment(0, self._rec_base % SEQUENCE_NUMBER_SPACE, ack_syn_fin, self._advertised_window,
+                          len(sack_data), calculate_checksum(sack_data, partial), sack_data)
+        data = segment.create_segment_into(self._ack_buffer)
+        self._acks_sent += 1
         self._lossy_layer.send_segment(data)
+
+    # Method that stops the delayed ACK timer and wakes up an application that waits for data
+    def Stop(self):
+        self._ack_timer.Stop()
+        self._data_to_deliver.close()
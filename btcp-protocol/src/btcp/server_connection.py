@@ -0,0 +1,161 @@
+import logging
+import random
+from btcp.btcp_segment import *
+from btcp.framing import MessageParser
+from btcp.selective_repeat import *
+
+logger = logging.getLogger(__name__)
+
+
+# One connection of a BTCPServerSocket with a client. The server socket demultiplexes the incoming segments by the
+# address of the client and hands them to the connection, which runs its own three-way handshake and selective
+# repeat receiver. The connection ID is the initial sequence number of the client, a SYN with another ID from the
+# same address starts a new connection. The receiver keeps up to buffer_size bytes of data that the application did not
+# read yet, after which it advertises a zero window.
+class BTCPServerConnection:
+    def __init__(self, lossy_layer, address, connection_id, window, timer_factory=DelayedAckTimer,
+                 buffer_size=RECEIVE_BUFFER_SIZE):
+        self._lossy_layer = lossy_layer
+        self._address = address
+        self._connection_id = connection_id
+
+        # Boolean variable that determines whether the three-way handshake was completed
+        self._connected = False
+
+        # Boolean variable that determines whether the client terminated the connection
+        self._finished = False
+
+        # Sequence number of the client and of the server that are send during the three-way handshake
+        self._x_value = connection_id
+        self._y_value = random.randrange(SEQUENCE_NUMBER_SPACE)
+
+        # largest payload of a segment, the smallest of what the client announced in its SYN and what the path to
+        # the client allows
+        self._max_segment_size = PAYLOAD_SIZE
+
+        # optional features (FEATURE_*) that the client asked for in its SYN and the server supports
+        self._features = 0
+
+        # Selective repeater, its ACKs are sent to the client of this connection
+        self._selective_repeater = SelectiveRepeaterReceiver(self, window, buffer_size=buffer_size,
+                                                             timer_factory=timer_factory)
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def connection_id(self):
+        return self._connection_id
+
+    def is_connected(self):
+        return self._connected
+
+    def is_finished(self):
+        return self._finished
+
+    # Put a segment into the network, addressed to the client of this connection
+    def send_segment(self, segment):
+        self._lossy_layer.send_segment(segment, self._address)
+
+    # Method that agrees on the largest payload of a segment with the client, given the size announced in its SYN
+    def negotiate_segment_size(self, client_payload_size):
+        self._max_segment_size = min(self._lossy_layer.path_payload_size(self._address), client_payload_size)
+        self._selective_repeater.SetMaximumSegmentSize(self._max_segment_size)
+
+    # Method that agrees to the optional features the client asked for in its SYN, as far as they are supported
+    def negotiate_features(self, client_features):
+        self._features = client_features & SUPPORTED_FEATURES
+        self._selective_repeater.SetForwardErrorCorrection(bool(self._features & FEATURE_FEC))
+        self._selective_repeater.SetCompression(bool(self._features & FEATURE_COMPRESSION))
+        self._selective_repeater.SetHeaderChecksum(bool(self._features & FEATURE_HEADER_CHECKSUM))
+
+    # Step 2 of the three-way handshake, also used to answer a retransmitted SYN. The SYN-ACK carries the largest
+    # payload size the path to the client allows and the features the server agreed to. Once the header checksum is
+    # agreed to, the checksum of the SYN-ACK already covers its header: the client asked for it, so it understands it.
+    def send_syn_ack(self):
+        ack_syn_fin = flags_to_binary(True, True, False)
+        if self._features & FEATURE_HEADER_CHECKSUM:
+            ack_syn_fin |= HEADER_CHECKSUM_FLAG
+        option = pack_mss_option(self._lossy_layer.path_payload_size(self._address), self._features)
+        ack_number = (self._x_value + 1) % SEQUENCE_NUMBER_SPACE
+        window = self._selective_repeater.AdvertisedWindow()
+        partial = header_checksum(self._y_value, ack_number, ack_syn_fin, window, len(option))
+        segment = Segment(self._y_value, ack_number, ack_syn_fin, window, len(option),
+                          calculate_checksum(option, partial), option)
+        self.send_segment(segment.create_segment())
+
+    # Step 3 of the three-way handshake. Returns True when this ACK established the connection.
+    def acknowledge(self, ack_number):
+        if self._connected:
+            return False
+        if ack_number != (self._y_value + 1) % SEQUENCE_NUMBER_SPACE:
+            logger.warning("acknowledgement number incorrect: %d, expected %d", ack_number,
+                           (self._y_value + 1) % SEQUENCE_NUMBER_SPACE)
+            return False
+        self._connected = True
+        return True
+
+    # Method that is called when a data packet of this connection arrives. Returns True when the packet established
+    # the connection, which happens when the ACK of the handshake was lost but the client already started sending.
+    def receive_packet(self, segment):
+        established = False
+        if not self._connected and not self._finished:
+            self._connected = True
+            established = True
+        if self._connected:
+            self._selective_repeater.ReceivePacket(segment)
+        return established
+
+    # Second step of termination handshake
+    def finish(self):
+        self._connected = False
+        self._finished = True
+        self._selective_repeater.Stop()
+
+    # Return the statistics counters of the connection and its receiver, labelled with the client address
+    def stats(self):
+        return {
+            'address': '{}:{}'.format(*self._address),
+            'connection_id': str(self._connection_id),
+            'connected': self._connected,
+            'max_segment_size': self._max_segment_size,
+            'fec': bool(self._features & FEATURE_FEC),
+            'compression': bool(self._features & FEATURE_COMPRESSION),
+            'header_checksum': bool(self._features & FEATURE_HEADER_CHECKSUM),
+            'receiver': self._selective_repeater.Stats(),
+        }
+
+    # Return the data that was received in order since the last call. When there is none, wait up to timeout seconds
+    # for it (None waits until data arrives or the connection ends).
+    def DeliverData(self, timeout=0):
+        return self._selective_repeater.DeliverData(timeout)
+
+    # Send any incoming data to the application layer
+    def recv(self, output):
+        # Wait for data to be delivered, or for the connection to end
+        data = self._selective_repeater.DeliverData(None)
+
+        # Write bytes to file with path "output"
+        f = open(output, 'wb')
+        f.write(data)
+        f.close()
+        print("Data Received")
+
+    # Generator of the framed messages the client sends with send_messages: every Message (name and data) is yielded
+    # as soon as all of it arrived, until the client terminates the connection
+    def messages(self):
+        parser = MessageParser()
+        data = self.DeliverData(None)
+        while data:
+            yield from parser.feed(data)
+            data = self.DeliverData(None)
+        if parser.incomplete():
+            logger.warning("connection with %s ended in the middle of a message", self._address)
+
+    # Clean up any state. The connection counts as finished, so that a reader that waits for its data (when the
+    # connection is replaced by a new one of the same client or the server is cleaned) gets the end of the data.
+    def close(self):
+        self._connected = False
+        self._finished = True
+        self._selective_repeater.Stop()
@@ -1,100 +1,194 @@
-import socket
-import random
+import logging
+import queue
+import threading
 from btcp.lossy_layer import LossyLayer
 from btcp.btcp_socket import BTCPSocket
 from btcp.btcp_segment import *
-from btcp.selective_repeat import *
+from btcp.server_connection import BTCPServerConnection
+
+logger = logging.getLogger(__name__)
 
 
 # The bTCP server socket
-# A server application makes use of the services provided by bTCP by calling accept, recv, and close
+# A server application makes use of the services provided by bTCP by calling accept, recv, and close.
+# The socket serves many clients at once: every client gets its own BTCPServerConnection, keyed by its address.
+# Established connections are put in an accept queue, accept_connection returns them one by one and recv uses the
+# next one when it has no connection yet.
 class BTCPServerSocket(BTCPSocket):
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout, network=None, buffer_size=RECEIVE_BUFFER_SIZE):
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
-
-        # Boolean variable that determines whether the server has a connection to the client
-        self._connected_to_client = False
+        # an EmulatedNetwork to send the segments through instead of a UDP socket
+        self._network = network
+        # number of bytes every connection keeps for the application before it advertises a zero window
+        self._buffer_size = buffer_size
+        self._lossy_layer = self.create_lossy_layer()
 
         # Boolean variable that is true when the server is listening for the clients initiation of the three-way handshake
         self._listening = False
 
-        # Global variables that keep track of the sequence and the acknowledgement number that are send during
-        # the three-way handshake
-        self._x_value = 0
-        self._y_value = 0
+        # Connection table: the connection with each client address (that did not terminate yet)
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+
+        # Connections that completed the three-way handshake and were not accepted by the application yet
+        self._accept_queue = queue.Queue()
+
+        # Connection that recv reads from
+        self._connection = None
 
-        # Selective repeater
-        self._selective_repeater = SelectiveRepeaterReceiver(self._lossy_layer, self._window)
+        # statistics counters, read with stats
+        self._segments_received = 0
+        self._bytes_received = 0
+        self._unknown_segments = 0
+        self._connections_accepted = 0
+        self._connections_rejected = 0
+        self._connections_finished = 0
+
+    # Create the lossy layer the socket sends and receives segments with
+    def create_lossy_layer(self):
+        if self._network is not None:
+            return self._network.create_lossy_layer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        return LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+
+    # Create the connection with the client at address
+    def create_connection(self, address, connection_id):
+        return BTCPServerConnection(self._lossy_layer, address, connection_id, self._window,
+                                    buffer_size=self._buffer_size)
 
     # Called by the lossy layer from another thread whenever a segment arrives
     def lossy_layer_input(self, rec_data):
-        (header, packet) = rec_data
-        seg_info = unpack_segment(header)
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
+        (header, address) = rec_data
+        self._segments_received += 1
+        self._bytes_received += len(header)
+        segment = unpack_segment(header)
+        (ack, syn, fin) = segment.flags
+        with self._connections_lock:
+            connection = self._connections.get(address)
+        # the checksum does not cover the flags: a data segment whose flags were damaged into a SYN or a FIN must not
+        # replace or end the connection, which would stall a long-lived connection. A SYN carries no more than its
+        # options and a FIN no data.
         if syn and not ack and not fin:
-            if self._listening:
-                self.accept_syn_packet(seg_info)
+            if self._listening and segment.data_length <= MSS_OPTION_SIZE + FEATURES_SIZE:
+                self.accept_syn_packet(segment, address, connection)
         if not syn and ack and not fin:
-            if ack_number != self._y_value+1:
-                print("acknowledgement number incorrect:", ack_number, self._y_value+1)
-            else:
+            if connection is None:
+                self._unknown_segments += 1
+            elif connection.acknowledge(segment.ack_number):
                 print("connected to client.")
-                self._connected_to_client = True
-                self._listening = False
-        if not syn and not ack and fin:
-            self.finish_client()
+                self._connections_accepted += 1
+                self._accept_queue.put(connection)
+        if not syn and not ack and fin and segment.data_length == 0:
+            # a client that agreed to the header checksum sends a FIN that covers its header, a client of the first
+            # wire format sends every FIN with sequence number 0
+            if segment.extended and segment.checksum != calculate_checksum(segment.data, segment.header_checksum):
+                self._unknown_segments += 1
+            elif connection is None or segment.seq_number in (0, connection.connection_id):
+                self.finish_client(address, connection, segment)
         if not syn and not ack and not fin:
-            self._selective_repeater.ReceivePacket(seg_info)
+            if connection is None:
+                self._unknown_segments += 1
+            elif connection.receive_packet(segment):
+                print("connected to client.")
+                self._connections_accepted += 1
+                self._accept_queue.put(connection)
 
     # Wait for the client to initiate a three-way handshake
     def accept(self):
         self._listening = True
 
+    # Return the next connection that completed the three-way handshake, or None if there is none within timeout
+    # seconds (None waits forever). The server starts listening if it was not yet.
+    def accept_connection(self, timeout=None):
+        self._listening = True
+        try:
+            return self._accept_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Return the statistics counters of the socket and of every connection in the connection table
+    def stats(self):
+        connections = self.connections()
+        stats = {
+            'segments_received': self._segments_received,
+            'bytes_received': self._bytes_received,
+            'unknown_segments': self._unknown_segments,
+            'connections_accepted': self._connections_accepted,
+            'connections_rejected': self._connections_rejected,
+            'connections_finished': self._connections_finished,
+            'active_connections': len(connections),
+            'connections': [connection.stats() for connection in connections],
+        }
+        if hasattr(self._lossy_layer, 'batch_stats'):
+            stats['lossy_layer'] = self._lossy_layer.batch_stats()
+        return stats
+
+    # Return the connections that are currently in the connection table
+    def connections(self):
+        with self._connections_lock:
+            return list(self._connections.values())
+
     # accept a packet from the client with the syn flag and do the server part of the three-way handshake
-    def accept_syn_packet(self, seg_info):
-        (seq_number, ack_number, (ack, syn, fin), window, data_length, checksum, data) = seg_info
-        self._x_value = seq_number
-        self._y_value = random.randint(0, MAX_VALUE_16_BIT_INTEGER + 1)
-        ack_syn_fin = flags_to_binary(True, True, False)
-        segment = Segment(self._y_value, self._x_value + 1, ack_syn_fin, self._window, 0, 0, None)
-        data = segment.create_segment()
-        self._lossy_layer.send_segment(data)
+    def accept_syn_packet(self, syn, address, connection):
+        seq_number = syn.seq_number
+        if connection is None or connection.connection_id != seq_number:
+            # new client, or a new connection of a client whose previous connection was not terminated
+            with self._connections_lock:
+                if connection is None and len(self._connections) >= MAX_SERVER_CONNECTIONS:
+                    logger.warning("connection table full: ignoring SYN from %s", address)
+                    self._connections_rejected += 1
+                    return
+                if connection is not None:
+                    connection.close()
+                connection = self.create_connection(address, seq_number)
+                self._connections[address] = connection
+            connection.negotiate_segment_size(unpack_mss_option(syn))
+            connection.negotiate_features(unpack_features(syn))
+        # a retransmitted SYN is answered with the same SYN-ACK
+        connection.send_syn_ack()
 
-    # Second step of termination handshake
-    def finish_client(self):
+    # Second step of termination handshake. The FIN-ACK acknowledges the sequence number of the FIN and covers its
+    # header when the FIN did, so the client can tell it from a damaged segment. This does not depend on the
+    # connection, which is gone when the FIN-ACK was lost and the client sends its FIN again.
+    def finish_client(self, address, connection, fin):
         ack_syn_fin = flags_to_binary(True, False, True)
-        segment = Segment(0, 0, ack_syn_fin, 0, 0, 0, None)
+        if fin.extended:
+            ack_syn_fin |= HEADER_CHECKSUM_FLAG
+        ack_number = (fin.seq_number + 1) % SEQUENCE_NUMBER_SPACE
+        segment = Segment(0, ack_number, ack_syn_fin, 0, 0,
+                          calculate_checksum(b'', header_checksum(0, ack_number, ack_syn_fin, 0, 0)), None)
         data = segment.create_segment()
-        self._lossy_layer.send_segment(data)
-        self._connected_to_client = False
-        print("disconnected to client")
+        self._lossy_layer.send_segment(data, address)
+        if connection is not None:
+            with self._connections_lock:
+                if self._connections.get(address) is connection:
+                    del self._connections[address]
+            connection.finish()
+            self._connections_finished += 1
+            print("disconnected to client")
 
     # Send any incoming data to the application layer
     def recv(self, output):
-        data = bytes()
-        collected_data = bytes()
-
-        # Wait for data to be delivered
-        while len(data) == 0:
-            data = self._selective_repeater.DeliverData()
+        if self._connection is None:
+            self._connection = self.accept_connection()
+        self._connection.recv(output)
 
-        # Write bytes to file with path "output"
-        f = open(output, 'wb')
-        f.write(data)
-        f.close()
-        print("Data Received")
+    # Generator of the messages that the client sends over the connection, see BTCPServerConnection.messages
+    def messages(self):
+        if self._connection is None:
+            self._connection = self.accept_connection()
+        yield from self._connection.messages()
 
     def clean(self):
         self._listening = False
-        self._x_value = 0
-        self._y_value = 0
-        self._selective_repeater = SelectiveRepeaterReceiver(self._lossy_layer, self._window)
+        self._connection = None
+        with self._connections_lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections = {}
+        self._accept_queue = queue.Queue()
 
     # Clean up any state
     def close(self):
-        self._listening = False
+        self.clean()
         self._lossy_layer.destroy()
-        self._x_value = 0
-        self._y_value = 0
         #self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
@@ -0,0 +1,297 @@
+import logging
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+from btcp.client_socket import BTCPClientSocket
+from btcp.constants import *
+
+logger = logging.getLogger(__name__)
+
+# Precompiled format of the header that is sent before every range: the size of the file, the offset of the range in
+# the file and the stripe that sends it
+STRIPE_HEADER_STRUCT = struct.Struct(STRIPE_HEADER_FORMAT)
+
+
+# Return the ranges (offset, length) a file of size bytes is split in for the given number of stripes. There are
+# STRIPE_RANGES_PER_STRIPE ranges per stripe, so a stripe that is faster than the others takes over some of their
+# work, but no range is smaller than STRIPE_MIN_RANGE_SIZE. An empty file is one empty range, so that the receiver
+# still learns its size.
+def split_ranges(size, stripes):
+    range_size = max(STRIPE_MIN_RANGE_SIZE, -(-size // (stripes * STRIPE_RANGES_PER_STRIPE)))
+    return [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)] or [(0, 0)]
+
+
+# Return the index of the next range that is not taken by a stripe yet, counter is a shared multiprocessing.Value
+def take_range(counter):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    return index
+
+
+# Send the ranges of the file at path that are not taken yet over one connection, until there are none left, and put
+# the measurements of the stripe in results. Every range is a transfer of its own: the connection is set up, the
+# header and the range are sent and the connection is terminated again. When the stripe fails, the index of the
+# range it was sending is reported in the measurements, so that another stripe can send it again. Runs in a thread or
+# in a worker process.
+def run_stripe(stripe, port, path, ranges, counter, results, window, timeout, network, options):
+    measurements = {
+        'stripe': stripe,
+        'port': port,
+        'ranges': 0,
+        'bytes': 0,
+        'seconds': 0.0,
+        'segments_sent': 0,
+        'retransmissions': 0,
+        'error': None,
+        'failed_ranges': [],
+    }
+    client = None
+    index = None
+    try:
+        client = BTCPClientSocket(window, timeout, port=port, network=network, **options)
+        size = os.path.getsize(path)
+        index = take_range(counter)
+        while index < len(ranges):
+            (offset, length) = ranges[index]
+            start = time.monotonic()
+            # like a single connection, the range is sent even when the handshake timed out: its first packet then
+            # establishes the connection at the server
+            client.connect()
+            client.send(path, offset, length, STRIPE_HEADER_STRUCT.pack(size, offset, stripe))
+            sender = client.stats()['sender']
+            client.disconnect()
+            client.clean()
+            measurements['seconds'] += time.monotonic() - start
+            measurements['ranges'] += 1
+            measurements['bytes'] += length
+            measurements['segments_sent'] += sender['segments_sent']
+            measurements['retransmissions'] += sender['retransmissions']
+            index = take_range(counter)
+    except Exception as error:
+        logger.warning("stripe %d failed: %s", stripe, error)
+        measurements['error'] = str(error)
+        if index is not None and index < len(ranges):
+            measurements['failed_ranges'].append(index)
+    finally:
+        if client is not None:
+            client.close()
+        results.put(measurements)
+
+
+# Return the goodput in Mb/s of size bytes that took seconds
+def goodput_mbps(size, seconds):
+    return size * 8 / seconds / 1e6 if seconds > 0 else 0.0
+
+
+# Client side of a striped transfer. A file is split in ranges that are sent over a number of parallel connections,
+# the stripes, from the ports base_port, base_port + 1, ... . A stripe takes the next range whenever it finished one,
+# so the work is balanced between the stripes. Every range is preceded by a header with its offset, the
+# StripedReceiver of the server writes it there in the output file.
+# The stripes run in threads, or with processes each in a worker process of its own so that they do not share a CPU.
+# Worker processes send over UDP, an emulated network can only be used by threads. The other options (such as
+# congestion_control, pacing, fec and compression) are passed on to the BTCPClientSocket of every stripe.
+class StripedClient:
+    def __init__(self, window, timeout, stripes=DEFAULT_STRIPES, base_port=CLIENT_PORT, network=None,
+                 processes=False, **options):
+        if stripes < 1:
+            raise ValueError("Number of stripes must be positive: {}".format(stripes))
+        if processes and network is not None:
+            raise ValueError("An emulated network can not be used by worker processes")
+        self._window = window
+        self._timeout = timeout
+        self._stripes = stripes
+        self._base_port = base_port
+        self._network = network
+        self._processes = processes
+        self._options = options
+
+        # measurements of the last transfer, read with stats
+        self._stripe_stats = []
+        self._size = 0
+        self._seconds = 0.0
+
+    # Send the file with path in a reliable way to the server, split over the stripes. The ranges of a stripe that
+    # fails are sent again by the stripes that are left. Raises ConnectionError when all stripes failed before all
+    # ranges were sent.
+    def send(self, path):
+        size = os.path.getsize(path)
+        ranges = split_ranges(size, self._stripes)
+        stripes = list(range(min(self._stripes, len(ranges))))
+        stripe_stats = {}
+        errors = []
+        # indices of the ranges that still have to be sent
+        remaining = list(range(len(ranges)))
+        start = time.monotonic()
+        while remaining:
+            if not stripes:
+                self._seconds = time.monotonic() - start
+                self._stripe_stats = sorted(stripe_stats.values(), key=lambda measurements: measurements['stripe'])
+                raise ConnectionError("Striped transfer of {} failed, {} of {} ranges were not sent: {}".format(
+                    path, len(remaining), len(ranges), "; ".join(errors)))
+            (round_stats, taken) = self.send_ranges(path, stripes, [ranges[index] for index in remaining])
+            unsent = remaining[taken:]
+            for measurements in round_stats:
+                unsent += [remaining[index] for index in measurements.pop('failed_ranges')]
+                if measurements['error'] is not None:
+                    errors.append("stripe {}: {}".format(measurements['stripe'], measurements['error']))
+                    stripes.remove(measurements['stripe'])
+                total = stripe_stats.setdefault(measurements['stripe'], dict(measurements, ranges=0, bytes=0,
+                                                                             seconds=0.0, segments_sent=0,
+                                                                             retransmissions=0))
+                for field in ('ranges', 'bytes', 'seconds', 'segments_sent', 'retransmissions'):
+                    total[field] += measurements[field]
+                total['error'] = measurements['error']
+            remaining = sorted(unsent)
+
+        self._seconds = time.monotonic() - start
+        self._size = sum(measurements['bytes'] for measurements in stripe_stats.values())
+        self._stripe_stats = sorted(stripe_stats.values(), key=lambda measurements: measurements['stripe'])
+
+    # Send the ranges over the given stripes, every stripe takes the next range whenever it finished one. Returns the
+    # measurements of the stripes and the number of ranges that were taken: those after it were not sent because
+    # all stripes failed.
+    def send_ranges(self, path, stripes, ranges):
+        counter = multiprocessing.Value('q', 0)
+        if self._processes:
+            (results, worker) = (multiprocessing.Queue(), multiprocessing.Process)
+        else:
+            (results, worker) = (queue.Queue(), threading.Thread)
+        workers = []
+        for stripe in stripes[:len(ranges)]:
+            workers.append(worker(target=run_stripe, daemon=True,
+                                  args=(stripe, self._base_port + stripe, path, ranges, counter, results,
+                                        self._window, self._timeout, self._network, self._options)))
+            workers[-1].start()
+        # the results are taken before the workers are joined, a worker process only exits once its result is read
+        stripe_stats = [results.get() for _ in workers]
+        for w in workers:
+            w.join()
+        return stripe_stats, min(counter.value, len(ranges))
+
+    # Return the measurements of the last transfer: its size, duration and goodput and the same for every stripe,
+    # together with the number of ranges, segments and retransmissions of the stripe
+    def stats(self):
+        return {
+            'bytes': self._size,
+            'seconds': self._seconds,
+            'goodput_mbps': goodput_mbps(self._size, self._seconds),
+            'stripes': [dict(measurements, goodput_mbps=goodput_mbps(measurements['bytes'], measurements['seconds']))
+                        for measurements in self._stripe_stats],
+        }
+
+
+# Server side of a striped transfer. It takes the connections of the stripes from a BTCPServerSocket, reads the
+# header of every range and writes the range at its offset in the output file, until the whole file arrived. Every
+# connection is read by a thread of its own. The server socket should not be used for other transfers meanwhile.
+class StripedReceiver:
+    def __init__(self, server):
+        self._server = server
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+        # the file that is written, None when no transfer is received, and the threads that read the connections
+        self._output = None
+        self._receivers = []
+
+        # size of the file (None until the first header arrived), number of bytes that were written, the number of
+        # bytes that were written of every range (by offset, a range that is sent again is not counted twice) and
+        # the bytes, ranges and seconds of every stripe
+        self._size = None
+        self._received = 0
+        self._written = {}
+        self._stripe_stats = {}
+
+    # Receive a striped file and write it to the file with path output. Returns False if the file did not arrive
+    # completely within timeout seconds (None waits for it forever).
+    def recv(self, output, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._done.clear()
+        self._receivers = []
+        self._size = None
+        self._received = 0
+        self._written = {}
+        self._stripe_stats = {}
+        with open(output, 'wb') as f:
+            self._output = f
+            try:
+                while not self._done.is_set():
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return False
+                    connection = self._server.accept_connection(STRIPE_ACCEPT_INTERVAL / 1000)
+                    if connection is not None:
+                        receiver = threading.Thread(target=self.receive_range, args=(connection,), daemon=True)
+                        receiver.start()
+                        self._receivers.append((receiver, connection))
+            finally:
+                self.stop_receivers()
+        print("Data Received")
+        return True
+
+    # Method that makes sure no thread writes to the output file anymore before it is closed. When the whole file
+    # arrived, the threads only wait for the end of their connections; else their connections are closed, so that
+    # they end, and they are joined.
+    def stop_receivers(self):
+        with self._lock:
+            self._output = None
+        if self._done.is_set():
+            return
+        for (receiver, connection) in self._receivers:
+            connection.close()
+        for (receiver, connection) in self._receivers:
+            receiver.join()
+
+    # Method that reads the range of one connection and writes it to the output file, until the connection ends or
+    # the transfer is over
+    def receive_range(self, connection):
+        header = bytearray()
+        offset = None
+        position = None
+        stripe = None
+        start = time.monotonic()
+        while True:
+            data = connection.DeliverData(None)
+            if not data:
+                break
+            if position is None:
+                header += data
+                if len(header) < STRIPE_HEADER_SIZE:
+                    continue
+                (size, offset, stripe) = STRIPE_HEADER_STRUCT.unpack_from(header)
+                position = offset
+                data = header[STRIPE_HEADER_SIZE:]
+                with self._lock:
+                    self._size = size
+                    self._stripe_stats.setdefault(stripe, {'stripe': stripe, 'ranges': 0, 'bytes': 0, 'seconds': 0.0})
+            with self._lock:
+                if self._output is None:
+                    break
+                self._output.seek(position)
+                self._output.write(data)
+                position += len(data)
+                written = self._written.get(offset, 0)
+                if position - offset > written:
+                    self._received += position - offset - written
+                    self._written[offset] = position - offset
+                self._stripe_stats[stripe]['bytes'] += len(data)
+                if self._received >= self._size:
+                    self._done.set()
+        if stripe is not None:
+            with self._lock:
+                self._stripe_stats[stripe]['ranges'] += 1
+                self._stripe_stats[stripe]['seconds'] += time.monotonic() - start
+
+    # Return the size of the file, the number of bytes that arrived and the bytes, ranges, seconds and goodput of
+    # every stripe that were counted so far
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'bytes_received': self._received,
+                'stripes': [dict(measurements, goodput_mbps=goodput_mbps(measurements['bytes'],
+                                                                         measurements['seconds']))
+                            for (_, measurements) in sorted(self._stripe_stats.items())],
+            }
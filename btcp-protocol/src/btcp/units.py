@@ -0,0 +1,9 @@
+# Parse a rate in the notation of tc ("10mbit", "1gbit", "500kbps") into bytes per second. A number without a unit
+# is in bits per second.
+def parse_rate(value):
+    units = (('gbit', 1e9 / 8), ('mbit', 1e6 / 8), ('kbit', 1e3 / 8), ('bit', 1 / 8),
+             ('gbps', 1e9), ('mbps', 1e6), ('kbps', 1e3), ('bps', 1.0))
+    for (unit, factor) in units:
+        if value.lower().endswith(unit):
+            return float(value[:-len(unit)]) * factor
+    return float(value) / 8
@@ -1,7 +1,11 @@
 #!/usr/local/bin/python3
 
 import argparse
+import logging
 from btcp.client_socket import BTCPClientSocket
+from btcp.congestion_control import CONGESTION_CONTROLLERS
+from btcp.constants import DEFAULT_CONGESTION_CONTROL
+from btcp.metrics import MetricsExporter
 
 
 def main():
@@ -9,10 +13,26 @@ def main():
     parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
     parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=100)
     parser.add_argument("-i", "--input", help="File to send", default="input.file")
+    parser.add_argument("-c", "--congestion", help="Congestion controller to use",
+                        choices=sorted(CONGESTION_CONTROLLERS), default=DEFAULT_CONGESTION_CONTROL)
+    parser.add_argument("-p", "--pacing", help="Pace the segments: 'rtt' spreads the window over the round trip "
+                                               "time, a rate such as 10mbit sends at that rate")
+    parser.add_argument("-f", "--fec", help="Forward error correction: 'adaptive' or the number of segments per "
+                                            "parity segment")
+    parser.add_argument("-z", "--compression", help="Compress the payloads if the server agrees", action="store_true")
+    parser.add_argument("-l", "--log-level", help="Level of the protocol log messages", default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("-m", "--metrics-port", help="Serve Prometheus metrics on this local port", type=int)
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
 
-    # Create a bTCP client socket with the given window size and timeout value
-    s = BTCPClientSocket(args.window, args.timeout)
+    # Create a bTCP client socket with the given window size, timeout value, congestion controller, pacing, forward
+    # error correction and compression
+    s = BTCPClientSocket(args.window, args.timeout, args.congestion, pacing=args.pacing, fec=args.fec,
+                         compression=args.compression)
+    if args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_port)
+        exporter.register('client', s)
     # TODO Write your file transfer clientcode using your implementation of BTCPClientSocket's connect, send, and disconnect methods.
 
     print("Welcome to the Client Application v1.0 - (Created by Thomas Kolb)")
@@ -24,10 +44,17 @@ def main():
             print("Possible commands are:")
             print("connect - establish a connection to a server")
             print("send [input] - send data to the connected server")
+            print("sendmany [inputs] - send files to the connected server as messages, the connection stays open")
             print("disconnect - disconnect from the server")
             print("close - clean up any state and close application")
         elif inp == "connect":
             s.connect()
+        elif inp[:8] == "sendmany":
+            if len(inp) <= 8:
+                print("Usage: sendmany [inputs]")
+            else:
+                s.send_messages(x[9:].split())
+                print("messages sent!")
         elif inp[:4] == "send":
             if len(inp) <= 4:
                 print("Usage: send [input]")
@@ -35,6 +62,7 @@ def main():
                 arg_input = x[5:]
                 s.send(arg_input)
                 print("input sent!")
+                print("congestion control:", s.congestion_stats())
         elif inp == "disconnect":
             s.disconnect()
         elif inp == "close":
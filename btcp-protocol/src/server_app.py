@@ -1,6 +1,9 @@
 #!/usr/local/bin/python3
 
 import argparse
+import logging
+import os
+from btcp.metrics import MetricsExporter
 from btcp.server_socket import BTCPServerSocket
 
 
@@ -9,10 +12,17 @@ def main():
     parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
     parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=100)
     parser.add_argument("-o", "--output", help="Where to store the file", default="output.file")
+    parser.add_argument("-l", "--log-level", help="Level of the protocol log messages", default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("-m", "--metrics-port", help="Serve Prometheus metrics on this local port", type=int)
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
 
     # Create a bTCP server socket
     s = BTCPServerSocket(args.window, args.timeout)
+    if args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_port)
+        exporter.register('server', s)
     # TODO Write your file transfer server code here using your BTCPServerSocket's accept, and recv methods.
     #s.accept()
 
@@ -30,6 +40,8 @@ def main():
             print("Possible commands are:")
             print("accept - start listening for a client")
             print("recv [output] - receives data and sends it to the output path")
+            print("messages [directory] - receives messages until the client disconnects and stores each of them "
+                  "in the directory")
             print("close - clean up any state and close application")
         elif inp == "accept":
             s.accept()
@@ -40,6 +52,25 @@ def main():
             else:
                 output = x[5:]
                 s.recv(output)
+        elif inp[:8] == "messages":
+            if len(inp) <= 8:
+                print("Usage: messages [directory]")
+            else:
+                directory = x[9:]
+                for message in s.messages():
+                    # the name comes from the client, only its last component is used and a name that is not a
+                    # file name is skipped
+                    name = os.path.basename(message.name)
+                    if name in ("", ".", ".."):
+                        logging.warning("skipped message with invalid name %r", message.name)
+                        continue
+                    try:
+                        with open(os.path.join(directory, name), 'wb') as f:
+                            f.write(message.data)
+                    except OSError as error:
+                        logging.warning("could not store message %r: %s", message.name, error)
+                        continue
+                    print("received", message.name)
         elif inp == "close":
             print("closing application...")
             s.close()
@@ -1,56 +1,45 @@
-import subprocess
+import asyncio
+import math
+import os
+import random
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import sys
 import time
+import urllib.error
+import urllib.request
 
+from btcp.async_socket import AsyncBTCPClientSocket, AsyncBTCPServerSocket
 from btcp.client_socket import BTCPClientSocket
 from btcp.server_socket import BTCPServerSocket
 
-from btcp.btcp_segment import calculate_checksum
+import btcp.btcp_segment as btcp_segment
+from btcp.btcp_segment import HEADER_CHECKSUM_FLAG, HEADER_STRUCT, PARITY_FLAG, Segment, calculate_checksum, \
+    checksum_add, flags_to_binary, header_checksum, pack_mss_option, unpack_features, unpack_mss_option, unpack_segment
+from btcp.congestion_control import CreateCongestionController, CubicController, RenoController
+from btcp.constants import *
+from btcp.framing import Message, MessageParser, pack_message_header
+from btcp.lossy_layer import LossyLayer
+from btcp.metrics import Histogram, MetricsExporter, flatten_stats, render_prometheus
+from btcp.network_emulator import EmulatedLink, EmulatedNetwork, NetworkProfile
+from btcp.pacing import CreatePacer, TokenBucketPacer
+from btcp.rtt_estimator import RTTEstimator
+from btcp.striping import StripedClient, StripedReceiver, split_ranges
+from btcp.selective_repeat import FileChunkSource, IsDuplicateReport, PackSackBlocks, SelectiveRepeaterReceiver, \
+    UnpackSackBlocks, ValidateForwardErrorCorrection, XorPayloads
+from btcp.units import parse_rate
 
 timeout = 100
 winsize = 100
-intf = "lo"
-netem_add = "sudo tc qdisc add dev {} root netem".format(intf)
-netem_change = "sudo tc qdisc change dev {} root netem {}".format(intf, "{}")
-netem_del = "sudo tc qdisc del dev {} root netem".format(intf)
+seed = 0
 
-"""run command and retrieve output"""
+# network profile with all impairments of test_allbad_network
+ALL_BAD_PROFILE = "corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%"
 
-
-def run_command_with_output(command, input=None, cwd=None, shell=True):
-    import subprocess
-    try:
-        process = subprocess.Popen(command, cwd=cwd, shell=shell, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    except Exception as inst:
-        print("problem running command : \n   ", str(command))
-
-    [stdoutdata, stderrdata] = process.communicate(
-        input)  # no pipes set for stdin/stdout/stdout streams so does effectively only just wait for process ends  (same as process.wait()
-
-    if process.returncode:
-        print(stderrdata)
-        print("problem running command : \n   ", str(command), " ", process.returncode)
-
-    return stdoutdata
-
-
-"""run command with no output piping"""
-
-
-def run_command(command, cwd=None, shell=True):
-    import subprocess
-    process = None
-    try:
-        process = subprocess.Popen(command, shell=shell, cwd=cwd)
-        print(str(process))
-    except Exception as inst:
-        print("1. problem running command : \n   ", str(command), "\n problem : ", str(inst))
-
-    process.communicate()  # wait for the process to end
-
-    if process.returncode:
-        print("2. problem running command : \n   ", str(command), " ", process.returncode)
+# size of the file the end-to-end tests of the protocol features send
+FEATURE_FILE_SIZE = 1000 * 1000
 
 
 class TestbTCPFramework(unittest.TestCase):
@@ -58,8 +47,8 @@ class TestbTCPFramework(unittest.TestCase):
 
     def setUp(self):
         """Prepare for testing"""
-        # default netem rule (does nothing)
-        run_command(netem_add)
+        # default network profile (does nothing), the emulated network starts over from the seed
+        network.set_profile("")
 
         # launch localhost server
         server_socket.accept()
@@ -67,7 +56,7 @@ class TestbTCPFramework(unittest.TestCase):
     def tearDown(self):
         """Clean up after testing"""
         # clean the environment
-        run_command(netem_del)
+        network.set_profile("")
 
         # close server
         client_socket.disconnect()
@@ -111,7 +100,7 @@ class TestbTCPFramework(unittest.TestCase):
         (which sometimes results in lower layer packet loss)"""
 
         # setup environment
-        run_command(netem_change.format("corrupt 1%"))
+        network.set_profile("corrupt 1%")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -144,7 +133,7 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with duplicate packets"""
 
         # setup environment
-        run_command(netem_change.format("duplicate 10%"))
+        network.set_profile("duplicate 10%")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -177,7 +166,7 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with packet loss"""
 
         # setup environment
-        run_command(netem_change.format("loss 10% 25%"))
+        network.set_profile("loss 10% 25%")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -210,7 +199,7 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with packet reordering"""
 
         # setup environment
-        run_command(netem_change.format("delay 20ms reorder 25% 50%"))
+        network.set_profile("delay 20ms reorder 25% 50%")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -243,7 +232,7 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with delay relative to the timeout value"""
 
         # setup environment
-        run_command(netem_change.format("delay " + str(timeout) + "ms 20ms"))
+        network.set_profile("delay " + str(timeout) + "ms 20ms")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -276,7 +265,7 @@ class TestbTCPFramework(unittest.TestCase):
         """reliability over network with all of the above problems"""
 
         # setup environment
-        run_command(netem_change.format("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%"))
+        network.set_profile("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%")
 
         # launch localhost client connecting to server
         client_socket.connect()
@@ -306,10 +295,1261 @@ class TestbTCPFramework(unittest.TestCase):
                          "The checksum of the input and output file are NOT equal.")
 
 
-#    def test_command(self):
-#        #command=['dir','.']
-#        out = run_command_with_output("dir .")
-#        print(out)
+def reference_checksum(data):
+    """straightforward word by word one's complement checksum (RFC 1071), to verify the checksum engine against"""
+    if len(data) % 2 == 1:
+        data = data + b'\x00'
+    total = 0
+    for x in range(0, len(data), 2):
+        total += (data[x] << 8) + data[x + 1]
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class TestChecksum(unittest.TestCase):
+    """Test cases for the one's complement checksum engine"""
+
+    # sizes around the odd lengths, the segment sizes and the threshold from which NumPy sums the buffer
+    SIZES = (0, 1, 2, 3, 10, 1007, PAYLOAD_SIZE, btcp_segment.NUMPY_CHECKSUM_THRESHOLD - 1,
+             btcp_segment.NUMPY_CHECKSUM_THRESHOLD, 65537)
+
+    def check_engine(self):
+        rng = random.Random(seed)
+        for size in self.SIZES:
+            for data in (rng.randbytes(size), bytes(size), b'\xff' * size):
+                with self.subTest(size=size, first=data[:1]):
+                    self.assertEqual(calculate_checksum(data), reference_checksum(data))
+
+    def test_python_engine(self):
+        """the big integer sum agrees with the reference for every length, including carries and odd lengths"""
+        btcp_segment.load_numpy()
+        with unittest.mock.patch.object(btcp_segment, 'np', None):
+            self.check_engine()
+
+    def test_numpy_engine(self):
+        """the NumPy sum of large buffers agrees with the reference"""
+        if btcp_segment.load_numpy() is None:
+            self.skipTest("NumPy is not installed")
+        self.check_engine()
+
+    def test_carry_folding(self):
+        """carries are folded back in, and a sum that folds to 0xFFFF gives the checksum 0 rather than 0xFFFF"""
+        self.assertEqual(calculate_checksum(b''), 0xFFFF)
+        self.assertEqual(calculate_checksum(b'\xff\xff'), 0)
+        self.assertEqual(calculate_checksum(b'\xff\xff\x00\x01'), reference_checksum(b'\xff\xff\x00\x01'))
+        self.assertEqual(calculate_checksum(b'\x80\x00\x80\x00'), 0xFFFE)
+        self.assertEqual(calculate_checksum(b'\x01'), 0xFEFF, "an odd byte is padded at its end")
+
+    def test_partial(self):
+        """a checksum over several buffers with partial sums is the checksum of their concatenation"""
+        data = random.Random(seed).randbytes(PAYLOAD_SIZE + 1)
+        for split in (0, 2, HEADER_SIZE, PAYLOAD_SIZE):
+            with self.subTest(split=split):
+                partial = checksum_add(0, data[:split])
+                self.assertEqual(calculate_checksum(data[split:], partial), reference_checksum(data))
+        partial = checksum_add(checksum_add(0, data[:4]), data[4:10])
+        self.assertEqual(calculate_checksum(data[10:], partial), reference_checksum(data))
+        self.assertEqual(checksum_add(7, None), 7)
+
+
+class DroppingNetwork(EmulatedNetwork):
+    """emulated network that loses the first transmission of the data segments with the given sequence numbers, so
+    a test knows exactly which packets were lost"""
+
+    def __init__(self, drops, **kwargs):
+        super().__init__(seed=seed, **kwargs)
+        self.drops = set(drops)
+
+    def transmit(self, segment, source, destination):
+        (seq_number, _, flags, _, _, _) = HEADER_STRUCT.unpack_from(segment)
+        if flags & (flags_to_binary(True, True, True) | PARITY_FLAG) == 0 and seq_number in self.drops:
+            self.drops.remove(seq_number)
+            return
+        super().transmit(segment, source, destination)
+
+
+class ManualTimer:
+    """delayed ACK timer that never fires, so a test decides when ACKs are sent"""
+
+    def __init__(self, delay, callback):
+        self.callback = callback
+
+    def Start(self):
+        pass
+
+    def Cancel(self):
+        pass
+
+    def Stop(self):
+        pass
+
+
+def data_segment(seq_number, payload=b'data'):
+    """return a received data segment of the first wire format"""
+    return unpack_segment(Segment(seq_number, 0, 0, 0, len(payload), calculate_checksum(payload),
+                                  payload).create_segment())
+
+
+class FeatureTestCase(unittest.TestCase):
+    """Base of the end-to-end tests of the protocol features: every test has an ideal emulated network of its own,
+    which it may impair or replace, over which a file of random bytes is sent"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.input_path = os.path.join(cls.directory.name, "input.file")
+        with open(cls.input_path, 'wb') as f:
+            f.write(random.Random(seed).randbytes(FEATURE_FILE_SIZE))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.network = EmulatedNetwork(seed=seed)
+
+    def tearDown(self):
+        self.network.close()
+
+    def use_network(self, network):
+        """send the segments of the test through network instead"""
+        self.network.close()
+        self.network = network
+
+    def transfer(self, path=None, **options):
+        """send the file with path (the input file by default) from a new client with the given options, and
+        return the data the server received, the statistics of the client and those of the connection"""
+        client = BTCPClientSocket(winsize, timeout, network=self.network, **options)
+        server = BTCPServerSocket(winsize, timeout, network=self.network)
+        try:
+            server.accept()
+            client.connect()
+            # send returns when every packet is acknowledged, so all data has reached the server by now
+            client.send(path or self.input_path)
+            connection = server.accept_connection(5)
+            data = connection.DeliverData(5)
+            client_stats = client.stats()
+            connection_stats = connection.stats()
+            client.disconnect()
+        finally:
+            client.close()
+            server.close()
+        return data, client_stats, connection_stats
+
+    def assertReceived(self, data, path=None):
+        """the data is the content of the file with path (the input file by default)"""
+        with open(path or self.input_path, 'rb') as f:
+            self.assertEqual(f.read(), data, "The input and output file are NOT equal.")
+
+
+class TestSelectiveAcknowledgements(FeatureTestCase):
+    """Test cases for the SACK blocks and the duplicate reports (D-SACK) of the ACKs"""
+
+    def test_sack_blocks(self):
+        """SACK blocks survive packing, a trailing partial block is ignored"""
+        blocks = [(5, 9), (12, 13), (65535, 2)]
+        self.assertEqual(UnpackSackBlocks(PackSackBlocks(blocks)), blocks)
+        self.assertEqual(UnpackSackBlocks(PackSackBlocks(blocks) + b'\x01'), blocks)
+        self.assertEqual(UnpackSackBlocks(b''), [])
+
+    def test_duplicate_report(self):
+        """the first block is a duplicate report when it lies before the ack number or inside another block"""
+        self.assertTrue(IsDuplicateReport([(3, 4), (10, 12)], 8))
+        self.assertTrue(IsDuplicateReport([(11, 12), (10, 14)], 8))
+        self.assertTrue(IsDuplicateReport([(65535, 0)], 1), "the sequence numbers wrap around")
+        self.assertFalse(IsDuplicateReport([(10, 12), (14, 15)], 8))
+        self.assertFalse(IsDuplicateReport([], 8))
+
+    def receiver(self):
+        """return a receiver of which the ACKs are collected in self.acks as (ack number, SACK blocks)"""
+        self.acks = []
+        test = self
+
+        class AckCollector:
+            def send_segment(self, data):
+                ack = unpack_segment(bytes(data))
+                test.acks.append((ack.ack_number, UnpackSackBlocks(ack.data[:ack.data_length])))
+
+        return SelectiveRepeaterReceiver(AckCollector(), winsize, timer_factory=ManualTimer)
+
+    def test_sack_blocks_of_receiver(self):
+        """the ACKs after a gap report the packets behind it in SACK blocks, in-order packets are acknowledged in
+        pairs"""
+        receiver = self.receiver()
+        receiver.ReceivePacket(data_segment(0))
+        self.assertEqual(self.acks, [], "the first in-order packet waits for the delayed ACK")
+        receiver.ReceivePacket(data_segment(1))
+        self.assertEqual(self.acks, [(2, [])])
+        for seq_number in (3, 4, 6):
+            receiver.ReceivePacket(data_segment(seq_number))
+        self.assertEqual(self.acks[1:], [(2, [(3, 4)]), (2, [(3, 5)]), (2, [(3, 5), (6, 7)])])
+        receiver.ReceivePacket(data_segment(2))
+        self.assertEqual(self.acks[-1], (5, [(6, 7)]))
+
+    def test_duplicate_report_of_receiver(self):
+        """the ACK of a duplicate packet reports it in its first block"""
+        receiver = self.receiver()
+        for seq_number in (0, 1, 3):
+            receiver.ReceivePacket(data_segment(seq_number))
+        receiver.ReceivePacket(data_segment(1))
+        self.assertEqual(self.acks[-1], (2, [(1, 2), (3, 4)]))
+        self.assertTrue(IsDuplicateReport(self.acks[-1][1], 2))
+        self.assertEqual(receiver.Stats()['duplicates'], 1)
+
+    def test_only_lost_packets_retransmitted(self):
+        """the SACK blocks tell the sender which packets arrived, so only the lost ones are sent again"""
+        self.use_network(DroppingNetwork({20, 21, 60}))
+        (data, client_stats, connection_stats) = self.transfer()
+        self.assertReceived(data)
+        # a thread that is not scheduled in time may let a packet that did arrive time out, the receiver reports
+        # those as duplicates
+        self.assertEqual(client_stats['sender']['retransmissions'],
+                         3 + connection_stats['receiver']['duplicates'])
+
+
+class TestRTTEstimator(FeatureTestCase):
+    """Test cases for the retransmission timeout that follows the measured round trip times"""
+
+    def test_samples(self):
+        """the timeout is the smoothed round trip time plus four times its variance (RFC 6298)"""
+        estimator = RTTEstimator(1000)
+        self.assertEqual(estimator.GetTimeout(), 1000, "the configured timeout is used until the first sample")
+        estimator.AddSample(100)
+        self.assertEqual((estimator.srtt, estimator.rttvar), (100, 50))
+        self.assertEqual(estimator.GetTimeout(), 300)
+        estimator.AddSample(60)
+        self.assertAlmostEqual(estimator.srtt, 95)
+        self.assertAlmostEqual(estimator.rttvar, 47.5)
+        self.assertAlmostEqual(estimator.GetTimeout(), 285)
+
+    def test_backoff(self):
+        """every timeout doubles the retransmission timeout up to the maximum, a new sample resets it"""
+        estimator = RTTEstimator(1000)
+        estimator.Backoff()
+        estimator.Backoff()
+        self.assertEqual(estimator.GetTimeout(), 4000)
+        estimator.AddSample(100)
+        self.assertEqual(estimator.GetTimeout(), 300)
+        for _ in range(20):
+            estimator.Backoff()
+        self.assertEqual(estimator.GetTimeout(), MAX_RETRANSMISSION_TIMEOUT)
+
+    def test_clamp(self):
+        """the timeout stays between the minimum and the maximum"""
+        self.assertEqual(RTTEstimator(1).GetTimeout(), MIN_RETRANSMISSION_TIMEOUT)
+        self.assertEqual(RTTEstimator(10 ** 9).GetTimeout(), MAX_RETRANSMISSION_TIMEOUT)
+        estimator = RTTEstimator(1000)
+        estimator.AddSample(0.1)
+        self.assertEqual(estimator.GetTimeout(), MIN_RETRANSMISSION_TIMEOUT)
+
+    def test_timeout_follows_round_trip_time(self):
+        """over a network with a delay of 30 ms each way, the round trip times are measured at 60 ms or more and the
+        timeout lies above them"""
+        self.network.set_profile("delay 30ms")
+        (data, client_stats, _) = self.transfer()
+        self.assertReceived(data)
+        sender = client_stats['sender']
+        self.assertGreater(sender['rtt_ms']['count'], 0)
+        self.assertGreaterEqual(sender['rtt_ms']['sum'] / sender['rtt_ms']['count'], 60)
+        self.assertGreaterEqual(sender['retransmission_timeout_ms'], 60)
+        self.assertNotEqual(sender['retransmission_timeout_ms'], timeout)
+
+
+class TestCongestionControl(FeatureTestCase):
+    """Test cases for the Reno and CUBIC congestion controllers"""
+
+    def test_reno(self):
+        """Reno grows exponentially in slow start and linearly after a loss, which halves its window"""
+        controller = RenoController()
+        controller.OnAck(5)
+        self.assertEqual(controller.cwnd, INITIAL_CONGESTION_WINDOW + 5)
+        controller.OnLoss()
+        self.assertEqual((controller.cwnd, controller.ssthresh), (7.5, 7.5))
+        controller.OnAck(3)
+        self.assertAlmostEqual(controller.cwnd, 7.5 + 3 / 7.5)
+        controller.OnTimeout()
+        self.assertEqual(controller.cwnd, 1)
+        self.assertEqual(controller.Stats()['loss_events'], 2)
+
+    def test_reno_undo(self):
+        """a loss that turns out to be spurious is undone, a timeout is not"""
+        controller = RenoController()
+        controller.OnAck(5)
+        controller.OnLoss()
+        controller.UndoLoss()
+        self.assertEqual(controller.cwnd, INITIAL_CONGESTION_WINDOW + 5)
+        self.assertTrue(controller.InSlowStart())
+        controller.OnTimeout()
+        controller.UndoLoss()
+        self.assertEqual(controller.cwnd, 1)
+        self.assertEqual(controller.undone_losses, 1)
+
+    def test_cubic(self):
+        """CUBIC backs off to beta times its window and grows back towards the window of the loss"""
+        controller = CubicController()
+        controller.OnAck(10)
+        controller.OnLoss()
+        self.assertEqual(controller.w_max, 20)
+        self.assertAlmostEqual(controller.cwnd, 20 * CUBIC_BETA)
+        controller.OnAck(1)
+        self.assertGreater(controller.cwnd, 20 * CUBIC_BETA)
+        self.assertLess(controller.cwnd, 20)
+        # fast convergence: a loss before the window of the last loss was reached lowers w_max below the window
+        window = controller.cwnd
+        controller.OnLoss()
+        self.assertAlmostEqual(controller.w_max, window * (1 + CUBIC_BETA) / 2)
+        controller.UndoLoss()
+        self.assertEqual((controller.cwnd, controller.w_max), (window, 20))
+
+    def test_create(self):
+        """controllers are created by name"""
+        self.assertIsInstance(CreateCongestionController("cubic"), CubicController)
+        self.assertEqual(CreateCongestionController("fixed").GetWindow(), float('inf'))
+        with self.assertRaises(ValueError):
+            CreateCongestionController("vegas")
+
+    def test_loss_ends_slow_start(self):
+        """one lost packet is one loss event, after which the controller of the sender left slow start"""
+        for name in ("reno", "cubic"):
+            with self.subTest(controller=name):
+                self.use_network(DroppingNetwork({30}))
+                (data, client_stats, _) = self.transfer(congestion_control=name)
+                self.assertReceived(data)
+                congestion = client_stats['congestion']
+                self.assertEqual(congestion['controller'], name)
+                # the lost packet is found from the ACKs, or from its timer when a thread is not scheduled in time,
+                # which may also let a packet that did arrive time out: those are the only other loss events
+                self.assertGreaterEqual(congestion['loss_events'], 1)
+                self.assertLessEqual(congestion['loss_events'] - congestion['timeouts'], 1)
+                self.assertLess(congestion['ssthresh'], float('inf'))
+                if name == "cubic":
+                    self.assertAlmostEqual(congestion['ssthresh'], congestion['w_max'] * CUBIC_BETA)
+
+
+class TestFlowControl(FeatureTestCase):
+    """Test cases for the window the receiver advertises from the space that is left in its buffer"""
+
+    def test_zero_window_probes(self):
+        """a receiver whose application does not read advertises a zero window once its buffer is full, the sender
+        probes it until the application reads again and the data arrives intact"""
+        buffer_size = 20 * PAYLOAD_SIZE
+        client = BTCPClientSocket(winsize, timeout, network=self.network)
+        server = BTCPServerSocket(winsize, timeout, network=self.network, buffer_size=buffer_size)
+        sending = threading.Thread(target=client.send, args=(self.input_path,))
+        data = bytearray()
+        try:
+            server.accept()
+            client.connect()
+            sending.start()
+            connection = server.accept_connection(5)
+            deadline = time.monotonic() + 10
+            while client.stats()['sender']['zero_window_probes'] == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertGreater(client.stats()['sender']['zero_window_probes'], 0)
+            self.assertGreaterEqual(connection.stats()['receiver']['undelivered_bytes'],
+                                    buffer_size - client.stats()['max_segment_size'])
+            while len(data) < FEATURE_FILE_SIZE:
+                received = connection.DeliverData(5)
+                if not received:
+                    break
+                data += received
+            sending.join(30)
+            self.assertFalse(sending.is_alive(), "the sender did not finish")
+            client.disconnect()
+        finally:
+            client.close()
+            server.close()
+        self.assertReceived(bytes(data))
+
+
+class TestMultipleClients(FeatureTestCase):
+    """Test cases for a server socket that serves several clients at once"""
+
+    def test_clients_get_own_connections(self):
+        """every client gets a connection of its own, the data of the clients does not get mixed up"""
+        paths = []
+        for number in range(4):
+            paths.append(os.path.join(self.directory.name, "client_{}.file".format(number)))
+            with open(paths[-1], 'wb') as f:
+                f.write(random.Random("{}:{}".format(seed, number)).randbytes(FEATURE_FILE_SIZE // 4))
+        server = BTCPServerSocket(winsize, timeout, network=self.network)
+        clients = [BTCPClientSocket(winsize, timeout, port=CLIENT_PORT + number, network=self.network)
+                   for number in range(len(paths))]
+        try:
+            server.accept()
+
+            def send(client, path):
+                client.connect()
+                client.send(path)
+
+            senders = [threading.Thread(target=send, args=(client, path)) for (client, path) in zip(clients, paths)]
+            for sender in senders:
+                sender.start()
+            connections = [server.accept_connection(5) for _ in clients]
+            for sender in senders:
+                sender.join()
+
+            # the connections are told apart by the port of their client
+            for connection in connections:
+                number = connection.address[1] - CLIENT_PORT
+                self.assertReceived(connection.DeliverData(5), paths[number])
+            self.assertEqual(server.stats()['active_connections'], len(clients))
+            for client in clients:
+                client.disconnect()
+        finally:
+            for client in clients:
+                client.close()
+            server.close()
+
+
+def syn_segment(option, data_length=None, checksum=None):
+    """return a received SYN segment with the given option, of which the header claims data_length bytes of data and
+    the given checksum (by default that of the option)"""
+    segment = bytearray(HEADER_SIZE + len(option))
+    HEADER_STRUCT.pack_into(segment, 0, 1, 0, flags_to_binary(False, True, False), 0,
+                            len(option) if data_length is None else data_length,
+                            calculate_checksum(option) if checksum is None else checksum)
+    segment[HEADER_SIZE:] = option
+    return unpack_segment(segment)
+
+
+class TestNegotiation(FeatureTestCase):
+    """Test cases for the segment size and the optional features that client and server agree on in the handshake"""
+
+    def test_options(self):
+        """the segment size and the features of a SYN survive packing"""
+        syn = syn_segment(pack_mss_option(500, FEATURE_FEC | FEATURE_HEADER_CHECKSUM))
+        self.assertEqual(unpack_mss_option(syn), 500)
+        self.assertEqual(unpack_features(syn), FEATURE_FEC | FEATURE_HEADER_CHECKSUM)
+        syn = syn_segment(pack_mss_option(500))
+        self.assertEqual((unpack_mss_option(syn), unpack_features(syn)), (500, 0))
+
+    def test_first_wire_format(self):
+        """a SYN without options, as a peer of the first wire format sends it, asks for the default segment size"""
+        syn = syn_segment(b'')
+        self.assertEqual((unpack_mss_option(syn), unpack_features(syn)), (PAYLOAD_SIZE, 0))
+        # such a peer pads its segments with zeros
+        syn = syn_segment(bytes(PAYLOAD_SIZE), data_length=0)
+        self.assertEqual((unpack_mss_option(syn), unpack_features(syn)), (PAYLOAD_SIZE, 0))
+
+    def test_damaged_options(self):
+        """only the part of an option that both the data length and the data hold is read, a damaged option gives
+        the defaults"""
+        option = pack_mss_option(500, FEATURE_COMPRESSION)
+        expected = {0: (PAYLOAD_SIZE, 0), 1: (PAYLOAD_SIZE, 0), MSS_OPTION_SIZE: (500, 0),
+                    200: (500, FEATURE_COMPRESSION), MAX_VALUE_16_BIT_INTEGER: (500, FEATURE_COMPRESSION)}
+        for (data_length, options) in expected.items():
+            with self.subTest(data_length=data_length):
+                syn = syn_segment(option, data_length)
+                self.assertEqual((unpack_mss_option(syn), unpack_features(syn)), options)
+        damaged = bytearray(option)
+        damaged[0] ^= 0x10
+        syn = syn_segment(option, checksum=calculate_checksum(damaged))
+        self.assertEqual((unpack_mss_option(syn), unpack_features(syn)), (PAYLOAD_SIZE, 0))
+
+    def test_segment_size_limits(self):
+        """an announced segment size is kept between one byte and the largest payload of a datagram"""
+        self.assertEqual(unpack_mss_option(syn_segment(pack_mss_option(0))), 1)
+        self.assertEqual(unpack_mss_option(syn_segment(pack_mss_option(MAX_VALUE_16_BIT_INTEGER))), MAX_PAYLOAD_SIZE)
+
+    def test_segment_size_follows_path_mtu(self):
+        """client and server agree on the segment size that fits the path and on the features the client asked for,
+        so no segment is too large for the path"""
+        self.use_network(EmulatedNetwork(seed=seed, mtu=600))
+        (data, client_stats, connection_stats) = self.transfer(fec=4, compression=True)
+        self.assertReceived(data)
+        for stats in (client_stats, connection_stats):
+            self.assertEqual(stats['max_segment_size'], 600 - UDP_IP_HEADER_SIZE - HEADER_SIZE)
+            self.assertTrue(stats['fec'])
+            self.assertTrue(stats['compression'])
+            self.assertTrue(stats['header_checksum'])
+        self.assertEqual(self.network.stats()['oversized'], 0)
+
+
+class TestLossDetection(FeatureTestCase):
+    """Test cases for the detection of losses from the ACKs"""
+
+    def test_losses_retransmitted_without_timeout(self):
+        """losses are retransmitted as soon as the ACKs show them, without waiting for the timer"""
+        drops = {20, 21, 200}
+        self.use_network(DroppingNetwork(drops))
+        (data, client_stats, connection_stats) = self.transfer()
+        self.assertReceived(data)
+        sender = client_stats['sender']
+        self.assertEqual(sender['fast_retransmissions'], len(drops))
+        # a packet that did arrive may still time out when a thread is not scheduled in time, the receiver reports
+        # its retransmission as a duplicate
+        self.assertEqual(sender['retransmissions'], len(drops) + connection_stats['receiver']['duplicates'])
+        self.assertGreaterEqual(connection_stats['receiver']['duplicates'], sender['timeouts'])
+
+
+class TestPacing(FeatureTestCase):
+    """Test cases for the token bucket that paces the segments of the sender"""
+
+    def test_token_bucket(self):
+        """a burst may leave at once, after that the segments leave at the rate"""
+        pacer = TokenBucketPacer(rate=1000 * 1000, segment_size=1000)
+        self.assertTrue(pacer.CanSend(0))
+        for _ in range(3):
+            self.assertTrue(pacer.CanSend(0))
+            pacer.Consume(1000)
+        self.assertFalse(pacer.CanSend(0), "the bucket may go into debt by one segment only")
+        self.assertAlmostEqual(pacer.NextSendTime(), 0.001)
+        self.assertTrue(pacer.CanSend(0.001))
+        self.assertEqual(pacer.Stats()['waits'], 1)
+        self.assertEqual(pacer.Stats()['paced_segments'], 3)
+
+    def test_window_rate(self):
+        """without a configured rate the window is spread over the round trip time, once it is measured"""
+        pacer = TokenBucketPacer(segment_size=1000)
+        self.assertTrue(pacer.CanSend(0))
+        self.assertIsNone(pacer.NextSendTime())
+        pacer.OnWindowUpdate(10, None, True)
+        self.assertIsNone(pacer.rate)
+        pacer.OnWindowUpdate(10, 100, True)
+        self.assertAlmostEqual(pacer.rate, PACING_SLOW_START_GAIN * 10 * 1000 / 0.1)
+        pacer.OnWindowUpdate(10, 100, False)
+        self.assertAlmostEqual(pacer.rate, PACING_CONGESTION_AVOIDANCE_GAIN * 10 * 1000 / 0.1)
+        fixed = TokenBucketPacer(rate=5000)
+        fixed.OnWindowUpdate(10, 100, True)
+        self.assertEqual(fixed.rate, 5000)
+
+    def test_create(self):
+        """the pacing option is no pacing, pacing from the window or a rate"""
+        self.assertIsNone(CreatePacer(None))
+        self.assertEqual(CreatePacer("rtt").mode, "rtt")
+        self.assertEqual(CreatePacer("10mbit").rate, 10 * 1000 * 1000 / 8)
+        self.assertEqual(CreatePacer(5000).rate, 5000)
+        self.assertEqual(parse_rate("500kbps"), 500 * 1000)
+        self.assertEqual(parse_rate("8000"), 1000)
+        with self.assertRaises(ValueError):
+            CreatePacer(0)
+
+    def test_sender_keeps_fixed_rate(self):
+        """a sender with a fixed rate takes as long as the rate allows and waits for the token bucket"""
+        start = time.monotonic()
+        (data, client_stats, _) = self.transfer(pacing="8mbit")
+        elapsed = time.monotonic() - start
+        self.assertReceived(data)
+        stats = client_stats['sender']['pacing']
+        self.assertEqual(stats['mode'], "fixed")
+        self.assertEqual(stats['paced_segments'], client_stats['sender']['segments_sent'])
+        self.assertGreater(stats['waits'], 0)
+        self.assertGreaterEqual(elapsed, 0.8 * FEATURE_FILE_SIZE / parse_rate("8mbit"))
+
+    def test_rate_follows_window(self):
+        """a sender that paces from the window gets a rate once the round trip time is measured"""
+        (data, client_stats, _) = self.transfer(pacing="rtt")
+        self.assertReceived(data)
+        stats = client_stats['sender']['pacing']
+        self.assertEqual(stats['mode'], "rtt")
+        self.assertLess(stats['rate'], math.inf)
+        self.assertGreater(stats['paced_segments'], 0)
+
+
+class TestForwardErrorCorrection(FeatureTestCase):
+    """Test cases for the XOR parity segments of forward error correction"""
+
+    def test_parity(self):
+        """a lost payload is the XOR of the parity with the other payloads, the short ones padded with zeros"""
+        payloads = [b'\x01\x02\x03', b'\xff', b'\x10\x20']
+        parity = XorPayloads(payloads, 3)
+        self.assertEqual(parity.to_bytes(3, 'big'), b'\xee\x22\x03')
+        recovered = parity ^ XorPayloads(payloads[1:], 3)
+        self.assertEqual(recovered.to_bytes(3, 'big'), payloads[0])
+
+    def test_validate(self):
+        """the mode is adaptive or a number of packets per parity packet that fits the window"""
+        self.assertIsNone(ValidateForwardErrorCorrection(None, 100))
+        self.assertEqual(ValidateForwardErrorCorrection(FEC_ADAPTIVE, 100), FEC_ADAPTIVE)
+        self.assertEqual(ValidateForwardErrorCorrection("4", 100), 4)
+        for fec in ("often", 0, 101):
+            with self.subTest(fec=fec):
+                with self.assertRaises(ValueError):
+                    ValidateForwardErrorCorrection(fec, 100)
+
+    def test_lost_packets_recovered(self):
+        """the receiver recovers lost packets from the parity packets instead of waiting for retransmissions"""
+        drops = {21, 102}
+        self.use_network(DroppingNetwork(drops))
+        (data, client_stats, connection_stats) = self.transfer(fec=4)
+        self.assertReceived(data)
+        self.assertTrue(connection_stats['fec'])
+        self.assertGreater(client_stats['sender']['parity_segments'], 0)
+        self.assertEqual(connection_stats['receiver']['parity_segments_received'],
+                         client_stats['sender']['parity_segments'])
+        self.assertEqual(connection_stats['receiver']['recovered_packets'], len(drops))
+
+    def test_adaptive_parity(self):
+        """adaptive forward error correction sends parity packets from the start"""
+        (data, client_stats, connection_stats) = self.transfer(fec=FEC_ADAPTIVE)
+        self.assertReceived(data)
+        self.assertGreater(client_stats['sender']['parity_segments'], 0)
+        self.assertEqual(connection_stats['receiver']['recovered_packets'], 0)
+
+
+class TestCompression(FeatureTestCase):
+    """Test cases for the compression of the payloads and the checksum that covers the header"""
+
+    def test_header_checksum(self):
+        """the checksum of a segment with an extension flag covers the header, so a damaged header is noticed"""
+        data = b'payload'
+        partial = header_checksum(72, 0, HEADER_CHECKSUM_FLAG, 0, len(data))
+        segment = Segment(72, 0, HEADER_CHECKSUM_FLAG, 0, len(data), calculate_checksum(data, partial), data)
+        encoded = segment.create_segment()
+        view = unpack_segment(encoded)
+        self.assertEqual(view.checksum, calculate_checksum(view.data, view.header_checksum))
+        # sequence number 72 becomes 64
+        encoded[1] ^= 0x08
+        view = unpack_segment(encoded)
+        self.assertEqual(view.seq_number, 64)
+        self.assertNotEqual(view.checksum, calculate_checksum(view.data, view.header_checksum))
+        # the checksum of a segment of the first wire format only covers its payload
+        self.assertEqual(header_checksum(72, 0, 0, 0, len(data)), 0)
+
+    def connected_client(self):
+        """return a client that is connected to a new server, and that server"""
+        client = BTCPClientSocket(winsize, timeout, network=self.network)
+        server = BTCPServerSocket(winsize, timeout, network=self.network)
+        server.accept()
+        client.connect()
+        self.assertTrue(client.stats()['connected'])
+        return client, server
+
+    def client_input(self, client, ack_number, ack_syn_fin, data=b'', extended=True, checksum=None):
+        """give the client a segment from the server, of which the checksum covers the header when extended"""
+        flags = ack_syn_fin | HEADER_CHECKSUM_FLAG if extended else ack_syn_fin
+        if checksum is None:
+            checksum = calculate_checksum(data, header_checksum(0, ack_number, flags, 0, len(data)))
+        client.lossy_layer_input((Segment(0, ack_number, flags, 0, len(data), checksum, data).create_segment(),
+                                  (SERVER_IP, SERVER_PORT)))
+
+    def test_client_drops_damaged_segments(self):
+        """once the header checksum is agreed to, the client drops a segment of the server whose checksum does not
+        cover its header or does not match before it acts on the flags"""
+        (client, server) = self.connected_client()
+        try:
+            segment_size = client.stats()['max_segment_size']
+            self.assertTrue(client.stats()['header_checksum'])
+            fin_ack = flags_to_binary(True, False, True)
+            self.client_input(client, 0, fin_ack, extended=False)
+            self.client_input(client, 0, fin_ack, checksum=0)
+            stats = client.stats()
+            self.assertTrue(stats['connected'])
+            self.assertEqual(stats['checksum_failures'], 2)
+            # a SYN-ACK with a matching checksum is ignored as well once the client is connected
+            self.client_input(client, 0, flags_to_binary(True, True, False), pack_mss_option(100))
+            stats = client.stats()
+            self.assertEqual(stats['unexpected_segments'], 1)
+            self.assertEqual(stats['max_segment_size'], segment_size)
+            client.disconnect()
+            self.assertFalse(client.stats()['connected'])
+        finally:
+            client.close()
+            server.close()
+
+    def test_client_checks_flags_without_header_checksum(self):
+        """without the header checksum the client only takes a FIN-ACK without data that acknowledges its FIN"""
+        with unittest.mock.patch('btcp.server_connection.SUPPORTED_FEATURES', 0):
+            (client, server) = self.connected_client()
+        try:
+            self.assertFalse(client.stats()['header_checksum'])
+            fin_ack = flags_to_binary(True, False, True)
+            self.client_input(client, 1, fin_ack, extended=False)
+            self.client_input(client, 0, fin_ack, b'x', extended=False)
+            stats = client.stats()
+            self.assertTrue(stats['connected'])
+            self.assertEqual(stats['unexpected_segments'], 2)
+            client.disconnect()
+            self.assertFalse(client.stats()['connected'])
+        finally:
+            client.close()
+            server.close()
+
+    def test_text_is_compressed(self):
+        """compressible text is sent in fewer bytes and decompressed in order"""
+        path = os.path.join(self.directory.name, "text.file")
+        rng = random.Random(seed)
+        with open(path, 'w') as f:
+            while f.tell() < FEATURE_FILE_SIZE:
+                f.write("{},host{:02d},{},{:.3f}\n".format(1600000000 + f.tell(), rng.randrange(16),
+                                                           rng.choice(("INFO", "WARN", "ERROR")), rng.random() * 100))
+        (data, client_stats, connection_stats) = self.transfer(path, compression=True)
+        self.assertReceived(data, path)
+        self.assertTrue(connection_stats['compression'])
+        compression = client_stats['sender']['compression']
+        self.assertEqual(compression['input_bytes'], len(data))
+        self.assertLess(compression['compressed_bytes'], compression['input_bytes'] / 2)
+        self.assertGreater(connection_stats['receiver']['compressed_segments'], 0)
+
+    def test_incompressible_data(self):
+        """random bytes are sent uncompressed once compressing them does not pay off"""
+        (data, client_stats, _) = self.transfer(compression=True)
+        self.assertReceived(data)
+        self.assertGreater(client_stats['sender']['compression']['uncompressed_packets'], 0)
+
+
+def failing_stripe_socket(*stripes):
+    """return a client socket class of which the sends fail on the ports of the given stripes"""
+
+    class FailingStripeSocket(BTCPClientSocket):
+        def __init__(self, *args, port=CLIENT_PORT, **kwargs):
+            super().__init__(*args, port=port, **kwargs)
+            self.failing = port - CLIENT_PORT in stripes
+
+        def send(self, *args, **kwargs):
+            if self.failing:
+                raise OSError("stripe is broken")
+            return super().send(*args, **kwargs)
+
+    return FailingStripeSocket
+
+
+class TestStriping(FeatureTestCase):
+    """Test cases for a file that is striped over parallel connections"""
+
+    def test_split_ranges(self):
+        """the ranges cover the file without overlap and are not smaller than the minimum"""
+        self.assertEqual(split_ranges(16 * STRIPE_MIN_RANGE_SIZE, 2),
+                         [(offset, 2 * STRIPE_MIN_RANGE_SIZE) for offset in range(0, 16 * STRIPE_MIN_RANGE_SIZE,
+                                                                                  2 * STRIPE_MIN_RANGE_SIZE)])
+        ranges = split_ranges(16 * STRIPE_MIN_RANGE_SIZE + 5, 2)
+        self.assertEqual(sum(length for (_, length) in ranges), 16 * STRIPE_MIN_RANGE_SIZE + 5)
+        for ((offset, length), (next_offset, _)) in zip(ranges, ranges[1:]):
+            self.assertEqual(offset + length, next_offset)
+        self.assertEqual(split_ranges(1000, 4), [(0, 1000)])
+        self.assertEqual(split_ranges(0, 4), [(0, 0)], "an empty file is still sent, so its size arrives")
+
+    def striped_transfer(self, stripes=4, receive_timeout=60):
+        """send the input file striped over the given number of stripes, and return the client, whether the
+        receiver got the whole file and the path it wrote it to"""
+        output = os.path.join(self.directory.name, "striped.file")
+        client = StripedClient(winsize, timeout, stripes, network=self.network)
+        server = BTCPServerSocket(winsize, timeout, network=self.network)
+        receiver = StripedReceiver(server)
+        result = {}
+        receiving = threading.Thread(target=lambda: result.update(complete=receiver.recv(output, receive_timeout)))
+        receiving.start()
+        try:
+            client.send(self.input_path)
+        finally:
+            receiving.join()
+            server.close()
+        return client, result['complete'], output
+
+    def test_stripes_share_the_file(self):
+        """the stripes together deliver the file"""
+        (client, complete, output) = self.striped_transfer()
+        self.assertTrue(complete)
+        with open(output, 'rb') as f:
+            self.assertReceived(f.read())
+        stats = client.stats()
+        self.assertEqual(stats['bytes'], FEATURE_FILE_SIZE)
+        self.assertGreater(len([stripe for stripe in stats['stripes'] if stripe['ranges'] > 0]), 1)
+
+    def test_failed_stripe(self):
+        """the ranges of a stripe that fails are sent again over the other stripes"""
+        with unittest.mock.patch('btcp.striping.BTCPClientSocket', failing_stripe_socket(1)):
+            (client, complete, output) = self.striped_transfer()
+        self.assertTrue(complete)
+        with open(output, 'rb') as f:
+            self.assertReceived(f.read())
+        stripes = {stripe['stripe']: stripe for stripe in client.stats()['stripes']}
+        self.assertEqual(stripes[1]['bytes'], 0)
+        self.assertIsNotNone(stripes[1]['error'])
+
+    def test_all_stripes_failed(self):
+        """a transfer of which all stripes fail raises an error instead of leaving a file with holes"""
+        with unittest.mock.patch('btcp.striping.BTCPClientSocket', failing_stripe_socket(0, 1)):
+            with self.assertRaises(ConnectionError):
+                self.striped_transfer(stripes=2, receive_timeout=1)
+
+
+class TestMessages(FeatureTestCase):
+    """Test cases for the framed messages that are sent over one persistent connection"""
+
+    def test_parser(self):
+        """messages are parsed from pieces of any size"""
+        stream = pack_message_header("a", 3) + b'abc' + pack_message_header("b\u00e9", 0) + \
+            pack_message_header("c", 2) + b'cd'
+        expected = [Message("a", b'abc'), Message("b\u00e9", b''), Message("c", b'cd')]
+        self.assertEqual(MessageParser().feed(stream), expected)
+        for size in (1, 5, MESSAGE_HEADER_SIZE + 1):
+            with self.subTest(size=size):
+                parser = MessageParser()
+                messages = []
+                for start in range(0, len(stream), size):
+                    messages += parser.feed(stream[start:start + size])
+                self.assertEqual(messages, expected)
+                self.assertFalse(parser.incomplete())
+
+    def test_split_header(self):
+        """a message does not start before its whole header and name arrived"""
+        header = pack_message_header("name", 1)
+        parser = MessageParser()
+        self.assertEqual(parser.feed(header[:MESSAGE_HEADER_SIZE - 1]), [])
+        self.assertEqual(parser.feed(header[MESSAGE_HEADER_SIZE - 1:-2]), [])
+        self.assertTrue(parser.incomplete())
+        self.assertEqual(parser.feed(header[-2:] + b'x'), [Message("name", b'x')])
+
+    def test_empty_name(self):
+        """a message may have an empty name"""
+        self.assertEqual(MessageParser().feed(pack_message_header("", 2) + b'ab'), [Message("", b'ab')])
+
+    def test_truncated_stream(self):
+        """a stream that ends in the middle of a message leaves the parser incomplete"""
+        for end in (1, MESSAGE_HEADER_SIZE, MESSAGE_HEADER_SIZE + 4):
+            with self.subTest(end=end):
+                parser = MessageParser()
+                self.assertEqual(parser.feed((pack_message_header("name", 2) + b'ab')[:end]), [])
+                self.assertTrue(parser.incomplete())
+
+    def test_long_name(self):
+        """a name longer than the header can announce is refused"""
+        pack_message_header("x" * MAX_MESSAGE_NAME_SIZE, 0)
+        with self.assertRaises(ValueError):
+            pack_message_header("x" * (MAX_MESSAGE_NAME_SIZE + 1), 0)
+
+    def test_header_size(self):
+        """the header of a range is made from the size of the range in the opened file"""
+        source = FileChunkSource(self.input_path, 1000, offset=FEATURE_FILE_SIZE - 1500,
+                                 header=lambda size: pack_message_header("tail", size))
+        try:
+            self.assertEqual(source[0], pack_message_header("tail", 1500))
+            self.assertEqual(len(source), 3)
+        finally:
+            source.close()
+
+    def test_header_longer_than_segment(self):
+        """a header that does not fit in one packet is divided over packets of at most the segment size"""
+        header = pack_message_header("x" * MAX_MESSAGE_NAME_SIZE, 1500)
+        source = FileChunkSource(self.input_path, 100, offset=FEATURE_FILE_SIZE - 1500, header=header)
+        try:
+            header_packets = (len(header) + 99) // 100
+            self.assertEqual(len(source), header_packets + 15)
+            self.assertEqual(b''.join(bytes(source[seq_number]) for seq_number in range(header_packets)), header)
+            self.assertTrue(all(len(source[seq_number]) <= 100 for seq_number in range(len(source))))
+        finally:
+            source.close()
+
+    def test_long_name_over_small_mtu(self):
+        """a message whose name makes its header longer than a segment arrives over a path with a small MTU"""
+        self.use_network(EmulatedNetwork(seed=seed, mtu=200))
+        name = "x" * MAX_MESSAGE_NAME_SIZE
+        for compression in (False, True):
+            with self.subTest(compression=compression):
+                client = BTCPClientSocket(winsize, timeout, network=self.network, compression=compression)
+                server = BTCPServerSocket(winsize, timeout, network=self.network)
+                received = []
+                try:
+                    server.accept()
+                    client.connect()
+                    self.assertLess(client.stats()['max_segment_size'], MESSAGE_HEADER_SIZE + len(name))
+                    reader = threading.Thread(target=lambda: received.extend(server.messages()))
+                    reader.start()
+                    client.send_messages([(name, self.input_path)])
+                    client.disconnect()
+                    reader.join(30)
+                    self.assertFalse(reader.is_alive(), "the messages do not end with the connection")
+                finally:
+                    client.close()
+                    server.close()
+                self.assertEqual([message.name for message in received], [name])
+                self.assertReceived(received[0].data)
+        self.assertEqual(self.network.stats()['oversized'], 0)
+
+    def test_messages_over_one_connection(self):
+        """messages that are sent in several calls over one connection arrive whole, in order and with their names"""
+        paths = []
+        rng = random.Random(seed)
+        for number in range(8):
+            paths.append(os.path.join(self.directory.name, "message_{}.file".format(number)))
+            with open(paths[-1], 'wb') as f:
+                # one of the messages is empty
+                f.write(rng.randbytes(rng.randrange(FEATURE_FILE_SIZE // 8) if number != 3 else 0))
+        for compression in (False, True):
+            with self.subTest(compression=compression):
+                client = BTCPClientSocket(winsize, timeout, network=self.network, compression=compression)
+                server = BTCPServerSocket(winsize, timeout, network=self.network)
+                received = []
+                try:
+                    server.accept()
+                    client.connect()
+                    reader = threading.Thread(target=lambda: received.extend(server.messages()))
+                    reader.start()
+                    client.send_messages(paths[:5])
+                    client.send_messages(("renamed", path) for path in paths[5:])
+                    client.disconnect()
+                    reader.join(30)
+                    self.assertFalse(reader.is_alive(), "the messages do not end with the connection")
+                    self.assertEqual(server.stats()['connections_accepted'], 1)
+                finally:
+                    client.close()
+                    server.close()
+                names = [os.path.basename(path) for path in paths[:5]] + ["renamed"] * 3
+                self.assertEqual([message.name for message in received], names)
+                for (message, path) in zip(received, paths):
+                    self.assertReceived(message.data, path)
+
+
+class TestImpairedNetwork(FeatureTestCase):
+    """Smoke test of all features together over a network that corrupts, duplicates, loses, delays and reorders"""
+
+    def test_all_features(self):
+        """the file arrives intact with every feature enabled"""
+        self.network.set_profile(ALL_BAD_PROFILE)
+        (data, _, connection_stats) = self.transfer(fec=FEC_ADAPTIVE, compression=True, pacing="rtt",
+                                                    congestion_control="cubic")
+        self.assertReceived(data)
+        self.assertTrue(connection_stats['fec'])
+        self.assertTrue(connection_stats['compression'])
+
+
+class TestNetworkEmulator(unittest.TestCase):
+    """Test cases for the netem profiles and the random decisions of the emulated network"""
+
+    def test_parse(self):
+        """netem arguments give the probabilities, correlations, times, rate and limit of a profile"""
+        profile = NetworkProfile.parse(ALL_BAD_PROFILE)
+        self.assertEqual((profile.corrupt, profile.corrupt_correlation), (0.01, 0.0))
+        self.assertEqual((profile.duplicate, profile.loss, profile.loss_correlation), (0.1, 0.1, 0.25))
+        self.assertEqual((profile.delay, profile.jitter), (0.02, 0.0))
+        self.assertEqual((profile.reorder, profile.reorder_correlation), (0.25, 0.5))
+        profile = NetworkProfile.parse("loss random 5% delay 1s 500us 25% rate 10mbit limit 50")
+        self.assertEqual((profile.loss, profile.loss_correlation), (0.05, 0.0))
+        self.assertEqual((profile.delay, profile.jitter), (1.0, 0.0005))
+        self.assertEqual((profile.rate, profile.limit), (10 * 1000 * 1000 / 8, 50))
+        self.assertIsNone(profile.gilbert_elliott)
+
+    def test_parse_gemodel(self):
+        """a Gilbert-Elliott loss model takes the chances of the state changes and the loss in each state, the
+        values that are left out are those of netem"""
+        profile = NetworkProfile.parse("loss gemodel 1% 10% 70% 0.1%")
+        self.assertEqual(profile.gilbert_elliott, (0.01, 0.1, 0.7, 0.001))
+        self.assertEqual(profile.loss, 0.0)
+        profile = NetworkProfile.parse("loss gemodel 20%")
+        self.assertEqual(profile.gilbert_elliott, (0.2, 0.8, 1.0, 0.0))
+        for rule in ("slot 10ms", "loss 10% bogus"):
+            with self.subTest(rule=rule):
+                with self.assertRaises(ValueError):
+                    NetworkProfile.parse(rule)
+
+    def test_gemodel_bursts(self):
+        """a link that goes to the bad state at once and never back loses every segment from then on"""
+        link = EmulatedLink(seed, (CLIENT_IP, CLIENT_PORT), (SERVER_IP, SERVER_PORT),
+                            NetworkProfile.parse("loss gemodel 100% 0% 100% 0%"))
+        self.assertTrue(all(link.lose() for _ in range(100)))
+
+    def link_decisions(self, link, count=200):
+        """return the loss, corruption and latency decisions of a link for count segments"""
+        return [(link.lose(), link.flip_bit(b'segment'), link.latency()) for _ in range(count)]
+
+    def test_link_determinism(self):
+        """the decisions of a link only depend on the seed and its addresses, not on the traffic of other links"""
+        profile = NetworkProfile.parse("loss 10% 25% corrupt 5% delay 20ms 5ms reorder 25% 50%")
+        (client, server) = ((CLIENT_IP, CLIENT_PORT), (SERVER_IP, SERVER_PORT))
+        decisions = self.link_decisions(EmulatedLink(seed, client, server, profile))
+        link = EmulatedLink(seed, client, server, profile)
+        reverse = EmulatedLink(seed, server, client, profile)
+        interleaved = []
+        for _ in range(200):
+            interleaved += self.link_decisions(link, 1)
+            self.link_decisions(reverse, 3)
+        self.assertEqual(interleaved, decisions)
+        self.assertNotEqual(self.link_decisions(EmulatedLink(seed, server, client, profile)), decisions)
+        self.assertNotEqual(self.link_decisions(EmulatedLink(seed + 1, client, server, profile)), decisions)
+
+    def test_profile_starts_links_over(self):
+        """setting a profile starts the links over from the seed, so the same segments are lost again"""
+        network = EmulatedNetwork(seed=seed)
+        try:
+            losses = []
+            for _ in range(2):
+                network.set_profile("loss 30%")
+                before = network.stats()['lost']
+                for number in range(100):
+                    network.transmit(bytes(HEADER_SIZE), (CLIENT_IP, CLIENT_PORT), (SERVER_IP, SERVER_PORT))
+                losses.append(network.stats()['lost'] - before)
+            self.assertEqual(losses[0], losses[1])
+            self.assertGreater(losses[0], 0)
+        finally:
+            network.close()
+
+
+class SegmentRecorder:
+    """socket of a lossy layer that keeps a copy of every segment it receives, and waits for started before it
+    handles the first one"""
+
+    def __init__(self):
+        self.segments = []
+        self.started = threading.Event()
+        self.started.set()
+        self.received = threading.Condition()
+
+    def lossy_layer_input(self, rec_data):
+        self.started.wait(10)
+        with self.received:
+            self.segments.append(bytes(rec_data[0]))
+            self.received.notify_all()
+
+    def wait_for(self, count, timeout=5):
+        """wait until count segments were received, return whether they were"""
+        with self.received:
+            return self.received.wait_for(lambda: len(self.segments) >= count, timeout)
+
+
+def idle_incoming_segments(lossy_layer, event, udp_sock):
+    """I/O thread of a lossy layer that does not read the socket, so a test calls receive_batch itself"""
+    event.wait()
+
+
+class TestLossyLayer(unittest.TestCase):
+    """Test cases for the batches in which the lossy layer sends and receives datagrams over UDP"""
+
+    def setUp(self):
+        self.layers = []
+
+    def tearDown(self):
+        for layer in self.layers:
+            layer.destroy()
+
+    def create_layers(self):
+        """return a sending lossy layer and a receiving one with a SegmentRecorder, and the recorder"""
+        recorder = SegmentRecorder()
+        sender = LossyLayer(SegmentRecorder(), CLIENT_IP, CLIENT_PORT + 500, SERVER_IP, SERVER_PORT + 500)
+        self.layers.append(sender)
+        receiver = LossyLayer(recorder, SERVER_IP, SERVER_PORT + 500, CLIENT_IP, CLIENT_PORT + 500)
+        self.layers.append(receiver)
+        return sender, receiver, recorder
+
+    def test_send_batch(self):
+        """the segments that are sent inside a batch leave together when it ends"""
+        (sender, _, recorder) = self.create_layers()
+        segments = [number.to_bytes(2, 'big') * 10 for number in range(100)]
+        with sender.batch():
+            for segment in segments:
+                sender.send_segment(bytearray(segment))
+            # a full queue was flushed right away
+            self.assertEqual(sender.batch_stats()['sent_segments'], MAX_DATAGRAM_BATCH)
+        self.assertTrue(recorder.wait_for(len(segments)))
+        self.assertEqual(recorder.segments, segments)
+        stats = sender.batch_stats()
+        # the queue is flushed once when it is full and once when the batch ends
+        self.assertEqual((stats['send_batches'], stats['sent_segments']), (2, len(segments)))
+        self.assertEqual(stats['average_send_batch'], len(segments) / 2)
+
+    def test_batch_per_thread(self):
+        """a batch only holds back the segments of the thread that opened it"""
+        (sender, _, recorder) = self.create_layers()
+        in_batch = threading.Event()
+        release = threading.Event()
+
+        def batched():
+            with sender.batch():
+                sender.send_segment(b'batched')
+                in_batch.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=batched)
+        thread.start()
+        try:
+            in_batch.wait(5)
+            sender.send_segment(b'direct')
+            self.assertTrue(recorder.wait_for(1))
+            self.assertEqual(recorder.segments, [b'direct'])
+        finally:
+            release.set()
+            thread.join()
+        self.assertTrue(recorder.wait_for(2))
+        self.assertEqual(recorder.segments, [b'direct', b'batched'])
+
+    def test_receive_batch(self):
+        """every datagram that is ready is read into a receive buffer in one batch"""
+        with unittest.mock.patch('btcp.lossy_layer.handle_incoming_segments', idle_incoming_segments):
+            (sender, receiver, recorder) = self.create_layers()
+        segments = [number.to_bytes(2, 'big') * (number + 1) for number in range(20)]
+        for segment in segments:
+            sender.send_segment(segment)
+        # datagrams over the loopback interface are ready as soon as they are sent
+        receiver.receive_batch()
+        self.assertTrue(recorder.wait_for(len(segments)))
+        self.assertEqual(recorder.segments, segments)
+        stats = receiver.batch_stats()
+        self.assertEqual((stats['receive_batches'], stats['received_segments'], stats['dropped_segments']),
+                         (1, len(segments), 0))
+
+    def test_receive_buffers_exhausted(self):
+        """a datagram that arrives while all receive buffers wait for the protocol worker is dropped"""
+        with unittest.mock.patch('btcp.lossy_layer.handle_incoming_segments', idle_incoming_segments):
+            (sender, receiver, recorder) = self.create_layers()
+        recorder.started.clear()
+        count = RECEIVE_QUEUE_SIZE + 10
+        for number in range(count):
+            sender.send_segment(number.to_bytes(2, 'big'))
+        while receiver.batch_stats()['received_segments'] < count:
+            received = receiver.batch_stats()['received_segments']
+            receiver.receive_batch()
+            self.assertGreater(receiver.batch_stats()['received_segments'], received, "datagrams were lost")
+        recorder.started.set()
+        self.assertTrue(recorder.wait_for(RECEIVE_QUEUE_SIZE))
+        self.assertEqual(receiver.batch_stats()['dropped_segments'], 10)
+        self.assertEqual(recorder.segments, [number.to_bytes(2, 'big') for number in range(RECEIVE_QUEUE_SIZE)])
+
+    def test_worker_batches(self):
+        """under load the protocol worker handles the queued segments in batches, in the order they arrived"""
+        (sender, receiver, recorder) = self.create_layers()
+        batch_sizes = []
+        process_batch = receiver.process_batch
+
+        def record_batch(items):
+            batch_sizes.append(len(items))
+            return process_batch(items)
+
+        receiver.process_batch = record_batch
+        # the worker is kept busy with the first segment while the others are queued
+        recorder.started.clear()
+        segments = [number.to_bytes(2, 'big') for number in range(200)]
+        with sender.batch():
+            for segment in segments:
+                sender.send_segment(segment)
+        deadline = time.monotonic() + 5
+        while receiver.batch_stats()['received_segments'] < len(segments) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        recorder.started.set()
+        self.assertTrue(recorder.wait_for(len(segments)))
+        self.assertEqual(recorder.segments, segments)
+        self.assertGreater(max(batch_sizes), 1)
+        self.assertLessEqual(max(batch_sizes), MAX_DATAGRAM_BATCH)
+        self.assertGreater(receiver.batch_stats()['average_receive_batch'], 1)
+
+
+class StatsSource:
+    """source of fixed statistics for a metrics exporter"""
+
+    def __init__(self, stats):
+        self.stats = lambda: stats
+
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the statistics that are exported in the Prometheus text format"""
+
+    def test_histogram(self):
+        """every value is counted in the first bucket whose upper bound it does not exceed, the counts are
+        cumulative"""
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.Observe(value)
+        self.assertEqual(histogram.Snapshot(), {'buckets': {1: 2, 10: 3, '+Inf': 4}, 'sum': 56.5, 'count': 4})
+
+    def test_flatten_stats(self):
+        """nested dictionaries extend the name, strings are labels and lists hold labelled dictionaries"""
+        stats = {'connected': True, 'sender': {'timeouts': 2}, 'connections': [{'address': 'a', 'bytes': 5},
+                                                                              {'address': 'b', 'bytes': 7}]}
+        self.assertEqual(list(flatten_stats('btcp', stats)), [
+            ('btcp_connected', 'untyped', 'btcp_connected', (), 1.0),
+            ('btcp_sender_timeouts', 'untyped', 'btcp_sender_timeouts', (), 2.0),
+            ('btcp_connections_bytes', 'untyped', 'btcp_connections_bytes', (('address', 'a'),), 5.0),
+            ('btcp_connections_bytes', 'untyped', 'btcp_connections_bytes', (('address', 'b'),), 7.0),
+        ])
+
+    def test_render(self):
+        """every metric has a TYPE line, a histogram has cumulative buckets, a sum and a count, and label values are
+        escaped"""
+        histogram = Histogram((1, 10))
+        for value in (0.5, 5, 5):
+            histogram.Observe(value)
+        connections = [{'address': 'a"b\\c\nd', 'rtt_ms': histogram.Snapshot()},
+                       {'address': 'e', 'rtt_ms': Histogram((1, 10)).Snapshot()}]
+        text = render_prometheus([('btcp_server', lambda: {'ssthresh': math.inf, 'connections': connections})])
+        self.assertEqual(text.splitlines(), [
+            '# TYPE btcp_server_ssthresh untyped',
+            'btcp_server_ssthresh +Inf',
+            '# TYPE btcp_server_connections_rtt_ms histogram',
+            'btcp_server_connections_rtt_ms_bucket{address="a\\"b\\\\c\\nd",le="1"} 1',
+            'btcp_server_connections_rtt_ms_bucket{address="a\\"b\\\\c\\nd",le="10"} 3',
+            'btcp_server_connections_rtt_ms_bucket{address="a\\"b\\\\c\\nd",le="+Inf"} 3',
+            'btcp_server_connections_rtt_ms_bucket{address="e",le="1"} 0',
+            'btcp_server_connections_rtt_ms_bucket{address="e",le="10"} 0',
+            'btcp_server_connections_rtt_ms_bucket{address="e",le="+Inf"} 0',
+            'btcp_server_connections_rtt_ms_sum{address="a\\"b\\\\c\\nd"} 10.5',
+            'btcp_server_connections_rtt_ms_sum{address="e"} 0.0',
+            'btcp_server_connections_rtt_ms_count{address="a\\"b\\\\c\\nd"} 3',
+            'btcp_server_connections_rtt_ms_count{address="e"} 0',
+        ])
+
+    def test_exporter(self):
+        """a running exporter serves the stats of the registered sockets on /metrics, read on every scrape"""
+        network = EmulatedNetwork(seed=seed)
+        server = BTCPServerSocket(winsize, timeout, network=network)
+        exporter = MetricsExporter()
+        try:
+            exporter.register('server', server)
+            exporter.register('test', StatsSource({'retransmissions': 3}))
+            url = 'http://127.0.0.1:{}/metrics'.format(exporter.port)
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+                lines = response.read().decode().splitlines()
+            self.assertIn('# TYPE btcp_server_segments_received untyped', lines)
+            self.assertIn('btcp_server_segments_received 0.0', lines)
+            self.assertIn('btcp_test_retransmissions 3.0', lines)
+            server.lossy_layer_input((Segment(0, 0, 0, 0, 0, 0, None).create_segment(), (CLIENT_IP, CLIENT_PORT)))
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertIn('btcp_server_segments_received 1.0', response.read().decode().splitlines())
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen('http://127.0.0.1:{}/'.format(exporter.port), timeout=5)
+            self.assertEqual(context.exception.code, 404)
+        finally:
+            exporter.close()
+            server.close()
+            network.close()
+
+
+class TestAsyncSockets(unittest.TestCase):
+    """Test cases for the asyncio sockets, which run over UDP on localhost"""
+
+    def test_replaced_connection_ends_read(self):
+        """a reader of a connection that a new connection of the same client replaces gets the end of the data"""
+
+        async def scenario():
+            server = AsyncBTCPServerSocket(winsize, timeout)
+            client = AsyncBTCPClientSocket(winsize, timeout)
+            try:
+                accepting = asyncio.ensure_future(server.accept())
+                await client.connect()
+                connection = await asyncio.wait_for(accepting, 5)
+                reader = asyncio.ensure_future(connection.read())
+                await asyncio.sleep(0.05)
+                self.assertFalse(reader.done(), "read returned before any data arrived")
+
+                # the client starts over with a new initial sequence number from the same address
+                client.clean()
+                await client.connect()
+                self.assertEqual(await asyncio.wait_for(reader, 5), b'', "read of the replaced connection hangs")
+            finally:
+                client.close()
+                server.close()
+
+        asyncio.run(scenario())
+
+    def test_connect_once(self):
+        """connect on a connected socket does not start a new connection"""
+
+        async def scenario():
+            server = AsyncBTCPServerSocket(winsize, timeout)
+            client = AsyncBTCPClientSocket(winsize, timeout)
+            try:
+                accepting = asyncio.ensure_future(server.accept())
+                await client.connect()
+                connection = await asyncio.wait_for(accepting, 5)
+                await client.connect()
+                await asyncio.sleep(0.05)
+                self.assertIs(server.connections()[0], connection, "the accepted connection was replaced")
+                self.assertTrue(connection.is_connected())
+            finally:
+                client.close()
+                server.close()
+
+        asyncio.run(scenario())
 
 
 if __name__ == "__main__":
@@ -319,15 +1559,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="bTCP tests")
     parser.add_argument("-w", "--window", help="Define bTCP window size used", type=int, default=100)
     parser.add_argument("-t", "--timeout", help="Define the timeout value used (ms)", type=int, default=timeout)
+    parser.add_argument("-s", "--seed", help="Define the seed of the emulated network", type=int, default=seed)
     args, extra = parser.parse_known_args()
     timeout = args.timeout
     winsize = args.window
-    output_path = "/home/uppaal/PycharmProjects/nwd-project/src/output/output_{}.file"
+    seed = args.seed
+    output_path = "output/output_{}.file"
     input_file = "input.file"
     output_file = "output/output_{}.file"
 
-    client_socket = BTCPClientSocket(winsize, timeout)
-    server_socket = BTCPServerSocket(winsize, timeout)
+    # the network between client and server is emulated in-process, so the tests need no privileges and every run
+    # with the same seed impairs the same segments
+    network = EmulatedNetwork(seed=seed)
+    client_socket = BTCPClientSocket(winsize, timeout, network=network)
+    server_socket = BTCPServerSocket(winsize, timeout, network=network)
 
     # Pass the extra arguments to unittest
     sys.argv[1:] = extra